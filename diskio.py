@@ -0,0 +1,1047 @@
+#!/usr/bin/env python3
+"""
+Disk I/O Module
+Receiver-side file writing (up-front space reservation, large aligned writes,
+holes for all-zero blocks, a background writer thread), sender-side
+read-ahead, page cache drop-behind for bulk transfers, a splice() receive
+path on Linux, the durability (fsync) policy, staging directories for
+multi-file receives, claims on partial files and sparse file helpers shared
+by both ends.
+"""
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import itertools
+import os
+import queue
+import select
+import socket
+import struct
+import threading
+import zlib
+import time
+from collections import deque
+from pathlib import Path
+import shutil
+import sys
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+SYNC_FILE_RANGE_WAIT_BEFORE = 0x01
+SYNC_FILE_RANGE_WRITE = 0x02
+SYNC_FILE_RANGE_WAIT_AFTER = 0x04
+SPARSE_BLOCK = 1024 * 1024  # granularity of the sparse digest
+
+_fallocate = None
+_sync_file_range = None
+_syncfs = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _fallocate = _libc.fallocate
+        _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        _fallocate.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        _fallocate = None
+    try:
+        _sync_file_range = _libc.sync_file_range
+        _sync_file_range.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_uint]
+        _sync_file_range.restype = ctypes.c_int
+    except (NameError, AttributeError):
+        _sync_file_range = None
+    try:
+        _syncfs = _libc.syncfs
+        _syncfs.argtypes = [ctypes.c_int]
+        _syncfs.restype = ctypes.c_int
+    except (NameError, AttributeError):
+        _syncfs = None
+
+
+def _raise_enospc(path, needed, free):
+    raise OSError(errno.ENOSPC, f"Not enough disk space for {path}: need {needed} bytes, {free} free")
+
+
+def check_free_space(path, needed):
+    """Raise OSError(ENOSPC) if the filesystem holding ``path`` has less than ``needed`` bytes free."""
+    try:
+        free = shutil.disk_usage(os.path.dirname(os.path.abspath(path))).free
+    except OSError:
+        return
+    if free < needed:
+        _raise_enospc(path, needed, free)
+
+
+def data_extents(f, size):
+    """Yield (offset, length) of the data regions of the open file ``f``.
+
+    Uses SEEK_DATA/SEEK_HOLE; where they are unsupported the whole file is
+    one extent.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield 0, size
+        return
+    fd = f.fileno()
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return  # only a hole remains
+            if offset == 0:
+                yield 0, size  # filesystem without SEEK_DATA support
+            return
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def is_sparse(path):
+    """True if ``path`` has fewer allocated bytes than its size (has holes)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    blocks = getattr(st, 'st_blocks', None)
+    return hasattr(os, 'SEEK_DATA') and blocks is not None and blocks * 512 < st.st_size
+
+
+def sparse_digest(path):
+    """SHA-256 over the non-zero SPARSE_BLOCK blocks of ``path`` and its size.
+
+    Each non-zero block contributes its index and contents; holes and
+    all-zero blocks contribute nothing. The digest therefore does not depend
+    on how either filesystem laid out holes, and only data extents are read.
+    """
+    sha = hashlib.sha256()
+    zero = bytes(SPARSE_BLOCK)
+    last = -1
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        for start, length in list(data_extents(f, size)):
+            block = max(start // SPARSE_BLOCK, last + 1)
+            end_block = (start + length - 1) // SPARSE_BLOCK
+            while block <= end_block:
+                f.seek(block * SPARSE_BLOCK)
+                data = f.read(SPARSE_BLOCK)
+                if data != zero[:len(data)]:
+                    sha.update(struct.pack('!Q', block))
+                    sha.update(data)
+                last = block
+                block += 1
+    sha.update(struct.pack('!Q', size))
+    return sha.digest()
+
+
+def preallocate(f, offset, length):
+    """Reserve ``length`` bytes at ``offset`` for the open file ``f``.
+
+    The file size is left unchanged (FALLOC_FL_KEEP_SIZE), so a ``.partial``
+    file still reports how much has really been received. Raises
+    OSError(ENOSPC) right away if the disk cannot hold the data. Where
+    fallocate is not available, only the free space is checked. Returns
+    True if space was reserved.
+    """
+    if length <= 0:
+        return False
+    if _fallocate is not None:
+        if _fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+            return True
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            _raise_enospc(f.name, length, shutil.disk_usage(os.path.dirname(os.path.abspath(f.name))).free)
+        # EOPNOTSUPP (e.g. some network filesystems): fall back to a free space check
+    check_free_space(f.name, length)
+    return False
+
+
+def punch_hole(f, offset, length):
+    """Deallocate a range of ``f`` (keeping its size). Returns True on success."""
+    if _fallocate is None or length <= 0:
+        return False
+    return _fallocate(f.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class BlockWriter:
+    """File-like writer for received data.
+
+    Opens ``path`` for writing at ``offset`` (existing bytes before it are
+    kept, anything after is dropped) and preallocates the rest of
+    ``filesize``. If ``reserve`` is given (sparse transfers, where only the
+    data will take space) nothing is preallocated and only that many free
+    bytes are required. Incoming data of any size is collected into
+    BLOCK_SIZE blocks written at aligned offsets. All-zero blocks are
+    skipped, and their preallocated space is released, so sparse sources
+    stay sparse. close() sets the final file size. Writing more than
+    ``filesize`` bytes is allowed and simply extends the file. With
+    ``bulk`` written data is dropped from the page cache behind the stream
+    (see DropBehind).
+    """
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, path, filesize, offset=0, sparse=True, reserve=None, bulk=False):
+        self.path = path
+        self.filesize = filesize
+        self.sparse = sparse
+        mode = 'r+b' if offset and os.path.exists(path) else 'w+b'
+        self._f = open(path, mode)
+        try:
+            self._f.truncate(offset)
+            self._f.seek(offset)
+            if reserve is None:
+                self._preallocated = preallocate(self._f, offset, filesize - offset)
+            else:
+                self._preallocated = False
+                check_free_space(path, reserve)
+        except Exception:
+            self._f.close()
+            if mode == 'w+b':
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            raise
+        self.position = offset  # logical end of data handed to write()
+        self._buf = bytearray()
+        self._zero = bytes(self.BLOCK_SIZE)
+        self._drop = DropBehind(self._f, offset, dirty=True) if bulk else None
+
+    @property
+    def name(self):
+        return self._f.name
+
+    def write(self, data):
+        self._buf += data
+        self.position += len(data)
+        # Only write once the next aligned block boundary is reached
+        block_start = self.position - len(self._buf)
+        first = self.BLOCK_SIZE - (block_start % self.BLOCK_SIZE)
+        if len(self._buf) >= first:
+            cut = first + ((len(self._buf) - first) // self.BLOCK_SIZE) * self.BLOCK_SIZE
+            with memoryview(self._buf) as view:
+                self._write_out(view[:cut])
+            del self._buf[:cut]
+            if self._drop is not None:
+                self._drop.advance(self.position - len(self._buf))
+        return len(data)
+
+    def _write_out(self, data):
+        if not self.sparse:
+            self._f.write(data)
+            return
+        pos = 0
+        while pos < len(data):
+            offset = self._f.tell()
+            n = min(self.BLOCK_SIZE - (offset % self.BLOCK_SIZE), len(data) - pos)
+            chunk = data[pos:pos + n]
+            if n == self.BLOCK_SIZE and chunk == self._zero:
+                # Leave a hole. The size is extended first: holes cannot be
+                # punched into preallocated space beyond the end of file.
+                self._f.truncate(offset + n)
+                if self._preallocated:
+                    punch_hole(self._f, offset, n)
+                self._f.seek(offset + n)
+            else:
+                self._f.write(chunk)
+            pos += n
+
+    def skip(self, length):
+        """Leave a hole of ``length`` bytes at the current position."""
+        if length <= 0:
+            return
+        if self._buf:
+            with memoryview(self._buf) as view:
+                self._write_out(view)
+            self._buf.clear()
+        self.position += length
+        self._f.seek(self.position)
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def advance(self, length):
+        """Account for ``length`` bytes written to fileno() at ``position`` by the caller.
+
+        Call flush() before writing to the descriptor directly.
+        """
+        self.position += length
+        self._f.seek(self.position)
+        if self._drop is not None:
+            self._drop.advance(self.position)
+
+    def flush(self):
+        """Write buffered data (a partial block) and flush to the OS."""
+        if self._buf:
+            with memoryview(self._buf) as view:
+                self._write_out(view)
+            self._buf.clear()
+        self._f.flush()
+
+    def close(self):
+        if self._f.closed:
+            return
+        try:
+            self.flush()
+            if self._drop is not None:
+                self._drop.finish(self.position)
+            self._f.truncate(self.position)
+            if self._preallocated and self.position < self.filesize:
+                # Interrupted: give back the space reserved past the end of file
+                # (only a shrinking truncate releases it) until the transfer resumes
+                self._f.truncate(self.position + 1)
+                self._f.truncate(self.position)
+        finally:
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PipelinedWriter:
+    """Decouples network reads from disk writes on the receiver.
+
+    The network side fills buffers from a fixed pool (``depth`` buffers of
+    ``buffer_size`` bytes) with recv_into() and queues them. A writer thread
+    writes them through ``writer`` (a BlockWriter), updates ``hasher`` and
+    returns them to the pool. When every buffer is in flight the network
+    side waits; that is the backpressure, so a larger ``depth`` absorbs
+    longer disk stalls. With ``hash_existing`` the writer thread first feeds
+    that many bytes already on disk (a resumed prefix) to ``hasher``.
+    Errors from the writer thread are raised on the next call.
+    """
+    DEPTH = 8
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, writer, depth=None, buffer_size=None, hasher=None, hash_existing=0):
+        self.writer = writer
+        self.hasher = hasher
+        self.position = writer.position
+        self._pool = queue.Queue()
+        self._free_slots = depth or self.DEPTH  # buffers are allocated on first use
+        self._buffer_size = buffer_size or self.BUFFER_SIZE
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(hash_existing,), daemon=True)
+        self._thread.start()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def recv_from(self, conn, limit):
+        """Receive up to ``limit`` bytes from ``conn`` into one pool buffer and queue it.
+
+        Returns the number of bytes received; 0 means the peer closed.
+        """
+        buf = None
+        while buf is None:
+            self._check()
+            if self._free_slots and self._pool.empty():
+                self._free_slots -= 1
+                buf = bytearray(self._buffer_size)
+                break
+            try:
+                buf = self._pool.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        want = min(limit, len(buf))
+        n = 0
+        try:
+            with memoryview(buf) as view:
+                while n < want:
+                    got = conn.recv_into(view[n:want])
+                    if not got:
+                        break
+                    n += got
+        finally:
+            if n:
+                self._queue.put((buf, n))
+            else:
+                self._pool.put(buf)
+        self.position += n
+        return n
+
+    def write(self, data):
+        """Queue bytes that were received elsewhere."""
+        self._check()
+        self._queue.put((data if isinstance(data, bytes) else bytes(data), len(data)))
+        self.position += len(data)
+
+    def skip(self, length):
+        """Queue a hole of ``length`` bytes (see BlockWriter.skip)."""
+        self._check()
+        self._queue.put((None, length))
+        self.position += length
+
+    def digest(self):
+        return self.hasher.digest() if self.hasher is not None else None
+
+    def _run(self, hash_existing):
+        try:
+            if hasattr(self.hasher, 'update_file') and hash_existing:
+                self.hasher.update_file(self.writer.path, hash_existing)  # hashes in parallel
+            elif self.hasher is not None and hash_existing:
+                with open(self.writer.path, 'rb') as f:
+                    remaining = hash_existing
+                    while remaining > 0:
+                        chunk = f.read(min(self.BUFFER_SIZE, remaining))
+                        if not chunk:
+                            break
+                        self.hasher.update(chunk)
+                        remaining -= len(chunk)
+        except Exception as e:
+            self._error = e
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            buf, n = item
+            try:
+                if self._error is None:
+                    if buf is None:
+                        self.writer.skip(n)
+                    else:
+                        with memoryview(buf) as view:
+                            self.writer.write(view[:n])
+                            if self.hasher is not None:
+                                self.hasher.update(view[:n])
+            except Exception as e:
+                self._error = e  # keep draining so the network side never blocks
+            finally:
+                if isinstance(buf, bytearray):
+                    self._pool.put(buf)
+
+    def close(self):
+        """Wait for queued data to reach the BlockWriter, then close it."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        try:
+            self.writer.close()
+        finally:
+            self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SpliceWriter:
+    """Receives payload into a BlockWriter without copying it into Python.
+
+    Linux only: recv_from() moves bytes from the socket into a pipe and from
+    the pipe into the file with os.splice(), so they stay in the kernel.
+    Preallocation, truncation and drop-behind still come from ``writer``;
+    all-zero blocks are written rather than left as holes. If the file's
+    filesystem cannot splice, the rest is received through the writer
+    normally. Nothing is hashed (digest() is None): transfers that verify
+    a digest use PipelinedWriter, which hashes as it writes. Same interface
+    as PipelinedWriter; use supported() to check ``conn`` first.
+    """
+    PIPE_SIZE = 1024 * 1024
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.position = writer.position
+        self._spliced = True
+        self._buf = None
+        writer.flush()
+        self._pipe_r, self._pipe_w = os.pipe()
+        self._pipe_size = 64 * 1024
+        if fcntl is not None:
+            try:
+                self._pipe_size = fcntl.fcntl(self._pipe_w, getattr(fcntl, 'F_SETPIPE_SZ', 1031), self.PIPE_SIZE)
+            except OSError:
+                pass  # default pipe size (limited by /proc/sys/fs/pipe-max-size)
+
+    @staticmethod
+    def supported(conn):
+        """True if ``conn`` is a kernel stream socket that splice() can read from."""
+        return (hasattr(os, 'splice') and isinstance(conn, socket.socket)
+                and conn.type == socket.SOCK_STREAM)
+
+    def _splice_in(self, conn, want):
+        """Move up to ``want`` bytes from ``conn`` into the pipe."""
+        while True:
+            try:
+                return os.splice(conn.fileno(), self._pipe_w, want, flags=getattr(os, 'SPLICE_F_MOVE', 0))
+            except BlockingIOError:
+                # The socket has a timeout, so its descriptor is non-blocking
+                if not select.select([conn], [], [], conn.gettimeout())[0]:
+                    raise socket.timeout("timed out")
+
+    def recv_from(self, conn, limit):
+        """Receive up to ``limit`` bytes from ``conn`` into the file.
+
+        Returns the number of bytes received; 0 means the peer closed.
+        """
+        if not self._spliced:
+            return self._recv_copy(conn, limit)
+        n = self._splice_in(conn, min(limit, self._pipe_size))
+        if not n:
+            return 0
+        fd = self.writer.fileno()
+        left = n
+        while left:
+            try:
+                left -= os.splice(self._pipe_r, fd, left, offset_dst=self.writer.position + n - left,
+                                  flags=getattr(os, 'SPLICE_F_MOVE', 0))
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                # Filesystem without splice support: copy from here on
+                self._spliced = False
+                self.writer.advance(n - left)
+                while left:
+                    data = os.read(self._pipe_r, left)
+                    self.writer.write(data)
+                    left -= len(data)
+                self.position += n
+                return n
+        self.writer.advance(n)
+        self.position += n
+        return n
+
+    def _recv_copy(self, conn, limit):
+        if self._buf is None:
+            self._buf = bytearray(PipelinedWriter.BUFFER_SIZE)
+        with memoryview(self._buf) as view:
+            n = conn.recv_into(view[:min(limit, len(self._buf))])
+            if n:
+                self.writer.write(view[:n])
+        self.position += n
+        return n
+
+    def digest(self):
+        return None
+
+    def close(self):
+        if self._pipe_r is None:
+            return
+        os.close(self._pipe_r)
+        os.close(self._pipe_w)
+        self._pipe_r = self._pipe_w = None
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fadvise(f, offset, length, advice):
+    """posix_fadvise() hint for the open file ``f``; a no-op where unsupported."""
+    if hasattr(os, 'posix_fadvise') and advice is not None:
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, advice)
+        except OSError:
+            pass
+
+
+def _writeback(f, offset, length, wait):
+    """Start (or, with ``wait``, complete) writeback of a range of ``f``."""
+    if _sync_file_range is not None:
+        flags = SYNC_FILE_RANGE_WRITE
+        if wait:
+            flags |= SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WAIT_AFTER
+        if _sync_file_range(f.fileno(), offset, length, flags) == 0:
+            return
+    if wait and hasattr(os, 'fdatasync'):
+        os.fdatasync(f.fileno())
+
+
+class DropBehind:
+    """Evicts a file's pages from the page cache behind a stream (bulk mode).
+
+    Call advance() with the offset the stream has reached. Every ``window``
+    bytes, writeback of the window just finished is started (``dirty``
+    files) and the window before it, which has had a whole window's time to
+    reach the disk, is dropped with POSIX_FADV_DONTNEED. finish() drops the
+    rest. A transfer therefore keeps about two windows per file in the page
+    cache, however much data it moves.
+    """
+    WINDOW = 8 * 1024 * 1024
+
+    def __init__(self, f, start=0, dirty=False, window=None):
+        self._f = f
+        self.dirty = dirty
+        self.window = window or self.WINDOW
+        self._flushed = start  # writeback started up to here
+        self._dropped = start
+
+    def advance(self, position):
+        if position - self._flushed < self.window:
+            return
+        if self.dirty:
+            self._f.flush()
+            _writeback(self._f, self._flushed, position - self._flushed, wait=False)
+        self._drop(self._flushed)
+        self._flushed = position
+
+    def _drop(self, end):
+        if end <= self._dropped:
+            return
+        if self.dirty:
+            # Dirty pages are not evicted; wait until they are on disk
+            _writeback(self._f, self._dropped, end - self._dropped, wait=True)
+        fadvise(self._f, self._dropped, end - self._dropped, getattr(os, 'POSIX_FADV_DONTNEED', None))
+        self._dropped = end
+
+    def finish(self, position):
+        if self.dirty:
+            self._f.flush()
+        self._drop(position)
+        self._flushed = max(self._flushed, position)
+
+
+class ReadAhead:
+    """Reads file ranges ahead of the sender on a background thread.
+
+    ``items`` is a list of (path, offset, length) ranges that will be sent
+    in order. A reader thread fills pooled buffers (``depth`` chunks of
+    ``chunk_size`` bytes) so disk latency overlaps with network time. The
+    current file is read with POSIX_FADV_SEQUENTIAL, and the next
+    HINT_FILES files are opened early with POSIX_FADV_WILLNEED so the
+    kernel starts fetching them too. With ``bulk`` the pages already read
+    are dropped from the page cache (see DropBehind). chunks() yields the
+    data of the next item; each chunk is only valid until the next one is
+    requested.
+    """
+    CHUNK_SIZE = 256 * 1024
+    DEPTH = 16
+    HINT_FILES = 4
+    HINT_BYTES = 8 * 1024 * 1024  # WILLNEED window for upcoming files
+
+    _END = object()
+
+    def __init__(self, items, chunk_size=None, depth=None, bulk=False):
+        self.items = list(items)
+        self.bulk = bulk
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self._pool = queue.Queue()
+        self._free_slots = depth or self.DEPTH
+        self._queue = queue.Queue()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _take_buffer(self):
+        while not self._stop:
+            if self._free_slots and self._pool.empty():
+                self._free_slots -= 1
+                return bytearray(self.chunk_size)
+            try:
+                return self._pool.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return None
+
+    def _open_hinted(self, item):
+        path, offset, length = item
+        try:
+            f = open(path, 'rb', buffering=0)
+        except OSError as e:
+            return e
+        fadvise(f, offset, min(length, self.HINT_BYTES), getattr(os, 'POSIX_FADV_WILLNEED', None))
+        return f
+
+    def _run(self):
+        upcoming = deque()
+        hinted = 0
+        try:
+            for index, (path, offset, length) in enumerate(self.items):
+                while hinted < len(self.items) and hinted <= index + self.HINT_FILES:
+                    upcoming.append(self._open_hinted(self.items[hinted]))
+                    hinted += 1
+                f = upcoming.popleft()
+                if isinstance(f, Exception):
+                    raise f
+                with f:
+                    fadvise(f, offset, length, getattr(os, 'POSIX_FADV_SEQUENTIAL', None))
+                    f.seek(offset)
+                    drop = DropBehind(f, offset) if self.bulk else None
+                    remaining = length
+                    while remaining > 0:
+                        buf = self._take_buffer()
+                        if buf is None:
+                            return
+                        with memoryview(buf) as view:
+                            n = f.readinto(view[:min(len(buf), remaining)])
+                        if not n:
+                            self._pool.put(buf)
+                            break  # file shrank; the consumer sees fewer bytes
+                        self._queue.put((buf, n))
+                        remaining -= n
+                        if drop is not None:
+                            drop.advance(offset + length - remaining)
+                    if drop is not None:
+                        drop.finish(offset + length - remaining)
+                self._queue.put(self._END)
+        except Exception as e:
+            self._queue.put(e)
+        finally:
+            for f in upcoming:
+                if not isinstance(f, Exception):
+                    f.close()
+
+    def chunks(self):
+        """Yield the data of the next item, chunk by chunk."""
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            buf, n = item
+            try:
+                with memoryview(buf) as view:
+                    yield view[:n]
+            finally:
+                self._pool.put(buf)
+
+    def close(self):
+        self._stop = True
+        # Unblock and drain the reader
+        while self._thread.is_alive():
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(item, tuple):
+                self._pool.put(item[0])
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+DURABILITY_MODES = ('none', 'file', 'group')
+
+
+def fsync_path(path):
+    """fsync() the file at ``path`` and its directory, so its data and name survive a crash."""
+    fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # directories cannot be opened on Windows
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _Ticket:
+    __slots__ = ('path', 'done', 'error')
+
+    def __init__(self, path):
+        self.path = path
+        self.done = False
+        self.error = None
+
+
+class Durability:
+    """When received files must be on stable storage before they are acknowledged.
+
+    'none' never syncs (the OS writes data back on its own schedule).
+    'file' fsyncs each file and its directory as it is committed. 'group'
+    batches files: a background thread makes everything committed so far
+    durable with one syncfs() per filesystem (an fsync per file where
+    syncfs is unavailable) once ``group_files`` files are pending or the
+    oldest has waited ``group_ms`` milliseconds. commit() returns a ticket
+    and wait() blocks until the given tickets are durable, so the files of
+    a multi-file session and concurrent transfers share one sync.
+    """
+    GROUP_FILES = 1000
+    GROUP_MS = 50
+
+    def __init__(self, mode='none', group_files=None, group_ms=None):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {mode}")
+        self.mode = mode
+        self.group_files = group_files or self.GROUP_FILES
+        self.group_ms = self.GROUP_MS if group_ms is None else group_ms
+        self._cond = threading.Condition()
+        self._pending = []
+        self._first_pending = None  # when the oldest pending file was committed
+        self._thread = None
+
+    def commit(self, path):
+        """Register the finished file ``path``; returns a ticket for wait() (or None)."""
+        if self.mode == 'none':
+            return None
+        if self.mode == 'file':
+            fsync_path(path)
+            return None
+        ticket = _Ticket(str(path))
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if not self._pending:
+                self._first_pending = time.monotonic()
+            self._pending.append(ticket)
+            self._cond.notify_all()
+        return ticket
+
+    def done(self, ticket):
+        """True if wait(ticket) would not block"""
+        with self._cond:
+            return ticket is None or ticket.done
+
+    def wait(self, *tickets):
+        """Block until every ticket is durable; raises the OSError of a failed sync."""
+        tickets = [t for t in tickets if t is not None]
+        if not tickets:
+            return
+        with self._cond:
+            while not all(t.done for t in tickets):
+                self._cond.wait()
+        for t in tickets:
+            if t.error is not None:
+                raise t.error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._pending:
+                        due = self._first_pending + self.group_ms / 1000.0 - time.monotonic()
+                        if len(self._pending) >= self.group_files or due <= 0:
+                            break
+                        self._cond.wait(due)
+                    else:
+                        self._cond.wait()
+                batch, self._pending = self._pending, []
+            error = None
+            try:
+                self._sync([t.path for t in batch])
+            except OSError as e:
+                error = e
+            with self._cond:
+                for t in batch:
+                    t.done = True
+                    t.error = error
+                self._cond.notify_all()
+
+    def _sync(self, paths):
+        dirs = {os.path.dirname(os.path.abspath(p)) for p in paths}
+        if _syncfs is not None:
+            # One syncfs() per filesystem covers every file and rename on it
+            synced = set()
+            for d in dirs:
+                fd = os.open(d, os.O_RDONLY)
+                try:
+                    dev = os.fstat(fd).st_dev
+                    if dev not in synced:
+                        if _syncfs(fd) != 0:
+                            err = ctypes.get_errno()
+                            raise OSError(err, os.strerror(err))
+                        synced.add(dev)
+                finally:
+                    os.close(fd)
+            return
+        for p in paths:
+            fd = os.open(p, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for d in dirs:
+            _fsync_dir(d)
+
+
+class StagingArea:
+    """Receives a batch of files out of sight, then moves them into ``root`` at once.
+
+    Files are written below a hidden directory in ``root`` (same
+    filesystem, so moving them is a rename). commit() moves every staged
+    top-level file or directory into place: an entry that does not exist
+    in ``root`` yet moves with a single rename, so readers see a received
+    tree all at once, and existing directories are merged file by file.
+    Created directories are cached, so deep trees cost one mkdir per
+    directory. Leaving the with block without commit() (or calling
+    discard()) removes everything staged.
+    """
+    PREFIX = '.netlink-staging-'
+    _counter = itertools.count()
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.path = self.root / f'{self.PREFIX}{os.getpid()}-{next(self._counter)}'
+        self.path.mkdir(parents=True)
+        self._dirs = {self.path}
+        self._files = []  # relative paths, in the order they were staged
+        self.committed = False
+
+    def file_path(self, relative):
+        """Staging path for the file that will end up at ``root / relative``."""
+        path = self.path / relative
+        parent = path.parent
+        if parent not in self._dirs:
+            parent.mkdir(parents=True, exist_ok=True)
+            while parent not in self._dirs and parent != parent.parent:
+                self._dirs.add(parent)
+                parent = parent.parent
+        self._files.append(relative)
+        return path
+
+    def commit(self):
+        """Move the staged files into ``root``; returns their final paths.
+
+        Every move is planned and checked against ``root`` first, so a
+        staged file that would land on a directory (or a directory on a
+        file) raises before anything is renamed. Each rename is atomic, but
+        the merge as a whole is not: if one fails part way (disk error,
+        crash), ``root`` keeps the complete files already moved and the
+        rest are discarded with the staging directory. The batch is not
+        acknowledged then, so the sender resends it and the moved files are
+        simply replaced.
+        """
+        moves = []
+        self._plan(self.path, self.root, moves)
+        for src, dst in moves:
+            os.replace(src, dst)
+        self.committed = True
+        self.discard()
+        return [self.root / relative for relative in self._files]
+
+    def _plan(self, src_dir, dst_dir, moves):
+        for entry in os.scandir(src_dir):
+            dst = os.path.join(dst_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.isdir(dst):
+                    self._plan(entry.path, dst, moves)
+                elif os.path.lexists(dst):
+                    raise NotADirectoryError(errno.ENOTDIR, "Received directory collides with a file", dst)
+                else:
+                    moves.append((entry.path, dst))  # the whole subtree appears at once
+            elif os.path.isdir(dst) and not os.path.islink(dst):
+                raise IsADirectoryError(errno.EISDIR, "Received file collides with a directory", dst)
+            else:
+                moves.append((entry.path, dst))
+
+    def discard(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    @classmethod
+    def cleanup(cls, root):
+        """Remove staging directories left in ``root`` by receivers that are gone."""
+        if os.name != 'posix':
+            return  # cannot tell whether the owning process is alive
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            return
+        for entry in entries:
+            if not entry.name.startswith(cls.PREFIX):
+                continue
+            try:
+                pid = int(entry.name[len(cls.PREFIX):].split('-')[0])
+                os.kill(pid, 0)
+                continue  # still receiving
+            except ProcessLookupError:
+                pass
+            except (ValueError, PermissionError):
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self.committed:
+            self.discard()
+
+
+class PartialLocks:
+    """Exclusive claims on ``.partial`` files while they are being received.
+
+    Claims are tracked per owner (a connection) so they can all be dropped
+    when it ends. Threads of one process are coordinated in memory. With
+    ``shared`` (receive workers in several processes sharing ``directory``)
+    each claim also takes an fcntl lock on one byte of a lock file there,
+    at a slot chosen by a hash of the path; unrelated paths rarely share
+    one of the SLOTS slots, and if they do one transfer is just refused
+    until the other ends.
+    """
+    SLOTS = 1 << 20
+    LOCK_FILE = '.netlink-locks'
+
+    def __init__(self, directory, shared=False):
+        self.directory = Path(directory)
+        self.shared = shared and fcntl is not None
+        self._lock = threading.Lock()
+        self._paths = {}  # path -> owner
+        self._slots = {}  # slot -> number of claims in this process
+        self._fd = None
+
+    def _slot(self, path):
+        return zlib.crc32(path.encode('utf-8')) % self.SLOTS
+
+    def acquire(self, path, owner):
+        """Claim ``path`` for ``owner``; False if someone else is receiving it."""
+        path = os.path.abspath(str(path))
+        with self._lock:
+            if path in self._paths:
+                return self._paths[path] == owner
+            if self.shared:
+                slot = self._slot(path)
+                if not self._slots.get(slot):
+                    if self._fd is None:
+                        self._fd = os.open(self.directory / self.LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+                    try:
+                        fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                    except OSError:
+                        return False  # held by another worker process
+                self._slots[slot] = self._slots.get(slot, 0) + 1
+            self._paths[path] = owner
+            return True
+
+    def holder(self, path):
+        """The owner claiming ``path`` in this process, or None"""
+        with self._lock:
+            return self._paths.get(os.path.abspath(str(path)))
+
+    def release(self, owner):
+        """Drop every claim held by ``owner``."""
+        with self._lock:
+            for path in [p for p, o in self._paths.items() if o == owner]:
+                del self._paths[path]
+                if self.shared:
+                    slot = self._slot(path)
+                    self._slots[slot] -= 1
+                    if not self._slots[slot]:
+                        del self._slots[slot]
+                        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
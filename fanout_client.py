@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Fan-out Client Module
+Sends the same file(s) to many receivers at once, reading and hashing each
+file only once and sharing the blocks between all destinations
+"""
+import socket
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+from transfer_client import TransferClient, TransferPaused
+from diskio import DropBehind
+from ratelimit import RateLimiter
+from transport import STALL_TIMEOUT
+
+
+def parse_destination(dest, default_port=5000):
+    """Turn 'host', 'host:port' or a (host, port) tuple into (host, port)."""
+    if isinstance(dest, (tuple, list)):
+        return dest[0], int(dest[1])
+    dest = str(dest).strip()
+    if dest.count(':') == 1:
+        host, port = dest.split(':')
+        return host, int(port)
+    return dest, default_port
+
+
+class _PeerQueue:
+    """Bounded per-destination block queue.
+
+    The shared reader pushes (offset, data) blocks here. When the queue is full
+    the peer is detached from the shared pipeline and continues on its own
+    from disk, so a slow receiver never holds back the others.
+    """
+
+    def __init__(self, max_blocks):
+        self.max_blocks = max_blocks
+        self.blocks = deque()
+        self.cond = threading.Condition()
+        self.detached = False
+        self.finished = False  # reader reached end of file
+        self.closed = False    # consumer gave up (error/cancel)
+
+    def offer(self, block):
+        """Try to enqueue a block; detach the peer if it is too far behind."""
+        with self.cond:
+            if self.detached or self.closed:
+                return False
+            if len(self.blocks) >= self.max_blocks:
+                self.detached = True
+                self.cond.notify_all()
+                return False
+            self.blocks.append(block)
+            self.cond.notify_all()
+            return True
+
+    def has_room(self):
+        with self.cond:
+            return not self.detached and not self.closed and len(self.blocks) < self.max_blocks
+
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.blocks.clear()
+            self.cond.notify_all()
+
+    def get(self, timeout=0.5):
+        """Return the next block, or None when detached/finished and drained."""
+        with self.cond:
+            while not self.blocks:
+                if self.detached or self.finished or self.closed:
+                    return None
+                self.cond.wait(timeout)
+            block = self.blocks.popleft()
+            self.cond.notify_all()
+            return block
+
+
+class FanoutSender:
+    """Send files to several receivers using one read and one hash per file.
+
+    Every destination gets its own connection and resumable (0xFFFF0003)
+    session, so each peer can resume from its own offset. A single reader
+    thread feeds a shared in-memory block pipeline; each peer has a bounded
+    queue (``window_blocks`` deep) and is served by its own thread.
+    """
+    BLOCK_SIZE = 256 * 1024
+    WINDOW_BLOCKS = 64  # per-destination backpressure window (16 MiB by default)
+    MAX_RETRIES = TransferClient.MAX_RETRIES
+    RETRY_DELAY = TransferClient.RETRY_DELAY
+
+    def __init__(self, destinations, default_port=5000, pause_event=None,
+                 cancel_flag_fn=None, block_size=None, window_blocks=None, transport='auto', bulk=False,
+                 rate_limiter=None, stall_timeout=STALL_TIMEOUT, min_rate=0):
+        self.destinations = [parse_destination(d, default_port) for d in destinations]
+        if not self.destinations:
+            raise ValueError("At least one destination is required")
+        self.pause_event = pause_event
+        self.cancel_flag_fn = cancel_flag_fn
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.window_blocks = window_blocks or self.WINDOW_BLOCKS
+        self.transport = transport
+        self.bulk = bulk  # drop file data from the page cache behind the readers
+        # Shared by every destination, so global and per-peer limits cover them all
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # Each destination reconnects and resumes on its own when it stalls
+        self.stall_timeout = stall_timeout
+        self.min_rate = min_rate
+
+    def send_file(self, filepath, progress_callback=None):
+        """Send a file or directory to every destination."""
+        filepath = Path(filepath)
+        if filepath.is_dir():
+            return self.send_directory(filepath, progress_callback)
+        return self.send_files([filepath], progress_callback)
+
+    def send_directory(self, dirpath, progress_callback=None):
+        """Send a directory tree, preserving paths relative to its parent."""
+        dirpath = Path(dirpath)
+        if not dirpath.is_dir():
+            raise NotADirectoryError(f"Not a directory: {dirpath}")
+        files = [f for f in dirpath.rglob('*') if f.is_file()]
+        if not files:
+            raise FileNotFoundError(f"No files found in directory: {dirpath}")
+        names = [str(f.relative_to(dirpath.parent)).replace('\\', '/') for f in files]
+        return self._send_many(list(zip(files, names)), progress_callback)
+
+    def send_files(self, filepaths, progress_callback=None):
+        """Send a list of files (and/or directories) to every destination.
+
+        Returns a dict mapping (host, port) to None on success or the
+        exception that made that destination fail.
+        """
+        items = []
+        for filepath in filepaths:
+            filepath = Path(filepath)
+            if not filepath.exists():
+                raise FileNotFoundError(f"File not found: {filepath}")
+            if filepath.is_dir():
+                for f in filepath.rglob('*'):
+                    if f.is_file():
+                        items.append((f, str(f.relative_to(filepath.parent)).replace('\\', '/')))
+            else:
+                items.append((filepath, filepath.name))
+        return self._send_many(items, progress_callback)
+
+    def _send_many(self, items, progress_callback=None):
+        errors = {dest: None for dest in self.destinations}
+        for filepath, name in items:
+            # Peers that already failed are not retried for later files
+            active = [d for d in self.destinations if errors[d] is None]
+            if not active:
+                break
+            result = self._fanout_one(filepath, name, active, progress_callback)
+            for dest, err in result.items():
+                if err is not None:
+                    errors[dest] = err
+        failed = [d for d, e in errors.items() if e is not None]
+        print(f"Fan-out complete: {len(self.destinations) - len(failed)}/{len(self.destinations)} destination(s) succeeded")
+        return errors
+
+    def _fanout_one(self, filepath, name, destinations, progress_callback=None):
+        """Distribute one file to ``destinations`` with a single shared read."""
+        filesize = filepath.stat().st_size
+        helper = TransferClient(None, None, bulk=self.bulk)
+        print(f"Fan-out: {name} ({helper._format_size(filesize)}) to {len(destinations)} destination(s)")
+
+        # Hash once for all destinations
+        digest = helper._compute_sha256(filepath)
+
+        peers = []
+        errors = {}
+        for dest in destinations:
+            peer = {
+                'dest': dest,
+                'client': TransferClient(dest[0], dest[1], pause_event=self.pause_event,
+                                         cancel_flag_fn=self.cancel_flag_fn, transport=self.transport,
+                                         bulk=self.bulk, rate_limiter=self.rate_limiter,
+                                         stall_timeout=self.stall_timeout, min_rate=self.min_rate),
+                'queue': _PeerQueue(self.window_blocks),
+                'sock': None,
+                'offset': 0,
+            }
+            try:
+                self._open_session(peer, name, filesize, digest)
+            except Exception as e:
+                print(f"Fan-out: {dest[0]}:{dest[1]} unavailable: {e}")
+                errors[dest] = e
+                continue
+            peers.append(peer)
+
+        if not peers:
+            return errors
+
+        threads = []
+        for peer in peers:
+            t = threading.Thread(target=self._peer_worker,
+                                 args=(peer, filepath, name, filesize, digest, progress_callback, errors),
+                                 daemon=True)
+            threads.append(t)
+            t.start()
+
+        self._read_shared(filepath, filesize, peers)
+
+        for t in threads:
+            t.join()
+        for peer in peers:
+            errors.setdefault(peer['dest'], None)
+        return errors
+
+    def _open_session(self, peer, name, filesize, digest):
+        sock = peer['client']._connect()
+        try:
+            peer['offset'] = peer['client']._start_resumable(sock, name, filesize, digest)
+        except Exception:
+            sock.close()
+            raise
+        peer['sock'] = sock
+
+    def _read_shared(self, filepath, filesize, peers):
+        """Single reader: stream the file once into every attached peer queue."""
+        start = min(p['offset'] for p in peers)
+        queues = [p['queue'] for p in peers]
+        try:
+            with open(filepath, 'rb') as f:
+                f.seek(start)
+                offset = start
+                drop = DropBehind(f, start) if self.bulk else None
+                while offset < filesize:
+                    # Pace the reader on the fastest attached peer only
+                    while True:
+                        attached = [q for q in queues if not q.detached and not q.closed]
+                        if not attached:
+                            return
+                        if any(q.has_room() for q in attached):
+                            break
+                        time.sleep(0.005)
+                    data = f.read(min(self.block_size, filesize - offset))
+                    if not data:
+                        break
+                    block = (offset, data)
+                    for q in attached:
+                        q.offer(block)
+                    offset += len(data)
+                    if drop is not None:
+                        drop.advance(offset)
+                if drop is not None:
+                    drop.finish(offset)
+        finally:
+            for q in queues:
+                q.finish()
+
+    def _peer_worker(self, peer, filepath, name, filesize, digest, progress_callback, errors):
+        dest = peer['dest']
+        attempt = 1
+        while True:
+            try:
+                if peer['sock'] is None:
+                    # Reconnect and resume privately from the server's offset
+                    self._open_session(peer, name, filesize, digest)
+                self._stream_to_peer(peer, filepath, filesize, progress_callback)
+                errors[dest] = None
+                return
+            except TransferPaused:
+                # Connection and rate-limit share released; resume privately from disk
+                peer['queue'].close()
+                peer['client']._release_throttle()
+                print(f"\nFan-out: {dest[0]}:{dest[1]} paused; connection released until resumed")
+                peer['client']._wait_until_resumed()
+            except (socket.error, ConnectionError) as e:
+                peer['queue'].close()
+                if attempt >= self.MAX_RETRIES:
+                    print(f"\nFan-out: {dest[0]}:{dest[1]} failed after {attempt} attempts: {e}")
+                    errors[dest] = e
+                    return
+                wait_time = self.RETRY_DELAY * (2 ** (attempt - 1))
+                print(f"\nFan-out: {dest[0]}:{dest[1]} failed (attempt {attempt}/{self.MAX_RETRIES}): {e}")
+                attempt += 1
+                time.sleep(wait_time)
+            except Exception as e:
+                peer['queue'].close()
+                print(f"\nFan-out: {dest[0]}:{dest[1]} failed: {e}")
+                errors[dest] = e
+                return
+            finally:
+                peer['client']._release_throttle()
+                if peer['sock'] is not None:
+                    try:
+                        peer['sock'].close()
+                    except Exception:
+                        pass
+                    peer['sock'] = None
+
+    def _stream_to_peer(self, peer, filepath, filesize, progress_callback=None):
+        client = peer['client']
+        sock = peer['sock']
+        q = peer['queue']
+        sent = peer['offset']
+        start_time = time.time()
+        watchdog = client._watch(sock)
+
+        def _report():
+            if not progress_callback:
+                return
+            elapsed = max(0.001, time.time() - start_time)
+            speed = (sent - peer['offset']) / elapsed
+            eta = int((filesize - sent) / speed) if speed > 0 else None
+            try:
+                progress_callback(peer['dest'], sent, filesize, speed, eta)
+            except Exception:
+                pass
+
+        # Phase 1: consume shared blocks while attached
+        while sent < filesize:
+            block = q.get()
+            if block is None:
+                break
+            if self.cancel_flag_fn and self.cancel_flag_fn():
+                raise Exception("Transfer cancelled by user")
+            client._wait_if_paused(release=True)
+            block_offset, data = block
+            end = block_offset + len(data)
+            if end <= sent:
+                continue  # peer resumed past this block
+            if block_offset < sent:
+                data = memoryview(data)[sent - block_offset:]
+            client._send_paced(sock, b'', data)
+            watchdog.record(len(data))
+            sent = end
+            _report()
+
+        # Phase 2: detached (too slow) or reconnected: read privately from disk
+        if sent < filesize:
+            with open(filepath, 'rb') as f:
+                f.seek(sent)
+                drop = DropBehind(f, sent) if self.bulk else None
+                while sent < filesize:
+                    if self.cancel_flag_fn and self.cancel_flag_fn():
+                        raise Exception("Transfer cancelled by user")
+                    client._wait_if_paused(release=True)
+                    data = f.read(min(self.block_size, filesize - sent))
+                    if not data:
+                        break
+                    client._send_paced(sock, b'', data)
+                    watchdog.record(len(data))
+                    sent += len(data)
+                    if drop is not None:
+                        drop.advance(sent)
+                    _report()
+                if drop is not None:
+                    drop.finish(sent)
+
+        ack = client._wait_ack(sock, filesize - peer['offset'])
+        if ack != b'OK':
+            raise Exception("Server reported error after transfer (checksum mismatch?)")
+        peer['offset'] = sent
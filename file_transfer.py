@@ -5,8 +5,57 @@ Supports Windows, Linux, and macOS
 """
 import argparse
 import sys
+import threading
 from transfer_server import TransferServer
 from transfer_client import TransferClient
+from fanout_client import FanoutSender, parse_destination
+from multicast_transfer import MulticastSender, MulticastReceiver
+from hashing import parse_algorithms, DEFAULT_ACCEPTED
+from ratelimit import RateLimiter, parse_rate
+
+
+def _algorithms(text):
+    try:
+        return parse_algorithms(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _rate(text):
+    try:
+        return parse_rate(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _add_rate_arguments(subparser):
+    units = 'KB/s, or with a K, M or G suffix (e.g. 10M); type "global RATE", "peer [HOST] RATE" or ' \
+            '"transfer RATE" while running to change a limit'
+    subparser.add_argument('--max-rate', type=_rate, default=0,
+                           help=f'Limit all transfers together to this rate in {units}')
+    subparser.add_argument('--max-peer-rate', type=_rate, default=0,
+                           help='Limit the transfers with each peer together to this rate')
+    subparser.add_argument('--max-transfer-rate', type=_rate, default=0,
+                           help='Limit each transfer to this rate')
+
+
+def _rate_limiter(args, live=True):
+    """The limiter for the --max-*-rate options; with ``live``, stdin commands change it"""
+    limiter = RateLimiter(args.max_rate, args.max_peer_rate, args.max_transfer_rate)
+    if not live:
+        return limiter
+
+    def read_commands():
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                print(limiter.command(line))
+            except ValueError as e:
+                print(e)
+
+    threading.Thread(target=read_commands, daemon=True).start()
+    return limiter
 
 
 def main():
@@ -20,6 +69,19 @@ Examples:
   
   Send a file:
     python file_transfer.py send --host 192.168.1.100 --port 5000 --file document.pdf
+
+  Send a file to several receivers at once (read and hashed only once):
+    python file_transfer.py send --host 192.168.1.100 --host 192.168.1.101:5001 --file image.iso
+
+  Distribute through a relay chain (receivers started with --relay):
+    python file_transfer.py send --relay --host 10.0.0.1 --host 10.0.0.2 --host 10.0.0.3 --file image.iso
+
+  Multicast one file to every subscribed receiver on the segment:
+    python file_transfer.py receive --multicast --output-dir ./received
+    python file_transfer.py send --multicast --file image.iso --rate 50
+
+  Limit a receiver to 10 MB/s in total and 2 MB/s per sender (type "global 20M" to raise it live):
+    python file_transfer.py receive --max-rate 10M --max-peer-rate 2M
         """
     )
     
@@ -29,26 +91,161 @@ Examples:
     receive_parser = subparsers.add_parser('receive', help='Start server to receive files')
     receive_parser.add_argument('--port', type=int, default=5000, help='Port to listen on (default: 5000)')
     receive_parser.add_argument('--output-dir', default='.', help='Directory to save received files (default: current directory)')
+    receive_parser.add_argument('--relay', action='store_true', help='Forward relay-chain transfers to the next receiver in the chain')
+    receive_parser.add_argument('--multicast', action='store_true', help='Receive files distributed over reliable UDP multicast')
+    receive_parser.add_argument('--interface', default=None, help='Local interface IP to join the multicast group on')
+    receive_parser.add_argument('--no-copy-offload', action='store_true',
+                                help='Always receive file data over the network, even from senders on shared storage')
+    receive_parser.add_argument('--shared-mount', action='append', default=[], metavar='DIR',
+                                help='Let senders on other hosts have files under DIR copied locally instead of '
+                                     'sent (copy offload; by default only senders on this host). Repeat for more')
+    receive_parser.add_argument('--hardlink', action='store_true',
+                                help='Allow hardlinking files offered from shared storage when they cannot be copied')
+    receive_parser.add_argument('--queue-depth', type=int, default=8,
+                                help='1 MB buffers the network may run ahead of the disk writer (default: 8)')
+    receive_parser.add_argument('--udp', action='store_true',
+                                help='Also accept transfers over the UDP transport (for long-RTT or lossy links)')
+    receive_parser.add_argument('--bulk', action='store_true',
+                                help='Keep received data out of the page cache (for very large transfers)')
+    receive_parser.add_argument('--no-zero-copy', action='store_true',
+                                help='Copy received data through user space instead of using splice()')
+    receive_parser.add_argument('--durability', choices=['none', 'file', 'group'], default='none',
+                                help='Sync received files to disk before acknowledging them: never (default), '
+                                     'per file, or in groups')
+    receive_parser.add_argument('--group-files', type=int, default=1000,
+                                help='With --durability group: sync after this many files (default: 1000)')
+    receive_parser.add_argument('--group-ms', type=int, default=50,
+                                help='With --durability group: sync at least this often, in ms (default: 50)')
+    receive_parser.add_argument('--peer-quota', type=float, default=None,
+                                help='Refuse transfers once a sender has sent this many MB (default: no quota)')
+    receive_parser.add_argument('--min-free', type=float, default=0,
+                                help='Refuse transfers that would leave less than this many MB free (default: 0)')
+    receive_parser.add_argument('--workers', type=int, default=1,
+                                help='Receive in this many processes sharing the port, to use several CPU cores '
+                                     '(Linux/BSD, default: 1)')
+    receive_parser.add_argument('--worker-threads', type=int, default=4,
+                                help='With --workers: concurrent transfers per worker process (default: 4)')
+    receive_parser.add_argument('--accept-integrity', type=_algorithms, default=DEFAULT_ACCEPTED,
+                                help='Comma-separated integrity checks senders may choose from sha256, blake2b, '
+                                     'crc32, adler32 and none (default: all but none)')
+    receive_parser.add_argument('--max-chunk-size', type=int, default=16384,
+                                help='Largest chunk in KB a sender may use (default: 16384)')
+    _add_rate_arguments(receive_parser)
+    receive_parser.add_argument('--stall-timeout', type=float, default=30,
+                                help='Drop connections that send nothing for this many seconds so the sender '
+                                     'can resume on a new one; 0 waits forever (default: 30)')
     
     # Send command
     send_parser = subparsers.add_parser('send', help='Send a file to a receiver')
-    send_parser.add_argument('--host', required=True, help='IP address or hostname of the receiver')
+    send_parser.add_argument('--host', action='append',
+                             help='IP address or hostname of the receiver (HOST or HOST:PORT); '
+                                  'repeat to fan out to several receivers')
     send_parser.add_argument('--port', type=int, default=5000, help='Port of the receiver (default: 5000)')
     send_parser.add_argument('--file', required=True, help='Path to the file to send')
+    send_parser.add_argument('--relay', action='store_true',
+                             help='Send only to the first --host and let each receiver forward to the next one')
+    send_parser.add_argument('--multicast', action='store_true',
+                             help='Distribute the file once over reliable UDP multicast (no --host needed)')
+    send_parser.add_argument('--receivers', type=int, default=None,
+                             help='With --multicast: wait until this many receivers have verified the file')
+    send_parser.add_argument('--rate', type=float, default=8,
+                             help='With --multicast: maximum send rate in MB/s (default: 8)')
+    send_parser.add_argument('--interface', default=None, help='With --multicast: local interface IP to send from')
+    send_parser.add_argument('--udp', action='store_true',
+                             help='Use the congestion-controlled UDP transport instead of TCP (receiver needs --udp)')
+    send_parser.add_argument('--bulk', action='store_true',
+                             help='Keep sent file data out of the page cache (for very large transfers)')
+    send_parser.add_argument('--no-zero-copy', action='store_true',
+                             help='Read and send file data in user space instead of using sendfile()')
+    send_parser.add_argument('--no-tree-hash', action='store_true',
+                             help='Verify large files with a plain SHA256 instead of a tree hash computed on all cores')
+    send_parser.add_argument('--integrity', type=_algorithms, default=None,
+                             help='Comma-separated integrity checks to offer, preferred first: sha256, blake2b, '
+                                  'crc32, adler32 or none (e.g. blake2b,sha256)')
+    send_parser.add_argument('--chunk-size', type=int, default=None,
+                             help='Send in chunks of this many KB instead of adapting the chunk size to the link')
+    _add_rate_arguments(send_parser)
+    send_parser.add_argument('--stall-timeout', type=float, default=30,
+                             help='Reconnect and resume when the receiver takes nothing for this many seconds; '
+                                  '0 waits forever (default: 30)')
+    send_parser.add_argument('--min-rate', type=float, default=0,
+                             help='Also reconnect when throughput stays below this many KB/s for 20 seconds')
+    send_parser.add_argument('--multiplex', action='store_true',
+                             help='Send the files of a folder interleaved over one connection, so small files '
+                                  'are not held up behind large ones (each file is placed as soon as it arrives)')
     
     args = parser.parse_args()
     
     if not args.command:
         parser.print_help()
         sys.exit(1)
+    if args.command == 'receive' and args.workers > 1 and (args.max_rate or args.max_peer_rate):
+        parser.error('receive: --max-rate and --max-peer-rate cannot be combined with --workers '
+                     '(each worker process paces only its own connections); use --max-transfer-rate')
     
     try:
-        if args.command == 'receive':
-            server = TransferServer(port=args.port, output_dir=args.output_dir)
+        if args.command == 'receive' and args.multicast:
+            receiver = MulticastReceiver(output_dir=args.output_dir, interface=args.interface)
+            receiver.start()
+        elif args.command == 'receive':
+            if args.workers > 1 and args.max_transfer_rate:
+                print("Rate limits cannot be changed while running with --workers")
+            server = TransferServer(port=args.port, output_dir=args.output_dir, relay=args.relay,
+                                    udp=args.udp, copy_offload=not args.no_copy_offload,
+                                    allow_hardlink=args.hardlink, pipeline_depth=args.queue_depth,
+                                    bulk=args.bulk, zero_copy=not args.no_zero_copy,
+                                    durability=args.durability, group_files=args.group_files,
+                                    group_ms=args.group_ms, min_free=int(args.min_free * 1024 * 1024),
+                                    peer_quota=int(args.peer_quota * 1024 * 1024) if args.peer_quota is not None else None,
+                                    workers=args.workers, worker_threads=args.worker_threads,
+                                    integrity=args.accept_integrity, max_chunk=args.max_chunk_size * 1024,
+                                    stall_timeout=args.stall_timeout, shared_mounts=args.shared_mount,
+                                    rate_limiter=_rate_limiter(args, live=args.workers <= 1))
             server.start()
+        elif args.command == 'send' and args.multicast:
+            sender = MulticastSender(interface=args.interface, rate=int(args.rate * 1024 * 1024))
+            results = sender.send_file(args.file, expected_receivers=args.receivers)
+            bad = [r for r, status in results.items() if status != 'ok']
+            if bad:
+                raise Exception(f"Multicast incomplete for: {', '.join(bad)}")
         elif args.command == 'send':
-            client = TransferClient(host=args.host, port=args.port)
-            client.send_file(args.file)
+            transport = 'udp' if args.udp else 'auto'
+            limiter = _rate_limiter(args)
+            if not args.host:
+                parser.error('send: --host is required (unless --multicast is used)')
+            chunk_size = args.chunk_size * 1024 if args.chunk_size else None
+            relay = args.relay and len(args.host) > 1
+            if relay and (args.integrity or args.no_tree_hash or args.multiplex):
+                parser.error('send: --integrity, --no-tree-hash and --multiplex do not apply to --relay '
+                             '(files go down the chain one at a time, each verified with a plain SHA256)')
+            if not relay and len(args.host) > 1 and (args.integrity or args.multiplex or args.no_zero_copy):
+                parser.error('send: --integrity, --multiplex and --no-zero-copy do not apply to several --host '
+                             '(fan-out sends shared in-memory blocks verified with a plain SHA256)')
+            if relay:
+                host, port = parse_destination(args.host[0], args.port)
+                hops = ["%s:%d" % parse_destination(h, args.port) for h in args.host[1:]]
+                client = TransferClient(host=host, port=port, transport=transport, bulk=args.bulk,
+                                        zero_copy=not args.no_zero_copy, chunk_size=chunk_size,
+                                        stall_timeout=args.stall_timeout,
+                                        min_rate=int(args.min_rate * 1024), rate_limiter=limiter)
+                client.send_relay(args.file, hops)
+            elif len(args.host) > 1:
+                sender = FanoutSender(args.host, default_port=args.port, transport=transport, bulk=args.bulk,
+                                      block_size=chunk_size, rate_limiter=limiter,
+                                      stall_timeout=args.stall_timeout, min_rate=int(args.min_rate * 1024))
+                errors = sender.send_file(args.file)
+                failed = [f"{h}:{p}" for (h, p), e in errors.items() if e is not None]
+                if failed:
+                    raise Exception(f"Fan-out failed for: {', '.join(failed)}")
+            else:
+                host, port = parse_destination(args.host[0], args.port)
+                client = TransferClient(host=host, port=port, transport=transport, bulk=args.bulk,
+                                        zero_copy=not args.no_zero_copy, tree_hash=not args.no_tree_hash,
+                                        integrity=args.integrity,
+                                        chunk_size=chunk_size,
+                                        stall_timeout=args.stall_timeout, min_rate=int(args.min_rate * 1024),
+                                        rate_limiter=limiter, multiplex=args.multiplex)
+                client.send_file(args.file)
     except KeyboardInterrupt:
         print("\nOperation cancelled by user")
         sys.exit(0)
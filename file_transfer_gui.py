@@ -18,6 +18,8 @@ import zipfile
 from pathlib import Path
 from transfer_server import TransferServer
 from transfer_client import TransferClient
+from fanout_client import FanoutSender
+from ratelimit import RateLimiter, parse_rate
 from service_discovery import ServiceDiscovery
 
 # Application version
@@ -188,6 +190,9 @@ class FileTransferGUI:
         self._pause_event = threading.Event()
         self._pause_event.set()  # Initially not paused
         self._cancel_transfer = False  # Flag to cancel ongoing transfer
+        # Speed limits for sending and receiving; changes apply to running transfers
+        self._send_limiter = RateLimiter()
+        self._receive_limiter = RateLimiter()
 
         # Transfer history (for display in Advanced menu)
         try:
@@ -1477,6 +1482,11 @@ class FileTransferGUI:
         ttk.Button(
             refresh_frame, text="Refresh Discovery", command=self._refresh_discovery
         ).pack(side=tk.LEFT)
+        self.fanout_btn = ttk.Button(
+            refresh_frame, text="📡 Send to Selected", command=self._send_to_selected_peers
+        )
+        self.fanout_btn.pack(side=tk.LEFT, padx=5)
+        self._create_tooltip(self.fanout_btn, "Send the file list to every selected machine at once (Ctrl/Shift+click to select several)")
 
         manual_frame = ttk.LabelFrame(left_frame, text="Manual Connection")
         manual_frame.pack(fill="x", padx=5, pady=5)
@@ -1613,6 +1623,16 @@ class FileTransferGUI:
         )
         self.resumable_status_label.pack(side=tk.LEFT, padx=(10, 0))
 
+        limit_row = ttk.Frame(right_frame)
+        limit_row.pack(fill="x", padx=5, pady=(0, 5))
+        ttk.Label(limit_row, text="Speed limit (KB/s, 0 = none):").pack(side=tk.LEFT)
+        self.send_limit_var = tk.StringVar(value="0")
+        send_limit_entry = ttk.Entry(limit_row, textvariable=self.send_limit_var, width=10)
+        send_limit_entry.pack(side=tk.LEFT, padx=5)
+        self._create_tooltip(send_limit_entry, "Limit the upload rate of all sends together (e.g. 500 or 10M); "
+                                               "changes apply to running transfers")
+        self.send_limit_var.trace_add("write", lambda *_: self._apply_rate_limit("send"))
+
         progress_frame = ttk.Frame(right_frame)
         progress_frame.pack(fill="x", padx=5, pady=5)
         self.send_progress = ttk.Progressbar(progress_frame, mode="determinate")
@@ -1709,6 +1729,14 @@ class FileTransferGUI:
             side=tk.RIGHT, padx=(5, 0)
         )
 
+        ttk.Label(left_frame, text="Speed Limit (KB/s, 0 = none):").pack(anchor=tk.W, padx=5, pady=2)
+        self.receive_limit_var = tk.StringVar(value="0")
+        receive_limit_entry = ttk.Entry(left_frame, textvariable=self.receive_limit_var)
+        receive_limit_entry.pack(fill="x", padx=5, pady=2)
+        self._create_tooltip(receive_limit_entry, "Limit the download rate of all received transfers together "
+                                                  "(e.g. 500 or 10M); changes apply to running transfers")
+        self.receive_limit_var.trace_add("write", lambda *_: self._apply_rate_limit("recv"))
+
         btn_frame = ttk.Frame(left_frame)
         btn_frame.pack(fill="x", padx=5, pady=10)
 
@@ -2723,6 +2751,14 @@ project on GitHub or contributing to its development!
         peers = self.discovery.get_peers()
         now = time.time()
 
+        # Remember the current selection so periodic refreshes do not drop it
+        try:
+            selected_names = {
+                self._item_to_name.get(iid) for iid in self.machines_tree.selection()
+            }
+        except Exception:
+            selected_names = set()
+
         # Rebuild treeview items
         for iid in self.machines_tree.get_children():
             self.machines_tree.delete(iid)
@@ -2800,6 +2836,11 @@ project on GitHub or contributing to its development!
 
             self._machines_order.append(name)
             self._item_to_name[item] = name
+            if name in selected_names:
+                try:
+                    self.machines_tree.selection_add(item)
+                except Exception:
+                    pass
 
         # Log if we're discovering anything
         if (
@@ -3039,6 +3080,16 @@ project on GitHub or contributing to its development!
         except Exception as e:
             self._log_send(f"Pause toggle error: {e}")
 
+    def _apply_rate_limit(self, log_type: str):
+        """Apply the speed limit typed in the send or receive tab"""
+        var = self.send_limit_var if log_type == "send" else self.receive_limit_var
+        limiter = self._send_limiter if log_type == "send" else self._receive_limiter
+        try:
+            rate = parse_rate(var.get() or "0")
+        except ValueError:
+            return  # still typing
+        limiter.set_limits(global_rate=rate)
+
     def _cancel_transfer_fn(self):
         """Cancel ongoing file transfer"""
         try:
@@ -3162,7 +3213,8 @@ project on GitHub or contributing to its development!
         total_size_sent = 0
         transferred_files = []  # Track files for history
         try:
-            client = TransferClient(host, port, pause_event=self._pause_event, cancel_flag_fn=lambda: self._cancel_transfer)
+            client = TransferClient(host, port, pause_event=self._pause_event, cancel_flag_fn=lambda: self._cancel_transfer,
+                                    rate_limiter=self._send_limiter)
             self._log_send(f"Connecting to {host}:{port}...")
 
             # Progress callback updates UI
@@ -3446,6 +3498,139 @@ project on GitHub or contributing to its development!
             except Exception:
                 pass
 
+    def _send_to_selected_peers(self):
+        """Send the selected files to every machine selected in the discovery list"""
+        names = [
+            self._item_to_name.get(iid)
+            for iid in self.machines_tree.selection()
+            if self._item_to_name.get(iid)
+        ]
+        if not names or not self.discovery:
+            messagebox.showerror(
+                "Error", "Please select one or more discovered machines"
+            )
+            return
+
+        if not self.selected_files:
+            messagebox.showerror(
+                "Error", "Please select at least one file or folder to send"
+            )
+            return
+
+        for filepath in self.selected_files:
+            if not os.path.exists(filepath):
+                messagebox.showerror("Error", f"Path not found: {filepath}")
+                return
+
+        peers = self.discovery.get_peers()
+        destinations = []
+        for name in names:
+            info = peers.get(name)
+            if info:
+                destinations.append((info["ip"], int(info["port"])))
+        if not destinations:
+            messagebox.showerror("Error", "Selected machines are no longer available")
+            return
+
+        self.send_btn.config(state="disabled")
+        self.fanout_btn.config(state="disabled")
+        self.pause_btn.config(state="normal")
+        self.cancel_btn.config(state="normal")
+        self.send_progress["value"] = 0
+        self._log_send(f"Starting fan-out to {len(destinations)} machine(s): {', '.join(names)}")
+
+        self.transfer_paused = False
+        self._cancel_transfer = False
+        self._pause_event.set()
+        self.pause_btn.config(text="⏸ PAUSE")
+
+        thread = threading.Thread(
+            target=self._fanout_send_thread,
+            args=(destinations, list(self.selected_files)),
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _fanout_send_thread(self, destinations, filepaths):
+        """Thread function for fan-out sends; progress shows the slowest peer"""
+        success = False
+        send_start_time = time.time()
+        peer_progress = {}
+        try:
+            sender = FanoutSender(
+                destinations,
+                pause_event=self._pause_event,
+                cancel_flag_fn=lambda: self._cancel_transfer,
+                rate_limiter=self._send_limiter,
+            )
+
+            def progress_callback(dest, sent, total, speed=None, eta=None):
+                peer_progress[dest] = (sent / total) * 100 if total else 100
+                try:
+                    progress = min(peer_progress.values())
+                except ValueError:
+                    progress = 0
+                self.root.after(0, lambda: self.send_progress.config(value=progress))
+                self.root.after(
+                    0, lambda: self.progress_percent_var.set(f"{int(progress)}%")
+                )
+                if speed is not None:
+                    speed_str = self._format_transfer_speed(speed)
+                    self.root.after(
+                        0, lambda: self.speed_var.set(f"Speed: {speed_str} (per peer)")
+                    )
+
+            errors = sender.send_files(filepaths, progress_callback=progress_callback)
+            for (host, port), err in errors.items():
+                if err is None:
+                    self.root.after(
+                        0, lambda h=host, p=port: self._log_send(f"[Fan-out] {h}:{p} OK")
+                    )
+                else:
+                    self.root.after(
+                        0,
+                        lambda h=host, p=port, e=err: self._log_send(
+                            f"[Fan-out] {h}:{p} ERROR: {e}"
+                        ),
+                    )
+            ok_count = sum(1 for e in errors.values() if e is None)
+            success = ok_count == len(errors)
+            self.root.after(
+                0,
+                lambda: self._log_send(
+                    f"Fan-out complete: {ok_count}/{len(errors)} machine(s) succeeded"
+                ),
+            )
+            if ok_count:
+                try:
+                    total_size = 0
+                    for filepath in filepaths:
+                        path = Path(filepath)
+                        if path.is_dir():
+                            total_size += sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+                        else:
+                            total_size += path.stat().st_size
+                    display = Path(filepaths[0]).name if len(filepaths) == 1 else f"{len(filepaths)} items"
+                    self._add_transfer_history(
+                        'send', f"{display} -> {ok_count} peers", total_size, time.time() - send_start_time
+                    )
+                except Exception as e:
+                    self._log_send(f"Warning: Failed to record transfer history: {e}")
+        except Exception as e:
+            error_msg = str(e)
+            if "cancelled" in error_msg.lower():
+                self.root.after(0, lambda: self._log_send("[Transfer] Cancelled by user"))
+            else:
+                self.root.after(0, lambda: self._log_send(f"Error: {error_msg}"))
+                self.root.after(0, lambda: messagebox.showerror("Error", error_msg))
+        finally:
+            self.root.after(0, lambda: self.send_btn.config(state="normal"))
+            self.root.after(0, lambda: self.fanout_btn.config(state="normal"))
+            self.root.after(0, lambda: self.pause_btn.config(state="disabled"))
+            self.root.after(0, lambda: self.cancel_btn.config(state="disabled"))
+            if success:
+                self.root.after(0, lambda: self.send_progress.config(value=100))
+
     # -------------------------
     # Server (receiver) logic
     # -------------------------
@@ -3595,7 +3780,8 @@ project on GitHub or contributing to its development!
                 self._log_receive(f"Initializing TransferServer on port {port}, output_dir={output_dir}")
             except Exception:
                 pass
-            server = TransferServer(port=port, output_dir=output_dir, progress_callback=_server_progress)
+            server = TransferServer(port=port, output_dir=output_dir, progress_callback=_server_progress,
+                                    rate_limiter=self._receive_limiter)
             # Keep a reference to the running server so the GUI can update its
             # output directory while it's running (user may change Save folder).
             try:
@@ -4091,6 +4277,16 @@ project on GitHub or contributing to its development!
             except Exception:
                 pass
 
+            # Speed limits
+            try:
+                for key, var in (("send_rate_limit", self.send_limit_var),
+                                 ("receive_rate_limit", self.receive_limit_var)):
+                    value = data.get(key)
+                    if isinstance(value, str) and value:
+                        var.set(value)
+            except Exception:
+                pass
+
             # Notification preference (beep)
             try:
                 nb = data.get("notify_on_receive")
@@ -4151,6 +4347,12 @@ project on GitHub or contributing to its development!
             data["compress_before_send"] = bool(getattr(self, "compress_before_send", False))
         except Exception:
             data["compress_before_send"] = False
+        # Save speed limits
+        try:
+            data["send_rate_limit"] = self.send_limit_var.get().strip() or "0"
+            data["receive_rate_limit"] = self.receive_limit_var.get().strip() or "0"
+        except Exception:
+            pass
         # Save notification preference
         try:
             data["notify_on_receive"] = bool(getattr(self, "notify_on_receive", True))
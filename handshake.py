@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Handshake Module
+Optional HELLO / HELLO-ACK exchange at the start of a connection. The
+client sends the HELLO magic and its capabilities; the server answers
+with its own and then reads the usual protocol magic on the same
+connection. Both sides derive the same common feature set with common().
+Receivers that predate the handshake close the connection on the unknown
+magic, and the client falls back to the legacy protocols.
+
+Wire format: magic (4 bytes !I, client only), then length (4 bytes !I)
+and a UTF-8 JSON object:
+  version      protocol version (int)
+  max_chunk    largest chunk the peer reads or writes at once (bytes)
+  codecs       payload codecs, in order of preference
+  hashes       integrity algorithms, in order of preference
+  features     protocol features (see FEATURES)
+  max_streams  transfers the peer handles at the same time
+"""
+import json
+import struct
+
+
+HELLO_MAGIC = 0xFFFF0010
+PROTOCOL_VERSION = 1
+MAX_HELLO_SIZE = 64 * 1024
+CODECS = ('none',)  # no compression yet; listed so peers can add codecs later
+# Protocol feature -> magic it enables
+FEATURES = {
+    'resumable': 0xFFFF0003,
+    'relay': 0xFFFF0004,
+    'offload': 0xFFFF0005,
+    'sparse': 0xFFFF0006,
+    'tree': 0xFFFF0007,
+    'integrity': 0xFFFF0008,
+    'batch': 0xFFFF0009,
+    'mux': 0xFFFF0011,
+}
+
+
+def capabilities(features, hashes, max_chunk, max_streams=1, codecs=CODECS):
+    """Build a capabilities object for HELLO or HELLO-ACK"""
+    return {
+        'version': PROTOCOL_VERSION,
+        'max_chunk': int(max_chunk),
+        'codecs': list(codecs),
+        'hashes': list(hashes),
+        'features': [f for f in features if f in FEATURES],
+        'max_streams': int(max_streams),
+    }
+
+
+def common(local, remote):
+    """The feature set both peers support; lists keep ``local``'s preference order."""
+    def shared(key):
+        theirs = set(remote.get(key) or ())
+        return [item for item in local.get(key, ()) if item in theirs]
+
+    return {
+        'version': min(local['version'], int(remote.get('version', 1))),
+        'max_chunk': min(local['max_chunk'], int(remote.get('max_chunk') or local['max_chunk'])),
+        'codecs': shared('codecs'),
+        'hashes': shared('hashes'),
+        'features': shared('features'),
+        'max_streams': min(local['max_streams'], int(remote.get('max_streams') or 1)),
+    }
+
+
+def _encode(caps):
+    body = json.dumps(caps, separators=(',', ':')).encode('utf-8')
+    return struct.pack('!I', len(body)) + body
+
+
+def send_hello(sock, caps):
+    """Client side: HELLO magic and capabilities"""
+    sock.sendall(struct.pack('!I', HELLO_MAGIC) + _encode(caps))
+
+
+def send_hello_ack(sock, caps):
+    """Server side: capabilities in reply to a HELLO"""
+    sock.sendall(_encode(caps))
+
+
+def read_capabilities(recv_exact):
+    """Read one length-prefixed capabilities object with ``recv_exact(size)``.
+
+    Returns the dict, or None if the peer closed or sent garbage.
+    """
+    length_data = recv_exact(4)
+    if not length_data:
+        return None
+    length = struct.unpack('!I', length_data)[0]
+    if length > MAX_HELLO_SIZE:
+        return None
+    body = recv_exact(length)
+    if body is None:
+        return None
+    try:
+        caps = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return None
+    return caps if isinstance(caps, dict) and isinstance(caps.get('version'), int) else None
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Multiplexing Module
+Several files interleaved on one connection (magic 0xFFFF0011), in the
+manner of HTTP/2. Every frame names a stream (one file), streams and the
+connection have flow-control windows, and the sender interleaves the data
+of open streams by weight, so the small files of a batch finish while a
+big one is still on its way, without extra connections. Each file is
+verified and acknowledged on its own as soon as it is complete.
+
+Session (client -> server): magic, file count (4 bytes !I) and total size
+(8 bytes !Q); the server replies a status (4 bytes !I), 0 or a REJECT_*
+code, as for a batch (0xFFFF0009). Frames follow in both directions:
+type (1 byte), flags (1 byte), stream id (4 bytes !I, 0 is the
+connection), payload length (4 bytes !I), payload:
+
+  OPEN    c->s  file size (!Q) + file name (utf-8)
+  DATA    c->s  file data, at most the receiver's max_chunk bytes
+  END     c->s  SHA256 of the stream's data; no more DATA follows
+  WINDOW  s->c  window increment (!I) for the stream, or the connection
+  CANCEL  both  reason code (!I); the stream is dropped
+  ACK     s->c  b'OK' (verified and in place) or b'ER'
+  GOAWAY  c->s  no more streams; the receiver finishes and closes
+  PAUSE   c->s  the sender pauses (stream 0)
+  RESUME  c->s  the sender continues (stream 0)
+  PING    c->s  keepalive, sent every KEEPALIVE seconds while paused
+
+CANCEL on stream 0 cancels the whole session: the receiver drops every
+open stream with its .partial file and closes. On PAUSE the receiver
+closes the open files and parks the session: its socket waits in a
+ParkingLot with no thread of its own until the next frame arrives, so
+paused senders do not hold worker threads. A parked session that hears
+nothing for PARK_TIMEOUT seconds is dropped like a cancelled one.
+
+Each stream may have STREAM_WINDOW bytes in flight and all streams
+together CONNECTION_WINDOW; the receiver returns credit with WINDOW
+frames as it writes data out.
+"""
+import hashlib
+import selectors
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from transport import TransferStalled
+
+
+MUX_MAGIC = 0xFFFF0011
+FRAME = struct.Struct('!BBII')  # type, flags, stream id, payload length
+OPEN, DATA, END, WINDOW, CANCEL, ACK, GOAWAY, PAUSE, RESUME, PING = range(1, 11)
+STREAM_WINDOW = 8 * 1024 * 1024
+CONNECTION_WINDOW = 32 * 1024 * 1024
+MAX_STREAMS = 16  # streams a sender keeps open at once
+MAX_CONTROL = 64 * 1024  # largest payload of a frame other than DATA
+DEFAULT_WEIGHT = 16  # 1-256; a stream gets bandwidth in proportion to its weight
+KEEPALIVE = 15  # seconds between PINGs of a paused sender
+PARK_TIMEOUT = 4 * KEEPALIVE  # a parked session silent for this long is dropped
+PARKED = object()  # returned by a receiver that parked its session
+
+
+def frame(kind, stream, length=0, flags=0):
+    """The header of a frame with a ``length``-byte payload"""
+    return FRAME.pack(kind, flags, stream, length)
+
+
+def recv_exact(sock, size):
+    """``size`` bytes from ``sock`` as a bytearray, or None if it closed"""
+    buf = bytearray(size)
+    with memoryview(buf) as view:
+        n = 0
+        while n < size:
+            got = sock.recv_into(view[n:])
+            if not got:
+                return None
+            n += got
+    return buf
+
+
+def read_frame(recv, max_data):
+    """Read one frame with ``recv(size)``; (type, flags, stream, payload) or None if closed"""
+    header = recv(FRAME.size)
+    if not header:
+        return None
+    kind, flags, stream, length = FRAME.unpack(header)
+    if length > (max_data if kind == DATA else MAX_CONTROL):
+        raise ValueError(f"Frame of {length} bytes is too large")
+    payload = recv(length) if length else b''
+    if payload is None:
+        return None
+    return kind, flags, stream, payload
+
+
+class Credit:
+    """Receiver side of a window: credit to return as data is consumed"""
+
+    def __init__(self, window):
+        self.window = window
+        self._consumed = 0
+
+    def consume(self, nbytes):
+        """Account for ``nbytes``; returns the WINDOW increment to send now (or 0)"""
+        self._consumed += nbytes
+        if self._consumed < self.window // 2:
+            return 0
+        increment, self._consumed = self._consumed, 0
+        return increment
+
+
+class ReceiveSession:
+    """Receiver state of a session, kept while it is parked"""
+
+    def __init__(self, file_count):
+        self.file_count = file_count
+        self.streams = {}  # stream id -> state of an open stream
+        self.unacked = []  # (stream id, durability ticket) of files in place but not yet acknowledged
+        self.received_files = []
+        self.credit = Credit(CONNECTION_WINDOW)
+        self.paused = False
+
+
+class ParkingLot:
+    """Holds parked sessions: one thread watches all their sockets.
+
+    park(sock, wake, expire) calls ``wake()`` once ``sock`` has data, or
+    ``expire()`` if it stays silent for PARK_TIMEOUT seconds; both run on
+    the watcher thread and should hand the session to a worker.
+    """
+
+    def __init__(self, timeout=PARK_TIMEOUT):
+        self.timeout = timeout
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._parked = {}  # sock -> (deadline, wake, expire)
+        self._waker, self._wakee = socket.socketpair()
+        self._wakee.setblocking(False)
+        self._selector.register(self._wakee, selectors.EVENT_READ)
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    @staticmethod
+    def supports(sock):
+        """Only kernel sockets can be watched (not the UDP or in-memory transports)"""
+        return isinstance(sock, socket.socket)
+
+    def park(self, sock, wake, expire):
+        with self._lock:
+            self._parked[sock] = (time.monotonic() + self.timeout, wake, expire)
+            self._selector.register(sock, selectors.EVENT_READ)
+        self._waker.send(b'\0')
+
+    def _take(self, sock):
+        with self._lock:
+            entry = self._parked.pop(sock, None)
+            if entry is not None:
+                self._selector.unregister(sock)
+        return entry
+
+    def _watch(self):
+        while True:
+            with self._lock:
+                deadlines = [deadline for deadline, _, _ in self._parked.values()]
+            timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wakee:
+                    try:
+                        self._wakee.recv(4096)
+                    except OSError:
+                        pass
+                    continue
+                entry = self._take(key.fileobj)
+                if entry is not None:
+                    self._call(entry[1])
+            now = time.monotonic()
+            with self._lock:
+                expired = [sock for sock, (deadline, _, _) in self._parked.items() if deadline <= now]
+            for sock in expired:
+                entry = self._take(sock)
+                if entry is not None:
+                    self._call(entry[2])
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            print(f"Error handing over a parked session: {e}")
+
+
+class _Stream:
+    __slots__ = ('id', 'path', 'name', 'size', 'weight', 'file', 'sent', 'window', 'sha', 'status', 'ended')
+
+    def __init__(self, stream_id, path, name, size, weight):
+        self.id = stream_id
+        self.path = path
+        self.name = name
+        self.size = size
+        self.weight = max(1, min(256, weight))
+        self.file = None
+        self.sent = 0
+        self.window = STREAM_WINDOW
+        self.sha = hashlib.sha256()
+        self.status = None  # 'OK', 'ER' or a CANCEL code once the receiver answered
+        self.ended = False  # END sent
+
+
+class MuxSender:
+    """Sender side: interleaves the files of one session on ``sock``.
+
+    ``items`` are (path, name, size, weight) in the order streams are
+    opened; at most MAX_STREAMS are open at once. The next DATA frame goes
+    to the open stream with the least data sent for its weight (weighted
+    fair queuing) among those with window left. ``write(header, payload)``
+    sends a frame and ``sent(stream, n)`` is called after each DATA frame (pause,
+    cancel and progress live there). The last DATA frame of a stream is
+    followed by its END before sent() is called, so a pause or cancel
+    there never leaves a complete file unfinished. A background thread
+    reads WINDOW, ACK and CANCEL frames.
+    """
+
+    def __init__(self, sock, items, frame_size, write, sent=None, stall_timeout=None, ack_timeout=None):
+        self.sock = sock
+        self.frame_size = frame_size
+        self.write = write
+        self.sent = sent
+        self.stall_timeout = stall_timeout
+        self.ack_timeout = ack_timeout
+        self._pending = deque(_Stream(i, *item) for i, item in enumerate(items, 1))
+        self._streams = {s.id: s for s in self._pending}
+        self._window = CONNECTION_WINDOW
+        self._cond = threading.Condition()
+        self._error = None
+        self._closed = False
+
+    def run(self):
+        """Send every file; returns {name: status} once the receiver answered for all"""
+        reader = threading.Thread(target=self._read, daemon=True)
+        reader.start()
+        opened = []
+        try:
+            while self._pending or opened:
+                while self._pending and len(opened) < MAX_STREAMS:
+                    opened.append(self._open(self._pending.popleft()))
+                for stream in [s for s in opened if s.sent == s.size or s.status is not None]:
+                    self._end(stream)
+                    opened.remove(stream)
+                if opened:
+                    self._send_next(opened)
+            self._wait_answers()
+            self.write(frame(GOAWAY, 0), b'')
+            return self.answers()
+        finally:
+            self._closed = True
+            for stream in opened:
+                stream.file.close()
+
+    def pause(self, resumed, cancelled=None):
+        """Tell the receiver the session is paused until ``resumed(timeout)`` returns True.
+
+        PINGs keep the connection alive meanwhile. Returns False, without
+        resuming, if ``cancelled()`` turns True first; call cancel() then.
+        """
+        self.write(frame(PAUSE, 0), b'')
+        pinged = time.monotonic()
+        while not resumed(1):
+            if cancelled and cancelled():
+                return False
+            if time.monotonic() - pinged >= KEEPALIVE:
+                self.write(frame(PING, 0), b'')
+                pinged = time.monotonic()
+        if cancelled and cancelled():
+            return False
+        self.write(frame(RESUME, 0), b'')
+        return True
+
+    def cancel(self):
+        """Cancel the whole session; the receiver discards what it has of unfinished files"""
+        try:
+            self.write(frame(CANCEL, 0, 4), struct.pack('!I', 0))
+        except OSError:
+            pass
+
+    def answers(self):
+        """{name: status} of the streams the receiver answered so far"""
+        with self._cond:
+            return {s.name: s.status for s in self._streams.values() if s.status is not None}
+
+    def _open(self, stream):
+        stream.file = open(stream.path, 'rb')
+        name = stream.name.encode('utf-8')
+        self.write(frame(OPEN, stream.id, 8 + len(name)), struct.pack('!Q', stream.size) + name)
+        return stream
+
+    def _end(self, stream):
+        stream.file.close()
+        if stream.status is None and not stream.ended:
+            self.write(frame(END, stream.id, 32), stream.sha.digest())
+            stream.ended = True
+
+    def _send_next(self, opened):
+        with self._cond:
+            waited = time.monotonic()
+            while True:
+                if self._error is not None:
+                    raise self._error
+                ready = [s for s in opened if s.window > 0 and s.status is None] if self._window > 0 else []
+                if ready or any(s.status is not None for s in opened):
+                    break
+                if self.stall_timeout and time.monotonic() - waited >= self.stall_timeout:
+                    raise TransferStalled("the receiver stopped opening its windows")
+                self._cond.wait(1)
+            if not ready:
+                return  # a stream was cancelled; the caller drops it
+            stream = min(ready, key=lambda s: s.sent / s.weight)
+            n = min(self.frame_size, stream.size - stream.sent, stream.window, self._window)
+            stream.window -= n
+            self._window -= n
+        data = stream.file.read(n)
+        if len(data) < n:
+            # The file shrank: drop this stream, keep the others going
+            print(f"\n{stream.name} changed while it was being sent; cancelling it")
+            self.write(frame(CANCEL, stream.id, 4), struct.pack('!I', 0))
+            with self._cond:
+                stream.status = 0
+            return
+        stream.sha.update(data)
+        self.write(frame(DATA, stream.id, n), data)
+        stream.sent += n
+        if stream.sent == stream.size:
+            self._end(stream)
+        if self.sent:
+            self.sent(stream, n)
+
+    def _wait_answers(self):
+        deadline = time.monotonic() + self.ack_timeout if self.ack_timeout else None
+        with self._cond:
+            while any(s.status is None for s in self._streams.values()):
+                if self._error is not None:
+                    raise self._error
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TransferStalled("no answer from the receiver")
+                self._cond.wait(1)
+
+    def _recv(self, size):
+        """recv_exact() that rides out socket timeouts; the sending side judges stalls"""
+        buf = bytearray(size)
+        with memoryview(buf) as view:
+            n = 0
+            while n < size:
+                try:
+                    got = self.sock.recv_into(view[n:])
+                except socket.timeout:
+                    if self._closed:
+                        return None
+                    continue
+                if not got:
+                    return None
+                n += got
+        return buf
+
+    def _read(self):
+        try:
+            while not self._closed:
+                received = read_frame(self._recv, 0)
+                if received is None:
+                    raise ConnectionError("The receiver closed the connection")
+                kind, _, stream_id, payload = received
+                with self._cond:
+                    stream = self._streams.get(stream_id)
+                    if kind == WINDOW:
+                        increment = struct.unpack('!I', payload)[0]
+                        if stream_id == 0:
+                            self._window += increment
+                        elif stream is not None:
+                            stream.window += increment
+                    elif kind == ACK and stream is not None:
+                        stream.status = bytes(payload).decode('ascii', 'replace')
+                    elif kind == CANCEL and stream is not None:
+                        stream.status = struct.unpack('!I', payload)[0]
+                    self._cond.notify_all()
+        except Exception as e:
+            with self._cond:
+                if not self._closed:
+                    self._error = e
+                self._cond.notify_all()
+
+
+if __name__ == '__main__':
+    # Regression check: pause and resume at a stream boundary
+    import os
+    import tempfile
+    from pathlib import Path
+    from transfer_server import TransferServer
+    from transfer_client import TransferClient
+
+    workdir = Path(tempfile.mkdtemp(prefix='netlink_mux_'))
+    source = workdir / 'src'
+    source.mkdir()
+    for name, size in (('a.bin', 100000), ('b.bin', 3 * 1024 * 1024)):
+        (source / name).write_bytes(os.urandom(size))
+    server = TransferServer(port=5097, output_dir=workdir / 'received', copy_offload=False, transports=['tcp'])
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.3)
+
+    # 1. Receiver: a stream whose data is complete when PAUSE arrives still checks out at END
+    data = (source / 'a.bin').read_bytes()
+    sock = socket.create_connection(('127.0.0.1', 5097))
+    sock.sendall(struct.pack('!IIQ', MUX_MAGIC, 1, len(data)))
+    assert recv_exact(sock, 4) == b'\0\0\0\0'
+    sock.sendall(frame(OPEN, 1, 13) + struct.pack('!Q', len(data)) + b'raw.a' + frame(DATA, 1, len(data)) + data
+                 + frame(PAUSE, 0) + frame(RESUME, 0) + frame(END, 1, 32) + hashlib.sha256(data).digest())
+    while True:
+        kind, _, stream, payload = read_frame(lambda size: recv_exact(sock, size), 0)
+        if kind == ACK:
+            break
+    sock.sendall(frame(GOAWAY, 0))
+    sock.close()
+    print(f"Paused after the last DATA frame: {bytes(payload).decode()}")
+
+    # 2. Sender: pause in the first progress callback, right after a stream's last DATA frame
+    pause = threading.Event()
+    pause.set()
+
+    def progress(*args):
+        if not hasattr(progress, 'done'):
+            progress.done = True
+            pause.clear()
+            threading.Timer(1, pause.set).start()
+
+    client = TransferClient('127.0.0.1', 5097, transport='tcp', multiplex=True, pause_event=pause)
+    client.send_directory(source, progress)
+    for name in ('a.bin', 'b.bin'):
+        same = (workdir / 'received' / 'src' / name).read_bytes() == (source / name).read_bytes()
+        print(f"{name}: {'OK' if same else 'FAILED'}")
+    print(f"Files kept in {workdir}")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Rate Limit Module
+Bandwidth limits at three scopes: all transfers together (global), all
+transfers with one peer, and each transfer. A RateLimiter gives every
+running transfer a Throttle and splits the limits between them max-min
+fairly: a transfer never gets less than an equal share of its peer's and
+the global limit, and what a transfer cannot use under its own limit goes
+to the others. A quick job started next to a huge one therefore gets its
+share at once. Limits can be changed while transfers run.
+
+Each Throttle paces its transfer with a token bucket. Writes stay large:
+the bucket may go into debt by one write and the sender sleeps it off,
+so a limit spaces out full-size sends instead of cutting them up. One
+write carries at most SEND_TIME seconds of data (at least MIN_SEND), so
+slow limits still react quickly to pause, cancel and rate changes.
+
+Rates are in bytes per second; 0 means unlimited.
+"""
+import threading
+import time
+
+
+MIN_SEND = 64 * 1024
+SEND_TIME = 0.25
+UNITS = {'': 1024, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}  # plain numbers are KB/s
+SCOPES = ('global', 'peer', 'transfer')
+
+
+def parse_rate(text):
+    """'500' or '500K' -> KB/s, '10M' -> MB/s, '1G' -> GB/s, '0' or 'off' -> 0 (bytes/s)"""
+    text = str(text).strip().lower()
+    if text in ('off', 'none', 'unlimited'):
+        return 0
+    text = text[:-2] if text.endswith('/s') else text
+    text = text[:-1] if text.endswith('b') else text
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    try:
+        value = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise ValueError(f"Invalid rate: {text!r} (e.g. 500, 500K, 10M or off)")
+    if value < 0:
+        raise ValueError(f"Invalid rate: {text!r}")
+    return int(value * UNITS[unit])
+
+
+def format_rate(rate):
+    if not rate:
+        return 'unlimited'
+    for unit, size in (('GB/s', 1024 ** 3), ('MB/s', 1024 ** 2)):
+        if rate >= size:
+            return f"{rate / size:.1f} {unit}"
+    return f"{rate / 1024:.0f} KB/s"
+
+
+def _fair_shares(capacity, caps):
+    """Max-min fair split of ``capacity`` between demands ``caps`` (0: unlimited).
+
+    Returns the shares in the order of ``caps``; 0 is unlimited.
+    """
+    shares = [0] * len(caps)
+    order = sorted(range(len(caps)), key=lambda i: caps[i] or float('inf'))
+    left = capacity
+    for n, i in enumerate(order):
+        if not capacity:
+            shares[i] = caps[i]
+            continue
+        share = left / (len(order) - n)
+        shares[i] = min(caps[i], share) if caps[i] else share
+        left -= shares[i]
+    return shares
+
+
+class TokenBucket:
+    """``rate`` bytes/s with bursts of up to one write; take() may go into debt."""
+
+    def __init__(self, rate=0):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self._rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._rate:
+            burst = max(MIN_SEND, self._rate * SEND_TIME)
+            self._tokens = min(burst, self._tokens + (now - self._stamp) * self._rate)
+        else:
+            self._tokens = 0.0
+        self._stamp = now
+
+    def take(self, nbytes):
+        """Take ``nbytes``; returns the seconds to wait before the next write"""
+        with self._lock:
+            self._refill()
+            if not self._rate:
+                return 0
+            self._tokens -= nbytes
+            return -self._tokens / self._rate if self._tokens < 0 else 0
+
+
+class Throttle:
+    """Pacing for one transfer; its rate is set by the RateLimiter.
+
+    ``limit`` caps this transfer below the limiter's per-transfer limit
+    (0: no extra cap). Use it as a context manager, or close() it, so its
+    share goes back to the other transfers.
+    """
+
+    def __init__(self, limiter, peer, limit=0):
+        self.limiter = limiter
+        self.peer = peer
+        self.limit = limit
+        self._bucket = TokenBucket()
+
+    @property
+    def rate(self):
+        return self._bucket.rate
+
+    def max_send(self, size):
+        """How much of ``size`` bytes to send (or read) in the next call"""
+        rate = self._bucket.rate
+        if not rate:
+            return size
+        return min(size, max(MIN_SEND, int(rate * SEND_TIME)))
+
+    def pieces(self, data):
+        """Split ``data`` into writes of at most max_send() bytes"""
+        if self.max_send(len(data)) == len(data):
+            yield data
+            return
+        view = memoryview(data)
+        while view:
+            n = self.max_send(len(view))
+            yield view[:n]
+            view = view[n:]
+
+    def pace(self, nbytes):
+        """Account for ``nbytes`` just sent or received; sleeps while over the limit"""
+        delay = self._bucket.take(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self.limiter._rebalance()
+
+    def close(self):
+        self.limiter._remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RateLimiter:
+    """Global, per-peer and per-transfer limits shared by all running transfers.
+
+    ``peer_rate`` and ``transfer_rate`` apply to every peer / transfer;
+    set_peer_limit() overrides the limit of one peer.
+    """
+
+    def __init__(self, global_rate=0, peer_rate=0, transfer_rate=0):
+        self._lock = threading.Lock()
+        self.global_rate = global_rate
+        self.peer_rate = peer_rate
+        self.transfer_rate = transfer_rate
+        self._peer_limits = {}
+        self._throttles = []
+
+    def transfer(self, peer, limit=0):
+        """Register a transfer with ``peer``; returns its Throttle"""
+        throttle = Throttle(self, peer, limit)
+        with self._lock:
+            self._throttles.append(throttle)
+        self._rebalance()
+        return throttle
+
+    def set_limits(self, global_rate=None, peer_rate=None, transfer_rate=None):
+        """Change limits while transfers run; None keeps a limit as it is"""
+        with self._lock:
+            if global_rate is not None:
+                self.global_rate = global_rate
+            if peer_rate is not None:
+                self.peer_rate = peer_rate
+            if transfer_rate is not None:
+                self.transfer_rate = transfer_rate
+        self._rebalance()
+
+    def set_peer_limit(self, peer, rate):
+        """Limit transfers with ``peer`` to ``rate``; None goes back to peer_rate"""
+        with self._lock:
+            if rate is None:
+                self._peer_limits.pop(peer, None)
+            else:
+                self._peer_limits[peer] = rate
+        self._rebalance()
+
+    def command(self, line):
+        """Apply a text command: '<global|peer|transfer> RATE' or 'peer HOST RATE'.
+
+        Returns a description of the new limits; raises ValueError.
+        """
+        words = line.split()
+        if not words or words[0] not in SCOPES or len(words) not in (2, 3) \
+                or (len(words) == 3 and words[0] != 'peer'):
+            raise ValueError("usage: global RATE | peer [HOST] RATE | transfer RATE "
+                             "(RATE in KB/s, or with K/M/G, or off)")
+        rate = parse_rate(words[-1])
+        if len(words) == 3:
+            self.set_peer_limit(words[1], rate)
+        else:
+            self.set_limits(**{f'{words[0]}_rate': rate})
+        return self.describe()
+
+    def describe(self):
+        text = (f"Rate limits: global {format_rate(self.global_rate)}, per peer "
+                f"{format_rate(self.peer_rate)}, per transfer {format_rate(self.transfer_rate)}")
+        for peer, rate in sorted(self._peer_limits.items()):
+            text += f", {peer} {format_rate(rate)}"
+        return text
+
+    def _remove(self, throttle):
+        with self._lock:
+            if throttle in self._throttles:
+                self._throttles.remove(throttle)
+        self._rebalance()
+
+    def _rebalance(self):
+        """Give every transfer its max-min fair share of the peer and global limits"""
+        with self._lock:
+            by_peer = {}
+            for throttle in self._throttles:
+                by_peer.setdefault(throttle.peer, []).append(throttle)
+            caps = {}
+            for peer, throttles in by_peer.items():
+                caps[peer] = [min(r for r in (t.limit, self.transfer_rate) if r) if t.limit or self.transfer_rate
+                              else 0 for t in throttles]
+            peers = list(by_peer)
+            # What a peer can use: its own limit, or the sum of its transfers' limits
+            demand = []
+            for peer in peers:
+                peer_limit = self._peer_limits.get(peer, self.peer_rate)
+                wanted = 0 if 0 in caps[peer] else sum(caps[peer])
+                demand.append(min(r for r in (peer_limit, wanted) if r) if peer_limit or wanted else 0)
+            rates = []
+            for peer, share in zip(peers, _fair_shares(self.global_rate, demand)):
+                for throttle, rate in zip(by_peer[peer], _fair_shares(share, caps[peer])):
+                    rates.append((throttle, rate))
+        for throttle, rate in rates:
+            throttle._bucket.set_rate(int(rate))
+
+
+if __name__ == '__main__':
+    # Two transfers to one peer and one to another under a 30 MB/s global limit
+    limiter = RateLimiter(global_rate=30 * 1024 ** 2, peer_rate=20 * 1024 ** 2)
+    throttles = [limiter.transfer('a'), limiter.transfer('a', limit=4 * 1024 ** 2), limiter.transfer('b')]
+    for t in throttles:
+        print(f"{t.peer}: {format_rate(t.rate)}")
+    done = [0] * len(throttles)
+
+    def run(i):
+        end = time.time() + 2
+        while time.time() < end:
+            n = throttles[i].max_send(1024 ** 2)
+            throttles[i].pace(n)
+            done[i] += n
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(throttles))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for t, n in zip(throttles, done):
+        print(f"{t.peer}: {format_rate(n / 2)} measured")
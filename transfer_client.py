@@ -10,17 +10,155 @@ from pathlib import Path
 import hashlib
 import time
 
+from transport import (open_connection, io_size, TRANSPORTS, ChunkTuner, DEFAULT_CHUNK, MAX_CHUNK, clamp_chunk,
+                       corked, send_frame, STALL_TIMEOUT, StallWatchdog, TransferStalled, ack_timeout)
+from diskio import data_extents, is_sparse, sparse_digest, ReadAhead, DropBehind, fadvise
+from hashing import LEAF_SIZE, tree_digest, new_hasher, INTEGRITY_ALGORITHMS
+from handshake import FEATURES, capabilities, common, read_capabilities, send_hello
+from ratelimit import RateLimiter
+from mux import MUX_MAGIC, MuxSender, DEFAULT_WEIGHT
+
+
+class TransferRejected(Exception):
+    """The receiver refused a transfer before any data was sent (not retried)."""
+    REASONS = {1: "not enough disk space on the receiver",
+               2: "this sender's quota on the receiver is used up",
+               3: "the receiver accepts none of the offered integrity algorithms"}
+
+    def __init__(self, code):
+        self.code = code
+        super().__init__(f"Transfer rejected: {self.REASONS.get(code, f'reason code {code}')}")
+
+
+class TransferBusy(ConnectionError):
+    """The receiver is still receiving this file on another connection (retried)."""
+
+
+class TransferIncomplete(ConnectionError):
+    """The receiver failed some files of a multiplexed session; a retry resends only those."""
+
+
+class TransferPaused(ConnectionError):
+    """A long pause released the connection; the transfer resumes on a new one when unpaused."""
+
 
 class TransferClient:
     BUFFER_SIZE = 4096
     MAX_RETRIES = 3  # Maximum retry attempts on connection error
     RETRY_DELAY = 2  # Seconds to wait between retries
+    REJECTED = 0xFFFFFFFFFFFFFFFF  # offset reply announcing a refusal (see TransferRejected)
+    TREE_HASH_MIN = 64 * 1024 * 1024  # files from this size are verified with a parallel tree hash
+    PAUSE_RELEASE = 5  # seconds a resumable transfer stays connected while paused
     
-    def __init__(self, host, port, pause_event=None, cancel_flag_fn=None):
+    def __init__(self, host, port, pause_event=None, cancel_flag_fn=None, transport='auto',
+                 copy_offload=True, sparse=True, bulk=False, zero_copy=True, tree_hash=True,
+                 integrity=None, chunk_size=None, stall_timeout=STALL_TIMEOUT, min_rate=0,
+                 rate_limiter=None, rate_limit=0, multiplex=False):
         self.host = host
         self.port = port
         self.pause_event = pause_event  # threading.Event to handle pause/resume
         self.cancel_flag_fn = cancel_flag_fn  # callable that returns True if transfer should be cancelled
+        if transport != 'auto' and transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        # 'auto' picks the in-process/Unix socket fast path for local receivers, else TCP;
+        # 'udp' uses the congestion-controlled UDP stream for long/lossy links
+        self.transport = transport
+        # Offer the receiver to copy the file itself when it can see the same filesystem
+        self.copy_offload = copy_offload
+        # Send only the data extents of files with holes (VM images, databases)
+        self.sparse = sparse
+        # Bulk mode: drop file data from the page cache behind the reader
+        self.bulk = bulk
+        # Send single files with sendfile() over TCP/Unix sockets
+        self.zero_copy = zero_copy
+        # Verify large files with a tree hash computed on every core (magic 0xFFFF0007)
+        self.tree_hash = tree_hash
+        # Integrity algorithms to offer in order of preference (see hashing.new_hasher);
+        # None keeps SHA256 / the tree hash without negotiating (magic 0xFFFF0008)
+        self.integrity = tuple(integrity) if integrity else None
+        # Payload chunk size: fixed, or None to start at DEFAULT_CHUNK and adapt
+        # to the link; announced to the receiver (capped at its max_chunk)
+        self.chunk_size = clamp_chunk(chunk_size) if chunk_size else None
+        # A connection that moves no data for stall_timeout seconds (None: never),
+        # or less than min_rate bytes/s (0: no floor), is dropped and the
+        # transfer reconnects at once; resumable transfers continue where they were
+        self.stall_timeout = stall_timeout
+        self.min_rate = min_rate
+        self._watchdog = None
+        self._progress = 0  # bytes of resumable payload sent during the current attempt
+        # Bandwidth limits (see ratelimit.py); share one RateLimiter between
+        # clients to limit them together. rate_limit caps each transfer (bytes/s)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.rate_limit = rate_limit
+        self._throttle = None
+        self._digests = {}  # (path, size, mtime, algorithm) -> digest, so resuming does not rehash
+        # Send multiple files interleaved on stream frames (magic 0xFFFF0011, see
+        # mux.py) when the receiver supports it; each file is acknowledged on its own
+        self.multiplex = multiplex
+        # Receiver capabilities common with ours (handshake.common): None until the
+        # first connection, False for receivers that predate the HELLO handshake
+        self._peer = None
+
+    def _connect(self):
+        """Open a connection to the receiver over the selected transport.
+
+        The first connection starts with the HELLO handshake; what it learns
+        about the receiver is kept for later connections.
+        """
+        client_socket = open_connection(self.host, self.port, self.transport)
+        if self._peer is None:
+            try:
+                self._peer = self._hello(client_socket)
+            except OSError:
+                client_socket.close()  # _peer stays None: the next connection says HELLO again
+                raise
+            if self._peer is False:
+                # Older receiver: it closed on the unknown magic
+                client_socket.close()
+                client_socket = open_connection(self.host, self.port, self.transport)
+        return client_socket
+
+    def _capabilities(self):
+        return capabilities(FEATURES, INTEGRITY_ALGORITHMS + ('tree-sha256',),
+                            max_chunk=self.chunk_size or MAX_CHUNK)
+
+    def _hello(self, client_socket):
+        """Exchange capabilities (magic 0xFFFF0010); the common set.
+
+        False if the receiver does not speak HELLO: it closed (or reset) the
+        connection before answering, or answered with something else. A
+        connection lost part way through the answer raises ConnectionError.
+        """
+        local = self._capabilities()
+        received = []
+
+        def recv(size):
+            data = self._recv_exact(client_socket, size)
+            received.append(data)
+            return data
+
+        try:
+            send_hello(client_socket, local)
+            peer = read_capabilities(recv)
+        except (ConnectionResetError, BrokenPipeError):
+            if received and received[0]:
+                raise
+            return False  # closed on the unknown magic
+        if peer is None:
+            if received and received[0] and None in received:
+                raise ConnectionError("Connection closed during HELLO")
+            return False
+        return common(local, peer)
+
+    def _peer_supports(self, feature):
+        """False if the receiver's capabilities lack ``feature`` (see handshake.FEATURES).
+
+        Receivers without the handshake are assumed to support it; the
+        protocols fall back when they do not.
+        """
+        if self._peer is None:
+            self._connect().close()  # only to learn the capabilities
+        return not self._peer or feature in self._peer['features']
         
     def send_file(self, filepath, progress_callback=None):
         """Send a file or directory to the server (backward compatible)"""
@@ -50,84 +188,478 @@ class TransferClient:
         filename = filepath.name
         
         print(f"Sending: {filename} ({self._format_size(filesize)})")
+
+        # Same storage on both ends: let the receiver copy the file locally.
+        # Only receivers that advertise it take the offer with its SHA256.
+        if self.copy_offload and self._peer_supports('offload') and self._peer and self._try_copy_offload(filepath, filename):
+            if progress_callback:
+                try:
+                    progress_callback(filesize, filesize, None, 0)
+                except TypeError:
+                    progress_callback(filesize, filesize)
+            print("File copied by the receiver from shared storage")
+            return 0, True
         
+        if self.sparse and is_sparse(filepath) and self._peer_supports('sparse'):
+            result = self._send_sparse_internal(filepath, filename, filesize, progress_callback)
+            if result is not None:
+                return result
+            print("Receiver does not support sparse transfers; sending the full file")
+
+        if self.integrity and self._peer_supports('integrity'):
+            # Only offer what the receiver announced it accepts
+            algorithms = [a for a in self.integrity if not self._peer or a in self._peer['hashes']]
+            if not algorithms:
+                raise TransferRejected(3)
+            digest = None
+            if self._peer:
+                # The receiver takes the first algorithm it accepts, so the digest
+                # can be computed before connecting instead of on an idle connection
+                algorithms = algorithms[:1]
+                digest = self._compute_digest(filepath, new_hasher(algorithms[0]))
+            result = self._send_resumable(filepath, filename, filesize, digest, progress_callback,
+                                          algorithms=algorithms)
+            if result is not None:
+                return result
+            print("Receiver cannot negotiate the integrity check; using the default")
+
+        if self.tree_hash and filesize >= self.TREE_HASH_MIN and self._peer_supports('tree'):
+            digest = self._cached_digest(filepath, 'tree-sha256',
+                                         lambda: tree_digest(filepath, filesize, LEAF_SIZE, bulk=self.bulk))
+            result = self._send_resumable(filepath, filename, filesize, digest, progress_callback, LEAF_SIZE)
+            if result is not None:
+                return result
+            print("Receiver does not support tree hashes; hashing the file with SHA256")
+
         # Compute SHA256 digest first (needed for verification and resume negotiation)
-        sha = hashlib.sha256()
-        with open(filepath, 'rb') as f:
-            while True:
-                chunk = f.read(65536)
-                if not chunk:
-                    break
-                sha.update(chunk)
-        digest = sha.digest()
+        digest = self._compute_sha256(filepath)
 
         # Try resumable protocol (magic 0xFFFF0003)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((self.host, self.port))
+        return self._send_resumable(filepath, filename, filesize, digest, progress_callback)
 
-            # Send magic header for resumable single-file protocol (0xFFFF0003)
-            client_socket.sendall(struct.pack('!I', 0xFFFF0003))
+    def _send_resumable(self, filepath, filename, filesize, digest, progress_callback=None, leaf_size=None,
+                        algorithms=None):
+        """Send a file with the resumable protocol, verified by ``digest``.
 
-            # Send filename length and filename
-            filename_encoded = filename.encode('utf-8')
-            client_socket.sendall(struct.pack('!I', len(filename_encoded)))
-            client_socket.sendall(filename_encoded)
+        With ``leaf_size`` the digest is a tree hash (magic 0xFFFF0007).
+        With ``algorithms`` the integrity algorithm is negotiated first and,
+        unless given, the digest computed with it (magic 0xFFFF0008). Either way returns
+        None if the receiver does not know that protocol.
+        """
+        with self._connect() as client_socket:
+
+            if algorithms is not None:
+                try:
+                    algorithm = self._negotiate_integrity(client_socket, algorithms)
+                except OSError:
+                    algorithm = None
+                if algorithm is None:
+                    return None  # older receiver closed on the unknown magic
+                print(f"Integrity check: {algorithm}")
+                if digest is None:
+                    digest = self._compute_digest(filepath, new_hasher(algorithm))
+
+            try:
+                offset = self._start_resumable(client_socket, filename, filesize, digest, leaf_size=leaf_size,
+                                               negotiated=algorithms is not None)
+            except TransferBusy:
+                raise
+            except (OSError, ConnectionError):
+                if leaf_size is None:
+                    raise
+                offset = None
+            if offset is None:
+                return None  # older receiver closed on the unknown magic
+
+            self._send_payload(client_socket, filepath, offset, filesize, progress_callback)
+
+            # Wait for final acknowledgment
+            ack = self._wait_ack(client_socket, filesize - offset)
+            if ack != b'OK':
+                raise Exception("Server reported error after transfer (checksum mismatch?)")
 
-            # Send file size
-            client_socket.sendall(struct.pack('!Q', filesize))
+            print("File sent successfully!")
+            return offset, True
 
-            # Send preferred chunk size
-            preferred_chunk = 65536
-            client_socket.sendall(struct.pack('!I', preferred_chunk))
+    def _send_sparse_internal(self, filepath, filename, filesize, progress_callback=None):
+        """Send only the data extents of a sparse file (magic 0xFFFF0006).
 
-            # Send sha256 (32 bytes)
-            client_socket.sendall(digest)
+        Protocol (client -> server):
+        - filename_len (4 bytes !I) + filename (utf-8)
+        - filesize (8 bytes !Q), bytes of data (8 bytes !Q)
+        - sparse digest (32 bytes, see diskio.sparse_digest)
+        Server replies with the offset to resume from (8 bytes !Q). Client then
+        sends extent records, offset (8 bytes !Q) + length (8 bytes !Q) + data,
+        from that offset on; a record of length 0 at offset filesize ends the
+        file. Server recreates the holes, verifies and replies b'OK' or b'ER'.
+        Returns None if the receiver does not support the protocol.
+        """
+        with open(filepath, 'rb') as f:
+            extents = list(data_extents(f, filesize))
+        data_bytes = sum(length for _, length in extents)
+        print(f"Sparse file: {self._format_size(data_bytes)} of data in {len(extents)} extent(s)")
+        digest = sparse_digest(filepath)
 
-            # Read server reply: current offset (8 bytes)
-            offset_data = self._recv_exact(client_socket, 8)
+        with self._connect() as client_socket:
+            filename_encoded = filename.encode('utf-8')
+            client_socket.sendall(b''.join([
+                struct.pack('!I', 0xFFFF0006),
+                struct.pack('!I', len(filename_encoded)), filename_encoded,
+                struct.pack('!QQ', filesize, data_bytes),
+                digest,
+            ]))
+            try:
+                offset_data = self._recv_exact(client_socket, 8)
+            except OSError:
+                offset_data = None
             if not offset_data:
-                raise Exception("Server did not reply with offset for resumable transfer")
-            offset = struct.unpack('!Q', offset_data)[0]
+                return None  # older receiver closed on the unknown magic
+            offset = self._check_offset(client_socket, struct.unpack('!Q', offset_data)[0])
 
-            sent = offset
             start_time = time.time()
-            with open(filepath, 'rb') as f:
-                f.seek(offset)
-                while sent < filesize:
-                    # Check if transfer should be cancelled
-                    if self.cancel_flag_fn and self.cancel_flag_fn():
-                        raise Exception("Transfer cancelled by user")
-                    self._wait_if_paused()
-                    to_read = min(self.BUFFER_SIZE, filesize - sent)
-                    data = f.read(to_read)
-                    if not data:
-                        break
-                    client_socket.sendall(data)
-                    sent += len(data)
-                    # Progress indicator with speed/ETA
-                    elapsed = max(0.001, time.time() - start_time)
-                    speed = sent / elapsed  # bytes/sec
-                    remaining = max(0, filesize - sent)
-                    eta = int(remaining / speed) if speed > 0 else None
-                    progress = (sent / filesize) * 100
-                    print(f"\rProgress: {progress:.1f}% ({self._format_size(sent)}/{self._format_size(filesize)})", end='')
-                    if progress_callback:
-                        try:
-                            progress_callback(sent, filesize, speed, eta)
-                        except TypeError:
-                            # fallback to older signature
-                            progress_callback(sent, filesize)
-
+            watchdog = self._watch(client_socket)
+            ranges = [(max(start, offset), start + length) for start, length in extents if start + length > offset]
+            with self._read_ahead(client_socket, [(filepath, start, end - start) for start, end in ranges]) as reader, \
+                    corked(client_socket):
+                for pos, end in ranges:
+                    # The extent record goes out with the extent's first chunk
+                    record = struct.pack('!QQ', pos, end - pos)
+                    for data in reader.chunks():
+                        if self.cancel_flag_fn and self.cancel_flag_fn():
+                            raise Exception("Transfer cancelled by user")
+                        self._wait_if_paused(release=True)
+                        self._send_paced(client_socket, record, data)
+                        record = b''
+                        pos += len(data)
+                        self._progress += len(data)
+                        watchdog.record(len(data))
+                        # Progress is reported against the logical size (holes count as done)
+                        elapsed = max(0.001, time.time() - start_time)
+                        speed = (pos - offset) / elapsed
+                        eta = int((filesize - pos) / speed) if speed > 0 else None
+                        print(f"\rProgress: {pos / filesize * 100:.1f}% ({self._format_size(pos)}/{self._format_size(filesize)})", end='')
+                        if progress_callback:
+                            try:
+                                progress_callback(pos, filesize, speed, eta)
+                            except TypeError:
+                                progress_callback(pos, filesize)
+                    if pos < end:
+                        raise Exception(f"{filename} changed while it was being sent")
+                client_socket.sendall(struct.pack('!QQ', filesize, 0))
             print()
 
-            # Wait for final acknowledgment
-            ack = client_socket.recv(2)
+            ack = self._wait_ack(client_socket, filesize - offset)
             if ack != b'OK':
                 raise Exception("Server reported error after transfer (checksum mismatch?)")
 
             print("File sent successfully!")
             return offset, True
 
+    def _try_copy_offload(self, filepath, filename):
+        """Ask the receiver to copy ``filepath`` from shared storage (magic 0xFFFF0005).
+
+        The receiver only accepts if the path it sees has the same inode, size
+        and mtime, and checks its copy against the file's SHA256 (computed
+        here first). Returns True if it copied and verified the file; False
+        (decline, old receiver, any error) means the file must be streamed.
+        """
+        try:
+            st = os.stat(filepath)
+            digest = self._compute_sha256(filepath)
+            name_encoded = filename.encode('utf-8')
+            path_encoded = os.path.abspath(filepath).encode('utf-8')
+            with self._connect() as client_socket:
+                client_socket.sendall(b''.join([
+                    struct.pack('!I', 0xFFFF0005),
+                    struct.pack('!I', len(name_encoded)), name_encoded,
+                    struct.pack('!I', len(path_encoded)), path_encoded,
+                    struct.pack('!QQQQ', st.st_dev & 0xFFFFFFFFFFFFFFFF, st.st_ino & 0xFFFFFFFFFFFFFFFF,
+                                st.st_size, st.st_mtime_ns),
+                    digest,
+                ]))
+                # The receiver copies and hashes the whole file before replying
+                client_socket.settimeout(ack_timeout(self.stall_timeout, 3 * st.st_size))
+                reply = b''
+                while len(reply) < 2:
+                    data = client_socket.recv(2 - len(reply))
+                    if not data:
+                        break
+                    reply += data
+            return reply == b'OK'
+        except (OSError, ConnectionError):
+            return False
+
+    def _send_payload(self, client_socket, filepath, offset, filesize, progress_callback=None):
+        """Stream ``filepath`` from ``offset`` to the end over ``client_socket``."""
+        sent = offset
+        start_time = time.time()
+        tuner = self._tuner(client_socket)
+        watchdog = self._watch(client_socket)
+        if self.zero_copy and self._can_sendfile(client_socket):
+            chunks = self._sendfile_chunks(client_socket, filepath, offset, filesize, tuner)
+        else:
+            chunks = self._read_ahead_chunks(client_socket, filepath, offset, filesize)
+        for n in chunks:
+            tuner.record(n)
+            watchdog.record(n)
+            self._progress += n
+            sent += n
+            # Progress indicator with speed/ETA
+            elapsed = max(0.001, time.time() - start_time)
+            speed = sent / elapsed  # bytes/sec
+            remaining = max(0, filesize - sent)
+            eta = int(remaining / speed) if speed > 0 else None
+            progress = (sent / filesize) * 100
+            print(f"\rProgress: {progress:.1f}% ({self._format_size(sent)}/{self._format_size(filesize)})", end='')
+            if progress_callback:
+                try:
+                    progress_callback(sent, filesize, speed, eta)
+                except TypeError:
+                    # fallback to older signature
+                    progress_callback(sent, filesize)
+
+        print()
+
+    def _check_cancel_and_pause(self):
+        """Raise if the transfer was cancelled; block while it is paused (resumable payloads)"""
+        if self.cancel_flag_fn and self.cancel_flag_fn():
+            raise Exception("Transfer cancelled by user")
+        self._wait_if_paused(release=True)
+
+    def _read_ahead_chunks(self, client_socket, filepath, offset, filesize):
+        """Send chunks read by a background thread; yield the size of each"""
+        with self._read_ahead(client_socket, [(filepath, offset, filesize - offset)]) as reader:
+            for data in reader.chunks():
+                self._check_cancel_and_pause()
+                self._send_paced(client_socket, b'', data)
+                yield len(data)
+
+    def _can_sendfile(self, client_socket):
+        """sendfile() needs a kernel socket (not the UDP or in-memory transports)"""
+        return hasattr(os, 'sendfile') and isinstance(client_socket, socket.socket)
+
+    def _sendfile_chunks(self, client_socket, filepath, offset, filesize, tuner):
+        """Send with sendfile() so data goes from the page cache to the socket; yield sizes.
+
+        Each call sends ``tuner.chunk`` bytes, so the call size follows the link
+        speed, or less under a rate limit.
+        """
+        with open(filepath, 'rb') as f:
+            fadvise(f, offset, filesize - offset, getattr(os, 'POSIX_FADV_SEQUENTIAL', None))
+            drop = DropBehind(f, offset) if self.bulk else None
+            sent = offset
+            while sent < filesize:
+                self._check_cancel_and_pause()
+                n = client_socket.sendfile(f, sent, self._throttle.max_send(min(tuner.chunk, filesize - sent)))
+                if not n:
+                    break  # file shrank
+                self._throttle.pace(n)
+                sent += n
+                if drop is not None:
+                    drop.advance(sent)
+                yield n
+            if drop is not None:
+                drop.finish(sent)
+
+    def _watch(self, client_socket):
+        """Arm the stall timeout, throughput floor and rate limit for the payload about to be sent.
+
+        Not before: a receiver that serves one connection at a time keeps
+        new ones waiting for their reply while it finishes another transfer.
+        """
+        client_socket.settimeout(self.stall_timeout or None)
+        self._release_throttle()
+        self._throttle = self.rate_limiter.transfer(self.host, self.rate_limit)
+        self._watchdog = StallWatchdog(self.min_rate)
+        return self._watchdog
+
+    def _release_throttle(self):
+        """Give this transfer's share of the rate limits back to the others"""
+        if self._throttle is not None:
+            self._throttle.close()
+            self._throttle = None
+
+    def _send_paced(self, client_socket, header, data):
+        """send_frame() in writes the rate limit allows, sleeping while over it"""
+        if self._throttle is None:
+            send_frame(client_socket, header, data)  # paused: control frames only
+            return
+        for piece in self._throttle.pieces(data):
+            send_frame(client_socket, header, piece)
+            header = b''
+            self._throttle.pace(len(piece))
+
+    def _wait_ack(self, client_socket, size):
+        """Read the final 2-byte status, allowing the receiver time to verify ``size`` bytes"""
+        client_socket.settimeout(ack_timeout(self.stall_timeout, size))
+        return self._recv_exact(client_socket, 2)
+
+    def _chunk(self):
+        """Chunk size to announce and start with, within the receiver's max_chunk"""
+        size = self.chunk_size or DEFAULT_CHUNK
+        return min(size, self._peer['max_chunk']) if self._peer else size
+
+    def _tuner(self, client_socket):
+        """Adaptive (or, with chunk_size set, fixed) chunk sizing for one transfer"""
+        maximum = self._peer['max_chunk'] if self._peer else MAX_CHUNK
+        return ChunkTuner(client_socket, self._chunk(), maximum, adaptive=self.chunk_size is None)
+
+    def _read_ahead(self, client_socket, items):
+        """ReadAhead for ``items`` in chunks of the announced size.
+
+        Chunks are large enough to keep the prefetch queue cheap; fewer
+        buffers are used for larger chunks so the memory budget stays
+        that of ReadAhead's defaults.
+        """
+        size = max(io_size(client_socket, self.BUFFER_SIZE), ReadAhead.CHUNK_SIZE, self._chunk())
+        depth = max(2, ReadAhead.DEPTH * ReadAhead.CHUNK_SIZE // size)
+        return ReadAhead(items, size, depth, bulk=self.bulk)
+
+    def _compute_sha256(self, filepath):
+        """Return the raw SHA256 digest of a file."""
+        return self._compute_digest(filepath, hashlib.sha256())
+
+    def _compute_digest(self, filepath, sha):
+        """Feed a file to the hashlib-style ``sha`` and return its digest."""
+        if not sha.digest_size:
+            return b''  # 'none': nothing to read
+        return self._cached_digest(filepath, sha.name, lambda: self._hash_file(filepath, sha))
+
+    def _cached_digest(self, filepath, algorithm, compute):
+        """``compute()``, remembered while the file is unchanged (for retries and resumes)"""
+        st = os.stat(filepath)
+        key = (str(filepath), st.st_size, st.st_mtime_ns, algorithm)
+        if key not in self._digests:
+            self._digests[key] = compute()
+        return self._digests[key]
+
+    def _hash_file(self, filepath, sha):
+        with open(filepath, 'rb') as f:
+            drop = DropBehind(f) if self.bulk else None
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                if drop is not None:
+                    drop.advance(f.tell())
+            if drop is not None:
+                drop.finish(f.tell())
+        return sha.digest()
+
+    def _start_resumable(self, client_socket, filename, filesize, digest, relay_hops=None, leaf_size=None,
+                         negotiated=False):
+        """Send the resumable single-file header (magic 0xFFFF0003).
+
+        If ``relay_hops`` is given, the relay variant (magic 0xFFFF0004) is
+        used instead: the hop list ("host:port" strings) precedes the header.
+        With ``leaf_size`` the tree hash variant (magic 0xFFFF0007) is used:
+        the leaf size precedes the header and ``digest`` is the tree root.
+        With ``negotiated`` the 0xFFFF0008 exchange already took place and
+        only the digest length precedes the header.
+        Returns the offset the server wants the payload to start from, or
+        None for the tree hash variant if the server closed without a reply.
+        """
+        # The whole header goes out in one write (see transport.send_frame)
+        parts = []
+        if relay_hops is not None:
+            # Magic header for relay chain protocol (0xFFFF0004) and the hops
+            parts.append(struct.pack('!II', 0xFFFF0004, len(relay_hops)))
+            for hop in relay_hops:
+                hop_encoded = hop.encode('utf-8')
+                parts.append(struct.pack('!I', len(hop_encoded)) + hop_encoded)
+        elif negotiated:
+            # Integrity algorithm agreed on (0xFFFF0008): announce the digest length
+            parts.append(struct.pack('!B', len(digest)))
+        elif leaf_size is not None:
+            # Magic header for tree-hashed resumable protocol (0xFFFF0007) and the leaf size
+            parts.append(struct.pack('!II', 0xFFFF0007, leaf_size))
+        else:
+            # Magic header for resumable single-file protocol (0xFFFF0003)
+            parts.append(struct.pack('!I', 0xFFFF0003))
+
+        # Filename length and filename
+        filename_encoded = filename.encode('utf-8')
+        parts.append(struct.pack('!I', len(filename_encoded)) + filename_encoded)
+
+        # File size and preferred chunk size (the receiver reads in chunks of this size)
+        preferred_chunk = self._chunk()
+        parts.append(struct.pack('!QI', filesize, preferred_chunk))
+
+        # sha256 (32 bytes, or the agreed digest)
+        parts.append(digest)
+        client_socket.sendall(b''.join(parts))
+
+        # Read server reply: current offset (8 bytes)
+        offset_data = self._recv_exact(client_socket, 8)
+        if not offset_data:
+            if leaf_size is not None:
+                return None
+            raise Exception("Server did not reply with offset for resumable transfer")
+        return self._check_offset(client_socket, struct.unpack('!Q', offset_data)[0])
+
+    def _negotiate_integrity(self, client_socket, algorithms):
+        """Offer ``algorithms`` (magic 0xFFFF0008) and return the receiver's choice.
+
+        None if the receiver closed without answering (it predates the
+        protocol); TransferRejected if it accepts none of them.
+        """
+        parts = [struct.pack('!IB', 0xFFFF0008, len(algorithms))]
+        for name in algorithms:
+            parts.append(struct.pack('!B', len(name)) + name.encode('ascii'))
+        client_socket.sendall(b''.join(parts))
+        name_len = self._recv_exact(client_socket, 1)
+        if not name_len:
+            return None
+        if not name_len[0]:
+            code = self._recv_exact(client_socket, 4)
+            raise TransferRejected(struct.unpack('!I', code)[0] if code else 3)
+        name = self._recv_exact(client_socket, name_len[0])
+        if name is None:
+            return None
+        return name.decode('ascii')
+
+    def _check_offset(self, client_socket, offset):
+        """Return ``offset``, or raise TransferRejected if it is the refusal marker"""
+        if offset == self.REJECTED:
+            code = self._recv_exact(client_socket, 4)
+            code = struct.unpack('!I', code)[0] if code else 0
+            if code == 4:
+                raise TransferBusy("The receiver is still receiving this file on another connection")
+            raise TransferRejected(code)
+        return offset
+
+    def _open_batch(self, file_count, total_size):
+        """Connect and start a multi-file session; returns the socket.
+
+        The batch header (magic 0xFFFF0009: file count !I, total size !Q)
+        lets the receiver refuse before any data is sent. Receivers that do
+        not know it close the connection, and the plain multi-file header
+        (0xFFFF0002) is sent on a new connection instead.
+        """
+        client_socket = self._connect()
+        if not self._peer_supports('batch'):
+            # Known from the handshake: go straight to the plain header
+            client_socket.sendall(struct.pack('!II', 0xFFFF0002, file_count))
+            return client_socket
+        try:
+            client_socket.sendall(struct.pack('!IIQ', 0xFFFF0009, file_count, total_size))
+            status = self._recv_exact(client_socket, 4)
+        except OSError:
+            status = None
+        if status:
+            code = struct.unpack('!I', status)[0]
+            if code:
+                client_socket.close()
+                raise TransferRejected(code)
+            return client_socket
+        client_socket.close()
+
+        client_socket = self._connect()
+        # Send magic header for multi-file protocol (0xFFFF0002) and the number of files
+        client_socket.sendall(struct.pack('!II', 0xFFFF0002, file_count))
+        return client_socket
+
     def _recv_exact(self, sock, size):
         """Helper to receive exact bytes from a connected socket (client-side)."""
         data = b''
@@ -138,43 +670,148 @@ class TransferClient:
             data += chunk
         return data
     
-    def _wait_if_paused(self):
-        """Block if pause_event is set (paused), and resume when cleared."""
-        if self.pause_event:
-            self.pause_event.wait()  # Blocks while paused; resumes when event is cleared
+    def _wait_if_paused(self, release=False):
+        """Block while pause_event is cleared (paused); return once it is set again.
+
+        With ``release`` (resumable transfers) a pause longer than
+        PAUSE_RELEASE seconds raises TransferPaused instead: the connection
+        is closed, so the receiver frees its thread and file, and the retry
+        loop resumes the transfer on a new connection once unpaused.
+        """
+        if self.pause_event and not self.pause_event.is_set():
+            started = time.time()
+            if not release:
+                self.pause_event.wait()  # Blocks while paused; resumes when the event is set
+            elif not self.pause_event.wait(self.PAUSE_RELEASE):
+                raise TransferPaused("paused")
+            if self._watchdog is not None:
+                self._watchdog.exclude(time.time() - started)
+
+    def _wait_until_resumed(self):
+        """Wait out a pause with no connection open; raises if cancelled meanwhile"""
+        while not self.pause_event.wait(1):
+            if self.cancel_flag_fn and self.cancel_flag_fn():
+                raise Exception("Transfer cancelled by user")
+
+    def _pause_mux(self, sender):
+        """Pause a multiplexed session: the receiver parks it and closes its files until resumed"""
+        print("\nPaused")
+        started = time.time()
+        self._release_throttle()  # no share of the rate limits while paused
+        if not sender.pause(self.pause_event.wait, lambda: bool(self.cancel_flag_fn and self.cancel_flag_fn())):
+            sender.cancel()
+            raise Exception("Transfer cancelled by user")
+        self._throttle = self.rate_limiter.transfer(self.host, self.rate_limit)
+        if self._watchdog is not None:
+            self._watchdog.exclude(time.time() - started)
+        print("Resumed")
     
     def _retry_with_backoff(self, operation, operation_name="operation"):
         """
         Retry operation with exponential backoff on connection errors.
+        A stalled connection is replaced at once, and an attempt that got
+        resumable data across does not count against MAX_RETRIES.
         Args:
             operation: callable that performs the transfer
             operation_name: string name of operation for logging
         Returns:
             Result of operation or None if all retries failed
         """
-        for attempt in range(1, self.MAX_RETRIES + 1):
+        attempt = 1
+        while True:
+            self._progress = 0
+            self._watchdog = None
             try:
                 return operation()
+            except TransferPaused:
+                self._release_throttle()
+                print(f"\n{operation_name} paused; connection released until resumed")
+                self._wait_until_resumed()
+                print("Resuming")
             except (socket.error, ConnectionError, BrokenPipeError) as e:
+                self._release_throttle()
+                if self._progress:
+                    attempt = 1  # resumed transfers continue from the new offset
                 if attempt < self.MAX_RETRIES:
-                    wait_time = self.RETRY_DELAY * (2 ** (attempt - 1))  # exponential backoff
-                    print(f"\n{operation_name} failed (attempt {attempt}/{self.MAX_RETRIES}): {e}")
-                    print(f"Retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
+                    if isinstance(e, (TransferStalled, socket.timeout)):
+                        print(f"\n{operation_name} stalled ({e or 'no progress'}); reconnecting")
+                    else:
+                        wait_time = self.RETRY_DELAY * (2 ** (attempt - 1))  # exponential backoff
+                        print(f"\n{operation_name} failed (attempt {attempt}/{self.MAX_RETRIES}): {e}")
+                        print(f"Retrying in {wait_time} seconds...")
+                        time.sleep(wait_time)
+                    attempt += 1
                 else:
                     print(f"\n{operation_name} failed after {self.MAX_RETRIES} attempts: {e}")
                     raise
+            finally:
+                self._release_throttle()
     
-    def send_multiple_files(self, filepaths, progress_callback=None):
-        """Send multiple files to the server with automatic retry on connection error"""
+    def send_relay(self, filepath, relay_hops, progress_callback=None):
+        """Send a file or directory through a chain of relaying receivers.
+
+        This client only serves the first hop (``self.host``/``self.port``);
+        every receiver forwards blocks to the next one while still receiving
+        them. ``relay_hops`` lists the remaining receivers as "host:port".
+        """
+        filepath = Path(filepath)
+        if not filepath.exists():
+            raise FileNotFoundError(f"File not found: {filepath}")
+        hops = [str(h) for h in relay_hops]
+        if filepath.is_dir():
+            items = [(f, str(f.relative_to(filepath.parent)).replace('\\', '/'))
+                     for f in filepath.rglob('*') if f.is_file()]
+        else:
+            items = [(filepath, filepath.name)]
+
+        for path, name in items:
+            def _do_send(path=path, name=name):
+                return self._send_relay_internal(path, name, hops, progress_callback)
+
+            self._retry_with_backoff(_do_send, f"Relaying {name}")
+
+    def _send_relay_internal(self, filepath, filename, relay_hops, progress_callback=None):
+        filesize = filepath.stat().st_size
+        print(f"Sending: {filename} ({self._format_size(filesize)}) via relay chain of {len(relay_hops) + 1} receiver(s)")
+        if relay_hops and not self._peer_supports('relay'):
+            raise Exception(f"{self.host}:{self.port} does not relay transfers (start it with --relay)")
+
+        digest = self._compute_sha256(filepath)
+
+        with self._connect() as client_socket:
+
+            offset = self._start_resumable(client_socket, filename, filesize, digest, relay_hops=relay_hops)
+
+            self._send_payload(client_socket, filepath, offset, filesize, progress_callback)
+
+            # The first hop acknowledges only once the whole chain has verified the file
+            ack = self._wait_ack(client_socket, filesize - offset)
+            if ack != b'OK':
+                raise Exception("Relay chain reported error after transfer (checksum mismatch or hop failure)")
+
+            print("File relayed successfully!")
+            return offset, True
+
+    def send_multiple_files(self, filepaths, progress_callback=None, priorities=None):
+        """Send multiple files to the server with automatic retry on connection error.
+
+        With ``multiplex``, ``priorities`` may map paths to stream weights
+        (1-256, default mux.DEFAULT_WEIGHT): a file gets bandwidth in
+        proportion to its weight while it is sent next to others.
+        """
         filepaths = [Path(f) for f in filepaths]
         
         # Verify all files exist
         for filepath in filepaths:
             if not filepath.exists():
                 raise FileNotFoundError(f"File not found: {filepath}")
+        priorities = {Path(p): w for p, w in (priorities or {}).items()}
+        done = set()  # files acknowledged by an earlier multiplexed attempt
         
         def _do_send():
+            if self.multiplex and self._peer_supports('mux'):
+                files = [(f, f.name, priorities.get(f, DEFAULT_WEIGHT)) for f in filepaths]
+                return self._send_mux(files, progress_callback, done)
             return self._send_multiple_files_internal(filepaths, progress_callback)
         
         return self._retry_with_backoff(_do_send, f"Sending {len(filepaths)} file(s)")
@@ -190,45 +827,38 @@ class TransferClient:
         
         print(f"Sending {len(filepaths)} file(s) - Total size: {self._format_size(total_size)}")
         
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((self.host, self.port))
-            
-            # Send magic header for multi-file protocol (0xFFFF0002)
-            client_socket.sendall(struct.pack('!I', 0xFFFF0002))
-            
-            # Send number of files
-            client_socket.sendall(struct.pack('!I', len(filepaths)))
+        with self._open_batch(len(filepaths), total_size) as client_socket:
             
             sent_total = 0
             start_time = time.time()
-            for filepath in filepaths:
-                filesize = filepath.stat().st_size
-                filename = filepath.name
-                
-                print(f"\nSending: {filename} ({self._format_size(filesize)})")
+            watchdog = self._watch(client_socket)
+            # Read the next files ahead on a background thread while this one is sent
+            sizes = [f.stat().st_size for f in filepaths]
+            items = [(f, 0, size) for f, size in zip(filepaths, sizes)]
+            # Corked: headers and data of small files share full segments
+            with self._read_ahead(client_socket, items) as reader, corked(client_socket):
+                for filepath, filesize in zip(filepaths, sizes):
+                    filename = filepath.name
                 
-                # Send filename length and filename
-                filename_encoded = filename.encode('utf-8')
-                client_socket.sendall(struct.pack('!I', len(filename_encoded)))
-                client_socket.sendall(filename_encoded)
+                    print(f"\nSending: {filename} ({self._format_size(filesize)})")
                 
-                # Send file size
-                client_socket.sendall(struct.pack('!Q', filesize))
+                    # File header (filename length, filename, file size), written
+                    # together with the first chunk of content
+                    filename_encoded = filename.encode('utf-8')
+                    header = struct.pack('!I', len(filename_encoded)) + filename_encoded + struct.pack('!Q', filesize)
                 
-                # Send file content
-                sent = 0
-                with open(filepath, 'rb') as f:
-                    while sent < filesize:
+                    # Send file content
+                    sent = 0
+                    for data in reader.chunks():
                         # Check if transfer should be cancelled
                         if self.cancel_flag_fn and self.cancel_flag_fn():
                             raise Exception("Transfer cancelled by user")
                         self._wait_if_paused()  # Check and block if paused
-                        data = f.read(self.BUFFER_SIZE)
-                        if not data:
-                            break
-                        client_socket.sendall(data)
+                        self._send_paced(client_socket, header, data)
+                        header = b''
                         sent += len(data)
                         sent_total += len(data)
+                        watchdog.record(len(data))
 
                         # Progress indicator with speed/ETA (per-file + total)
                         elapsed = max(0.001, time.time() - start_time)
@@ -251,11 +881,13 @@ class TransferClient:
                                     progress_callback(sent_total, total_size, speed, total_eta)
                                 except TypeError:
                                     progress_callback(sent_total, total_size)
+                    if header:
+                        client_socket.sendall(header)  # empty file
             
             print("\n")
             
             # Wait for acknowledgment
-            ack = client_socket.recv(2)
+            ack = self._wait_ack(client_socket, total_size)
             if ack != b'OK':
                 raise Exception("Server did not acknowledge receipt")
                 
@@ -266,8 +898,15 @@ class TransferClient:
         dirpath = Path(dirpath)
         if not dirpath.is_dir():
             raise NotADirectoryError(f"Not a directory: {dirpath}")
+        done = set()  # files acknowledged by an earlier multiplexed attempt
         
         def _do_send():
+            if self.multiplex and self._peer_supports('mux'):
+                files = [(f, str(f.relative_to(dirpath.parent)).replace('\\', '/'), DEFAULT_WEIGHT)
+                         for f in dirpath.rglob('*') if f.is_file()]
+                if not files:
+                    raise FileNotFoundError(f"No files found in directory: {dirpath}")
+                return self._send_mux(files, progress_callback, done)
             return self._send_directory_internal(dirpath, progress_callback)
         
         return self._retry_with_backoff(_do_send, f"Sending directory {dirpath.name}")
@@ -290,47 +929,40 @@ class TransferClient:
         print(f"Sending directory: {dirpath.name}")
         print(f"Files: {len(files)} - Total size: {self._format_size(total_size)}")
         
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect((self.host, self.port))
-            
-            # Send magic header for multi-file protocol (0xFFFF0002)
-            client_socket.sendall(struct.pack('!I', 0xFFFF0002))
-            
-            # Send number of files
-            client_socket.sendall(struct.pack('!I', len(files)))
+        with self._open_batch(len(files), total_size) as client_socket:
             
             sent_total = 0
             start_time = time.time()
-            for filepath in files:
-                filesize = filepath.stat().st_size
-                # Preserve directory structure relative to parent
-                relative_path = filepath.relative_to(dirpath.parent)
-                filename = str(relative_path).replace('\\', '/')  # Normalize path separators
+            watchdog = self._watch(client_socket)
+            # Read the next files ahead on a background thread while this one is sent
+            sizes = [f.stat().st_size for f in files]
+            items = [(f, 0, size) for f, size in zip(files, sizes)]
+            # Corked: headers and data of small files share full segments
+            with self._read_ahead(client_socket, items) as reader, corked(client_socket):
+                for filepath, filesize in zip(files, sizes):
+                    # Preserve directory structure relative to parent
+                    relative_path = filepath.relative_to(dirpath.parent)
+                    filename = str(relative_path).replace('\\', '/')  # Normalize path separators
                 
-                print(f"\nSending: {filename} ({self._format_size(filesize)})")
+                    print(f"\nSending: {filename} ({self._format_size(filesize)})")
                 
-                # Send filename length and filename
-                filename_encoded = filename.encode('utf-8')
-                client_socket.sendall(struct.pack('!I', len(filename_encoded)))
-                client_socket.sendall(filename_encoded)
+                    # File header (filename length, filename, file size), written
+                    # together with the first chunk of content
+                    filename_encoded = filename.encode('utf-8')
+                    header = struct.pack('!I', len(filename_encoded)) + filename_encoded + struct.pack('!Q', filesize)
                 
-                # Send file size
-                client_socket.sendall(struct.pack('!Q', filesize))
-                
-                # Send file content
-                sent = 0
-                with open(filepath, 'rb') as f:
-                    while sent < filesize:
+                    # Send file content
+                    sent = 0
+                    for data in reader.chunks():
                         # Check if transfer should be cancelled
                         if self.cancel_flag_fn and self.cancel_flag_fn():
                             raise Exception("Transfer cancelled by user")
                         self._wait_if_paused()  # Check and block if paused
-                        data = f.read(self.BUFFER_SIZE)
-                        if not data:
-                            break
-                        client_socket.sendall(data)
+                        self._send_paced(client_socket, header, data)
+                        header = b''
                         sent += len(data)
                         sent_total += len(data)
+                        watchdog.record(len(data))
 
                         # Progress indicator with speed/ETA
                         elapsed = max(0.001, time.time() - start_time)
@@ -345,16 +977,90 @@ class TransferClient:
                                 progress_callback(sent_total, total_size, speed, eta)
                             except TypeError:
                                 progress_callback(sent_total, total_size)
+                    if header:
+                        client_socket.sendall(header)  # empty file
             
             print("\n")
             
             # Wait for acknowledgment
-            ack = client_socket.recv(2)
+            ack = self._wait_ack(client_socket, total_size)
             if ack != b'OK':
                 raise Exception("Server did not acknowledge receipt")
                 
             print(f"Directory sent successfully ({len(files)} file(s))!")
             
+    def _send_mux(self, files, progress_callback, done):
+        """Send ``files`` ((path, name, weight)) interleaved on one connection (magic 0xFFFF0011).
+
+        Small files finish while large ones are still being sent. Names in
+        ``done`` were acknowledged by an earlier attempt and are skipped;
+        newly acknowledged ones are added, so a retry resends only the rest.
+        """
+        items = [(path, name, path.stat().st_size, weight) for path, name, weight in files if name not in done]
+        total_size = sum(item[2] for item in items)
+        print(f"Sending {len(items)} file(s) on multiplexed streams - Total size: {self._format_size(total_size)}")
+
+        with self._connect() as client_socket:
+            client_socket.sendall(struct.pack('!IIQ', MUX_MAGIC, len(items), total_size))
+            status = self._recv_exact(client_socket, 4)
+            if not status:
+                raise ConnectionError("The receiver closed the connection")
+            code = struct.unpack('!I', status)[0]
+            if code:
+                raise TransferRejected(code)
+
+            watchdog = self._watch(client_socket)
+            start_time = time.time()
+            sent_total = 0
+
+            def sent(stream, n):
+                nonlocal sent_total
+                sent_total += n
+                watchdog.record(n)
+                if self.cancel_flag_fn and self.cancel_flag_fn():
+                    sender.cancel()  # the receiver discards the unfinished files
+                    raise Exception("Transfer cancelled by user")
+                if self.pause_event and not self.pause_event.is_set():
+                    self._pause_mux(sender)
+                elapsed = max(0.001, time.time() - start_time)
+                speed = sent_total / elapsed
+                file_eta = int((stream.size - stream.sent) / speed) if speed > 0 else None
+                total_eta = int(max(0, total_size - sent_total) / speed) if speed > 0 else None
+                print(f"\rTotal: {sent_total / max(1, total_size) * 100:.1f}% ({self._format_size(sent_total)}/"
+                      f"{self._format_size(total_size)})", end='')
+                if progress_callback:
+                    try:
+                        progress_callback(stream.sent, stream.size, speed, file_eta, sent_total, total_size,
+                                          total_eta, stream.name)
+                    except TypeError:
+                        try:
+                            progress_callback(sent_total, total_size, speed, total_eta)
+                        except TypeError:
+                            progress_callback(sent_total, total_size)
+
+            sender = MuxSender(client_socket, items, self._chunk(),
+                               lambda header, payload: self._send_paced(client_socket, header, payload),
+                               sent, self.stall_timeout, ack_timeout(self.stall_timeout, total_size))
+            try:
+                statuses = sender.run()
+            finally:
+                acked = [name for name, status in sender.answers().items() if status == 'OK']
+                done.update(acked)
+                self._progress += len(acked)  # a retry continues with the rest
+            print()
+
+        failed = {name: status for name, status in statuses.items() if status != 'OK'}
+        if not failed:
+            print(f"All {len(items)} file(s) sent successfully!")
+            return
+        print(f"{len(failed)} file(s) not accepted: {', '.join(sorted(failed))}")
+        codes = set(failed.values())
+        if codes == {4}:
+            raise TransferBusy("The receiver is still receiving some of these files on another connection")
+        if len(codes) == 1 and codes <= set(TransferRejected.REASONS):
+            raise TransferRejected(codes.pop())
+        raise TransferIncomplete(f"The receiver reported errors for {len(failed)} file(s)")
+
     def _format_size(self, size):
         """Format file size in human-readable format"""
         for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
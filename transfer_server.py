@@ -8,60 +8,381 @@ import struct
 import time
 from pathlib import Path
 import hashlib
+import threading
+import sys
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from transport import (get_transport, io_size, tune_socket, is_local_host, ChunkTuner, DEFAULT_CHUNK, MAX_CHUNK, clamp_chunk,
+                       STALL_TIMEOUT, ack_timeout)
+from workers import WorkerPool, workers_supported
+from hashing import TreeHash, valid_leaf_size, new_hasher, DEFAULT_ACCEPTED
+from handshake import HELLO_MAGIC, capabilities, read_capabilities, send_hello_ack
+from ratelimit import RateLimiter
+from diskio import BlockWriter, PipelinedWriter, SpliceWriter, Durability, StagingArea, PartialLocks, sparse_digest
+import mux
 
 
 class TransferServer:
     BUFFER_SIZE = 4096
+    RELAY_CONNECT_TIMEOUT = 5  # Seconds to wait for the next hop of a relay chain
+    FICLONE = 0x40049409  # Linux reflink ioctl (btrfs, XFS, some NFS servers)
+    REJECTED = 0xFFFFFFFFFFFFFFFF  # offset reply announcing a refusal; a 4-byte REJECT_* code follows
+    REJECT_NO_SPACE = 1
+    REJECT_QUOTA = 2
+    REJECT_INTEGRITY = 3  # none of the offered integrity algorithms is accepted
+    REJECT_BUSY = 4  # the file is still being received on another connection; retry later
+    TAKEOVER_IDLE = 5  # seconds a claimed .partial file must sit unchanged before a new connection takes it over
+    TAKEOVER_WAIT = 2  # seconds to wait for the stalled connection to let go
     
-    def __init__(self, port=5000, output_dir='.', progress_callback=None):
+    def __init__(self, port=5000, output_dir='.', progress_callback=None, relay=False, udp=False,
+                 transports=None, copy_offload=True, allow_hardlink=False,
+                 pipeline_depth=PipelinedWriter.DEPTH, bulk=False, zero_copy=True,
+                 durability='none', group_files=None, group_ms=None, peer_quota=None, min_free=0,
+                 workers=1, worker_threads=4, integrity=DEFAULT_ACCEPTED, max_chunk=MAX_CHUNK,
+                 stall_timeout=STALL_TIMEOUT, rate_limiter=None, shared_mounts=()):
         self.port = port
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
         # Optional callback to report progress: function(sent, total, speed=None, eta=None, filename=None)
         self.progress_callback = progress_callback
+        # Relay mode: forward relay-chain transfers (0xFFFF0004) to the next hop
+        self.relay = relay
+        # Transports to listen on (same port number); TCP is always included.
+        # Local peers are picked up through the Unix socket / in-process fast paths.
+        self.transports = list(transports or ('tcp', 'unix', 'memory'))
+        if udp and 'udp' not in self.transports:
+            self.transports.append('udp')
+        # Copy offload (0xFFFF0005): copy files the sender points at on shared storage.
+        # Senders on this host may offer any file; other senders only files under
+        # one of shared_mounts. Hardlinks share the inode with the source, so they are opt-in.
+        self.copy_offload = copy_offload
+        self.shared_mounts = [os.path.realpath(m) for m in shared_mounts]
+        self.allow_hardlink = allow_hardlink
+        # Buffers (1 MiB each) the network side may run ahead of the disk writer
+        self.pipeline_depth = pipeline_depth
+        # Bulk mode: drop received data from the page cache once it is on disk
+        self.bulk = bulk
+        # Splice payload from TCP/Unix sockets straight into files (Linux)
+        self.zero_copy = zero_copy
+        # When received files are synced to disk: 'none', 'file' or 'group'
+        # (batched every group_files files / group_ms ms); ACKs follow the sync
+        self.durability = Durability(durability, group_files, group_ms)
+        # Transfers are refused up front if they would leave less than min_free
+        # bytes on disk or take a peer past peer_quota bytes (None: no quota)
+        self.peer_quota = peer_quota
+        self.min_free = min_free
+        self._peer_usage = {}
+        self._reservations = {}
+        self._quota_lock = threading.Lock()
+        # Worker processes sharing the port (SO_REUSEPORT), each with a thread
+        # pool; they coordinate on .partial files through PartialLocks
+        self.workers = workers
+        self.worker_threads = worker_threads
+        if workers > 1 and not workers_supported():
+            print("Worker processes are not supported on this platform; using one process")
+            self.workers = 1
+        self._partial_locks = PartialLocks(self.output_dir, shared=self.workers > 1)
+        # Integrity algorithms senders may choose (0xFFFF0008); 'none' must be listed explicitly
+        self.integrity = tuple(integrity)
+        # Largest chunk (network read / pipeline buffer) a sender may ask for
+        self.max_chunk = clamp_chunk(max_chunk)
+        # Connections that move no data for stall_timeout seconds are dropped
+        # (None: wait forever), so their .partial file can be resumed elsewhere
+        self.stall_timeout = stall_timeout
+        self._connections = {}  # id(conn) -> conn, for taking over stalled transfers
+        # Bandwidth limits for receiving (see ratelimit.py); each connection is one transfer
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self._throttles = {}  # id(conn) -> Throttle
+        if self.workers > 1 and (self.rate_limiter.global_rate or self.rate_limiter.peer_rate):
+            # Each worker process would pace only its own connections
+            raise ValueError("Global and per-peer rate limits cannot be used with worker processes")
+        # Paused multiplexed sessions wait here without a thread (see _park)
+        self._parking = None
         
     def start(self):
         """Start the server and listen for incoming connections"""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            server_socket.bind(('0.0.0.0', self.port))
-            server_socket.listen(1)
-            
-            # Server running silently
-            
+        StagingArea.cleanup(self.output_dir)
+        if self.workers > 1:
+            WorkerPool(self, self.workers, self.worker_threads).run()
+            return
+        listener = get_transport('tcp').listen('0.0.0.0', self.port)
+        self._start_extra_listeners()
+
+        # Server running silently
+        with listener:
+            self._serve(listener)
+
+    def _start_extra_listeners(self):
+        """Serve the same-host fast paths (and UDP if enabled) alongside TCP"""
+        for name in self.transports:
+            if name == 'tcp' or not get_transport(name).available:
+                continue
+            try:
+                extra = get_transport(name).listen('0.0.0.0', self.port)
+            except OSError as e:
+                print(f"Not listening on {name} transport: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(extra,), daemon=True).start()
+
+    def _serve(self, listener):
+        """Accept connections from one listener; each is handled on a thread of its own.
+
+        Accepting never waits for a running transfer, so a sender that
+        reconnects after a stall reaches _claim_partial at once and can
+        take over from its half-dead connection.
+        """
+        try:
             while True:
                 try:
-                    conn, addr = server_socket.accept()
-                    result = self._receive_files(conn)
+                    conn, addr = listener.accept()
+                    self._dispatch(self._receive_files, conn)
                     # Do not return here; keep server running to accept further connections.
                 except Exception:
                     pass
+        finally:
+            listener.close()
     
     def _receive_files(self, conn):
         """Receive file(s) from the connected client"""
+        result = None
+        self._connections[id(conn)] = conn
+        self._throttles[id(conn)] = self.rate_limiter.transfer(self._peer_host(conn))
         try:
+            tune_socket(conn)
+            if hasattr(conn, 'settimeout'):
+                conn.settimeout(self.stall_timeout or None)
             # Read magic header to determine protocol version
             magic_data = self._recv_exact(conn, 4)
             if magic_data is None or not magic_data:
                 return
             
             magic = struct.unpack('!I', magic_data)[0]
+            if magic == HELLO_MAGIC:
+                # Capabilities first; the protocol magic follows on the same connection
+                if not self._handshake(conn):
+                    return
+                magic_data = self._recv_exact(conn, 4)
+                if not magic_data:
+                    return  # the client only asked for capabilities
+                magic = struct.unpack('!I', magic_data)[0]
             
             if magic == 0xFFFF0001:
-                return self._receive_files_single(conn)
+                result = self._receive_files_single(conn)
             elif magic == 0xFFFF0002:
-                return self._receive_files_multi(conn)
+                result = self._receive_files_multi(conn)
             elif magic == 0xFFFF0003:
-                return self._receive_files_resumable_single(conn)
-            else:
-                return None
+                result = self._receive_files_resumable_single(conn)
+            elif magic == 0xFFFF0004:
+                result = self._receive_files_relay(conn)
+            elif magic == 0xFFFF0005:
+                result = self._receive_files_offload(conn)
+            elif magic == 0xFFFF0006:
+                result = self._receive_files_sparse(conn)
+            elif magic == 0xFFFF0007:
+                result = self._receive_files_tree(conn)
+            elif magic == 0xFFFF0008:
+                result = self._receive_files_negotiated(conn)
+            elif magic == 0xFFFF0009:
+                result = self._receive_files_batch(conn)
+            elif magic == mux.MUX_MAGIC:
+                result = self._receive_files_mux(conn)
+            return result
                 
         except Exception:
             return None
         finally:
-            conn.close()
+            if result is not mux.PARKED:
+                self._end_connection(conn, result)
+
+    def _end_connection(self, conn, result):
+        # Quota reserved for a transfer that did not complete is given back
+        self._settle_quota(conn, completed=bool(result))
+        self._partial_locks.release(id(conn))
+        self._connections.pop(id(conn), None)
+        self._throttles.pop(id(conn)).close()
+        conn.close()
+
+    def _capabilities(self, conn=None):
+        """What this receiver offers ``conn``'s sender in its HELLO-ACK"""
+        features = ['resumable', 'sparse', 'tree', 'integrity', 'batch', 'mux']
+        if self.relay:
+            features.append('relay')
+        if self.copy_offload and (self.shared_mounts or conn is None or self._is_local_peer(conn)):
+            features.append('offload')
+        return capabilities(features, list(self.integrity) + ['tree-sha256'],
+                            max_chunk=self.max_chunk,
+                            max_streams=self.workers * self.worker_threads if self.workers > 1 else 1)
+
+    def _handshake(self, conn):
+        """Answer a HELLO (magic 0xFFFF0010, see handshake.py); False if it was malformed"""
+        peer = read_capabilities(lambda size: self._recv_exact(conn, size))
+        if peer is None:
+            return False
+        send_hello_ack(conn, self._capabilities(conn))
+        return True
+
+    def _claim_partial(self, conn, partial_path, filename):
+        """Claim ``partial_path`` for this connection until it ends.
+
+        A sender that lost its connection (e.g. moved to another network)
+        usually reconnects before the receiver notices the old connection
+        is dead. If that connection is in this process and the partial file
+        has not changed for TAKEOVER_IDLE seconds, it is shut down and the
+        new one takes over. Otherwise the transfer is refused with
+        REJECT_BUSY and False is returned; the client retries later.
+        """
+        owner = id(conn)
+        if self._partial_locks.acquire(partial_path, owner):
+            return True
+        holder = self._connections.get(self._partial_locks.holder(partial_path))
+        if holder is not None and self._idle_for(partial_path) >= self.TAKEOVER_IDLE:
+            print(f"Taking over {filename} from a stalled connection")
+            try:
+                holder.shutdown(socket.SHUT_RDWR)
+            except (OSError, AttributeError):
+                pass
+            deadline = time.time() + self.TAKEOVER_WAIT
+            while time.time() < deadline:
+                time.sleep(0.05)
+                if self._partial_locks.acquire(partial_path, owner):
+                    return True
+        self._reject(conn, self.REJECT_BUSY, filename)
+        return False
+
+    def _idle_for(self, path):
+        """Seconds since ``path`` was last written (0 if it cannot be told)"""
+        try:
+            return time.time() - os.stat(path).st_mtime
+        except OSError:
+            return 0
+
+    def _is_local_peer(self, conn):
+        host = self._peer_host(conn)
+        return bool(host) and is_local_host(host)
+
+    def _may_offload(self, conn, source):
+        """Whether ``conn``'s sender may have ``source`` copied: senders on this
+        host may offer any file, others only files under a shared mount"""
+        if self._is_local_peer(conn):
+            return True
+        real = os.path.realpath(source)
+        for mount in self.shared_mounts:
+            try:
+                if os.path.commonpath([real, mount]) == mount:
+                    return True
+            except ValueError:
+                continue
+        return False
+
+    def _peer_host(self, conn):
+        try:
+            return conn.getpeername()[0]
+        except Exception:
+            return None
+
+    def _admit(self, conn, needed):
+        """Check that ``needed`` more bytes fit on disk and in the peer's quota.
+
+        Returns 0 and reserves the bytes against the peer's quota, or a
+        REJECT_* code.
+        """
+        try:
+            free = shutil.disk_usage(self.output_dir).free
+        except OSError:
+            free = None
+        if free is not None and needed > free - self.min_free:
+            return self.REJECT_NO_SPACE
+        if self.peer_quota is not None:
+            peer = self._peer_host(conn)
+            with self._quota_lock:
+                used = self._peer_usage.get(peer, 0)
+                if used + needed > self.peer_quota:
+                    return self.REJECT_QUOTA
+                self._peer_usage[peer] = used + needed
+                self._reservations[id(conn)] = (peer, needed)
+        return 0
+
+    def _settle_quota(self, conn, completed):
+        with self._quota_lock:
+            reservation = self._reservations.pop(id(conn), None)
+            if reservation is not None and not completed:
+                peer, size = reservation
+                self._peer_usage[peer] = max(0, self._peer_usage.get(peer, 0) - size)
+
+    def _reject(self, conn, code, what, batch=False):
+        """Refuse a transfer: REJECTED and the code in place of the offset reply,
+        or just the code (``batch``: the status of an announced batch, or after
+        an empty algorithm name in the integrity negotiation)."""
+        reason = {self.REJECT_NO_SPACE: 'not enough disk space',
+                  self.REJECT_QUOTA: 'peer quota exceeded',
+                  self.REJECT_INTEGRITY: 'none of the integrity algorithms is accepted',
+                  self.REJECT_BUSY: 'already being received'}.get(code, f'code {code}')
+        print(f"Rejected {what} from {self._peer_host(conn)}: {reason}")
+        if batch:
+            conn.sendall(struct.pack('!I', code))
+        else:
+            conn.sendall(struct.pack('!QI', self.REJECTED, code))
+
+    def _receive_files_tree(self, conn):
+        """Resumable single file verified with a tree hash (magic 0xFFFF0007).
+
+        Protocol (client -> server):
+        - leaf_size (4 bytes !I, see hashing.valid_leaf_size)
+        - the resumable header, with the tree root digest in place of sha256
+        The rest is the resumable protocol; leaves are hashed on every core.
+        """
+        leaf_data = self._recv_exact(conn, 4)
+        if not leaf_data:
+            return None
+        leaf_size = struct.unpack('!I', leaf_data)[0]
+        if not valid_leaf_size(leaf_size):
+            print(f"Tree hash transfer refused: invalid leaf size {leaf_size}")
+            return None
+        return self._receive_files_resumable_single(conn, TreeHash(leaf_size))
+
+    def _receive_files_negotiated(self, conn):
+        """Resumable single file with an agreed integrity algorithm (magic 0xFFFF0008).
+
+        Protocol:
+        - client: count (1 byte !B), then per algorithm name_len (1 byte !B)
+          + name (ascii), in the sender's order of preference
+        - server: name_len (1 byte !B) + name of the first one it accepts;
+          name_len 0 refuses the transfer, followed by a REJECT_* code
+          (4 bytes !I, REJECT_INTEGRITY)
+        - client: digest_len (1 byte !B), then the resumable header with a
+          digest of that length (empty for 'none')
+        The rest is the resumable protocol.
+        """
+        count_data = self._recv_exact(conn, 1)
+        if not count_data:
+            return None
+        offered = []
+        for _ in range(count_data[0]):
+            name_len = self._recv_exact(conn, 1)
+            name = self._recv_exact(conn, name_len[0]) if name_len else None
+            if name is None:
+                return None
+            offered.append(name.decode('ascii', 'replace'))
+        chosen = next((name for name in offered if name in self.integrity), None)
+        if chosen is None:
+            conn.sendall(struct.pack('!B', 0))  # no name: the code follows
+            self._reject(conn, self.REJECT_INTEGRITY, f"transfer offering {', '.join(offered)}", batch=True)
+            return None
+        conn.sendall(struct.pack('!B', len(chosen)) + chosen.encode('ascii'))
+
+        hasher = new_hasher(chosen)
+        digest_len = self._recv_exact(conn, 1)
+        if not digest_len or digest_len[0] != hasher.digest_size:
+            return None
+        return self._receive_files_resumable_single(conn, hasher, hasher.digest_size)
 
-    def _receive_files_resumable_single(self, conn):
+    def _receive_files_resumable_single(self, conn, hasher=None, digest_size=32):
         """Receive a single file with resume support.
 
         Protocol (client -> server):
@@ -72,78 +393,63 @@ class TransferServer:
         - sha256 (32 bytes raw)
         Server replies with current_offset (8 bytes !Q).
         Client then sends remaining bytes starting at offset. After full transfer,
-        server verifies SHA256 and replies b'OK' or b'ER'.
+        server verifies SHA256 (or ``hasher``'s digest, ``digest_size`` bytes)
+        and replies b'OK' or b'ER'.
         """
+        if hasher is None:
+            hasher = hashlib.sha256()
         try:
-            # Receive filename length
-            filename_len_data = self._recv_exact(conn, 4)
-            if not filename_len_data:
-                return None
-            filename_len = struct.unpack('!I', filename_len_data)[0]
-
-            # Receive filename
-            filename_data = self._recv_exact(conn, filename_len)
-            if not filename_data:
-                return None
-            filename = filename_data.decode('utf-8')
-
-            # Receive filesize
-            filesize_data = self._recv_exact(conn, 8)
-            if not filesize_data:
-                return None
-            filesize = struct.unpack('!Q', filesize_data)[0]
-
-            # Receive chunk_size
-            chunk_size_data = self._recv_exact(conn, 4)
-            if not chunk_size_data:
-                return None
-            chunk_size = struct.unpack('!I', chunk_size_data)[0]
-
-            # Receive expected sha256 (32 bytes)
-            sha256_data = self._recv_exact(conn, 32)
-            if not sha256_data:
+            header = self._read_resumable_header(conn, digest_size)
+            if not header:
                 return None
-            expected_digest = sha256_data  # raw bytes
-
-
+            filename, filesize, chunk_size, expected_digest = header
+            chunk = self._chunk_for(chunk_size)
 
             # Prepare output paths
             output_path = self.output_dir / filename
             output_path.parent.mkdir(parents=True, exist_ok=True)
             partial_path = output_path.with_suffix(output_path.suffix + '.partial')
+            if not self._claim_partial(conn, partial_path, filename):
+                return None
+            offset = self._resume_offset(partial_path, filesize)
 
-            # If partial file exists but is larger than expected, remove it
-            offset = 0
-            if partial_path.exists():
-                try:
-                    existing_size = partial_path.stat().st_size
-                    if existing_size > filesize:
-                        partial_path.unlink()
-                    else:
-                        offset = existing_size
-                except Exception:
-                    offset = 0
+            code = self._admit(conn, filesize - offset)
+            if code:
+                self._reject(conn, code, filename)
+                return None
+
+            # Reserve the disk space before accepting data (fails now on a full disk)
+            try:
+                writer = BlockWriter(partial_path, filesize, offset, bulk=self.bulk)
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                self._reject(conn, self.REJECT_NO_SPACE, filename)
+                return None
 
             # Send current offset to client
             try:
                 conn.sendall(struct.pack('!Q', offset))
             except Exception:
+                writer.close()
                 return None
 
-            # Open partial file for append and receive remaining bytes
+            # Receive remaining bytes into the partial file; the writer thread
+            # hashes as it writes, so the file is not read back afterwards
             received = offset
-            with open(partial_path, 'ab') as f:
+            # An empty digest ('none') is not computed at all
+            with self._pipeline(writer, hasher if digest_size else None, offset, conn, chunk) as f:
+                tuner = ChunkTuner(conn, chunk, self.max_chunk, adaptive=False, send=False)
+                throttle = self._throttles[id(conn)]
                 start_time = time.time()
-                last_report = start_time
-                last_bytes = received
                 while received < filesize:
-                    to_read = min(self.BUFFER_SIZE, filesize - received)
-                    data = conn.recv(to_read)
-                    if not data:
+                    n = f.recv_from(conn, throttle.max_send(filesize - received))
+                    if not n:
                         # Connection closed unexpectedly; leave partial file
                         break
-                    f.write(data)
-                    received += len(data)
+                    received += n
+                    tuner.record(n)
+                    throttle.pace(n)
 
                     # Report progress via callback if available
                     try:
@@ -163,15 +469,7 @@ class TransferServer:
             if received < filesize:
                 return None
 
-            # Compute SHA256 of partial file
-            h = hashlib.sha256()
-            with open(partial_path, 'rb') as f:
-                while True:
-                    chunk = f.read(65536)
-                    if not chunk:
-                        break
-                    h.update(chunk)
-            digest = h.digest()
+            digest = f.digest() if digest_size else b''
 
             if digest == expected_digest:
                 # Rename partial to final filename (overwrite if exists)
@@ -179,6 +477,7 @@ class TransferServer:
                     if output_path.exists():
                         output_path.unlink()
                     partial_path.replace(output_path)
+                    self._make_durable(output_path)
                 except Exception as e:
                     print(f"Error renaming partial file: {e}")
                     conn.sendall(b'ER')
@@ -188,7 +487,7 @@ class TransferServer:
                 conn.sendall(b'OK')
                 return filename, filesize
             else:
-                print("SHA256 mismatch: transfer corrupted")
+                print(f"{hasher.name.upper()} mismatch: transfer corrupted")
                 conn.sendall(b'ER')
                 # leave partial file for inspection/resume
                 return None
@@ -197,23 +496,553 @@ class TransferServer:
             print(f"\nError receiving resumable file: {e}")
             return None
 
-    def _receive_files_multi(self, conn):
-        """Receive multiple files using multi-file protocol"""
+    def _receive_files_sparse(self, conn):
+        """Receive a sparse file as data extents and recreate its holes.
+
+        Protocol: see TransferClient._send_sparse_internal. Resumes like the
+        resumable protocol: the ``.partial`` file's size (holes included) is
+        the offset, and the digest is recomputed from the file on disk.
+        """
+        try:
+            name_len = self._recv_exact(conn, 4)
+            if not name_len:
+                return None
+            filename = self._recv_exact(conn, struct.unpack('!I', name_len)[0]).decode('utf-8')
+            filesize, data_bytes = struct.unpack('!QQ', self._recv_exact(conn, 16))
+            expected_digest = self._recv_exact(conn, 32)
+
+            output_path = self.output_dir / filename
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            partial_path = output_path.with_suffix(output_path.suffix + '.partial')
+            if not self._claim_partial(conn, partial_path, filename):
+                return None
+            offset = self._resume_offset(partial_path, filesize)
+            # Only the data needs space; the layout of the holes is not known yet
+            code = self._admit(conn, data_bytes)
+            if code:
+                self._reject(conn, code, filename)
+                return None
+            try:
+                writer = BlockWriter(partial_path, filesize, offset, reserve=data_bytes, bulk=self.bulk)
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                self._reject(conn, self.REJECT_NO_SPACE, filename)
+                return None
+            try:
+                conn.sendall(struct.pack('!Q', offset))
+            except Exception:
+                writer.close()
+                return None
+
+            print(f"Receiving sparse file: {filename} ({self._format_size(filesize)}, "
+                  f"{self._format_size(data_bytes)} of data)")
+            complete = False
+            throttle = self._throttles[id(conn)]
+            with self._pipeline(writer) as f:
+                start_time = time.time()
+                while not complete:
+                    record = self._recv_exact(conn, 16)
+                    if not record:
+                        break
+                    extent_offset, length = struct.unpack('!QQ', record)
+                    if extent_offset < f.position or extent_offset + length > filesize:
+                        raise ValueError(f"Invalid extent {extent_offset}+{length} at {f.position}")
+                    f.skip(extent_offset - f.position)
+                    if length == 0:
+                        complete = f.position == filesize
+                        break
+                    remaining = length
+                    while remaining > 0:
+                        n = f.recv_from(conn, throttle.max_send(remaining))
+                        if not n:
+                            break
+                        throttle.pace(n)
+                        remaining -= n
+                    if remaining:
+                        break  # connection closed; keep the partial file for resume
+
+                    try:
+                        elapsed = time.time() - start_time
+                        speed = (f.position - offset) / elapsed if elapsed > 0 else 0
+                        eta = int((filesize - f.position) / speed) if speed > 0 else None
+                        if self.progress_callback:
+                            try:
+                                self.progress_callback(f.position, filesize, speed, eta, filename)
+                            except Exception:
+                                pass
+                    except Exception:
+                        pass
+
+            if not complete:
+                return None
+
+            if sparse_digest(partial_path) != expected_digest:
+                print("Sparse digest mismatch: transfer corrupted")
+                conn.sendall(b'ER')
+                return None
+            try:
+                if output_path.exists():
+                    output_path.unlink()
+                partial_path.replace(output_path)
+                self._make_durable(output_path)
+            except Exception as e:
+                print(f"Error renaming partial file: {e}")
+                conn.sendall(b'ER')
+                return None
+
+            print(f"File saved to: {output_path.absolute()}")
+            conn.sendall(b'OK')
+            return filename, filesize
+
+        except Exception as e:
+            print(f"\nError receiving sparse file: {e}")
+            return None
+
+    def _receive_files_offload(self, conn):
+        """Complete a transfer by copying the sender's file from shared storage.
+
+        Protocol (client -> server):
+        - filename_len (4 bytes !I) + filename (utf-8)
+        - path_len (4 bytes !I) + sender's absolute path (utf-8)
+        - st_dev, st_ino, st_size, st_mtime_ns (4 x 8 bytes !QQQQ)
+        - sha256 of the file (32 bytes)
+        The offer is accepted only from a sender on this host or for a path
+        under one of shared_mounts, and only if the path seen here has the
+        same inode, size and mtime (st_dev differs between NFS clients, so
+        it is not compared). The file is reflinked, copied with
+        copy_file_range or, if allowed, hardlinked, and the copy must match
+        the sha256. Server replies b'OK' when the file is in place, b'NO' if
+        the client should stream it instead.
+        """
+        reply = b'NO'
+        try:
+            name_len = self._recv_exact(conn, 4)
+            if not name_len:
+                return None
+            filename = self._recv_exact(conn, struct.unpack('!I', name_len)[0]).decode('utf-8')
+            path_len = self._recv_exact(conn, 4)
+            source = self._recv_exact(conn, struct.unpack('!I', path_len)[0]).decode('utf-8')
+            _, ino, size, mtime_ns = struct.unpack('!QQQQ', self._recv_exact(conn, 32))
+            expected_digest = self._recv_exact(conn, 32)
+
+            if not self.copy_offload or not self._may_offload(conn, source):
+                return None
+
+            fingerprint = (ino, size, mtime_ns)
+            try:
+                st = os.stat(source)
+            except OSError:
+                return None
+            if (st.st_ino & 0xFFFFFFFFFFFFFFFF, st.st_size, st.st_mtime_ns) != fingerprint:
+                return None
+
+            output_path = self.output_dir / filename
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = output_path.with_suffix(output_path.suffix + '.offload')
+            method = self._offload_copy(source, temp_path, size)
+            if method is None:
+                return None
+
+            # The source must not have changed while it was being copied
+            st = os.stat(source)
+            if (st.st_ino & 0xFFFFFFFFFFFFFFFF, st.st_size, st.st_mtime_ns) != fingerprint \
+                    or temp_path.stat().st_size != size or self._file_sha256(temp_path) != expected_digest:
+                print(f"Copy offload of {filename} failed verification")
+                temp_path.unlink()
+                return None
+            temp_path.replace(output_path)
+            self._make_durable(output_path)
+
+            if self.progress_callback:
+                try:
+                    self.progress_callback(size, size, None, 0, filename)
+                except Exception:
+                    pass
+            print(f"File saved to: {output_path.absolute()} ({method} from shared storage)")
+            reply = b'OK'
+            return filename, size
+        except Exception as e:
+            print(f"\nError during copy offload: {e}")
+            return None
+        finally:
+            try:
+                conn.sendall(reply)
+            except Exception:
+                pass
+
+    def _file_sha256(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        return sha.digest()
+
+    def _offload_copy(self, source, dest, size):
+        """Copy ``source`` to ``dest`` without moving data through the process.
+
+        Tries a reflink, then copy_file_range, then (if allowed) a hardlink.
+        Returns the method used, or None if none applied.
+        """
+        if fcntl is not None and sys.platform.startswith('linux'):
+            try:
+                with open(source, 'rb') as src, open(dest, 'wb') as dst:
+                    fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+
+        if hasattr(os, 'copy_file_range'):
+            try:
+                with open(source, 'rb') as src, open(dest, 'wb') as dst:
+                    remaining = size
+                    while remaining > 0:
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(), min(remaining, 1 << 30))
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                if remaining == 0:
+                    return 'copy_file_range'
+            except OSError:
+                pass
+
+        if self.allow_hardlink:
+            try:
+                if os.path.lexists(dest):
+                    os.unlink(dest)
+                os.link(source, dest)
+                return 'hardlink'
+            except OSError:
+                pass
+
         try:
-            # Read number of files
-            file_count_data = self._recv_exact(conn, 4)
-            if not file_count_data:
+            os.unlink(dest)
+        except OSError:
+            pass
+        return None
+
+    def _receive_files_relay(self, conn):
+        """Receive a file and forward it cut-through to the next relay hop.
+
+        Protocol (client -> server):
+        - hop_count (4 bytes !I)
+        - for each remaining hop: hop_len (4 bytes !I) + "host:port" (utf-8)
+        - the resumable header (see _receive_files_resumable_single)
+        The server connects to the first reachable hop and hands it the rest
+        of the chain, then replies min(local offset, downstream offset) so one
+        upstream stream can resume every hop. Each block is forwarded before it
+        is written locally. The final b'OK' is sent only when the local copy
+        and the whole downstream chain verified; otherwise b'ER'.
+        """
+        downstream = None
+        try:
+            hop_count_data = self._recv_exact(conn, 4)
+            if not hop_count_data:
+                return None
+            hop_count = struct.unpack('!I', hop_count_data)[0]
+            hops = []
+            for _ in range(hop_count):
+                hop_len_data = self._recv_exact(conn, 4)
+                if not hop_len_data:
+                    return None
+                hop_data = self._recv_exact(conn, struct.unpack('!I', hop_len_data)[0])
+                if not hop_data:
+                    return None
+                hops.append(hop_data.decode('utf-8'))
+
+            header = self._read_resumable_header(conn)
+            if not header:
+                return None
+            filename, filesize, chunk_size, expected_digest = header
+            chunk = self._chunk_for(chunk_size)
+
+            if hops and not self.relay:
+                print("Relay request refused: relay mode is disabled on this receiver")
+                return None
+
+            output_path = self.output_dir / filename
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            partial_path = output_path.with_suffix(output_path.suffix + '.partial')
+            if not self._claim_partial(conn, partial_path, filename):
+                return None
+            local_offset = self._resume_offset(partial_path, filesize)
+
+            code = self._admit(conn, filesize - local_offset)
+            if code:
+                self._reject(conn, code, filename)
+                return None
+
+            downstream, down_offset = self._connect_next_hop(hops, header)
+            if downstream is None:
+                down_offset = filesize  # end of chain: nothing to forward
+            downstream_ok = downstream is not None or not hops
+
+            offset = min(local_offset, down_offset)
+            try:
+                writer = BlockWriter(partial_path, filesize, local_offset, bulk=self.bulk)
+            except OSError as e:
+                if downstream is not None:
+                    downstream.close()
+                    downstream = None
+                if e.errno != errno.ENOSPC:
+                    raise
+                self._reject(conn, self.REJECT_NO_SPACE, filename)
+                return None
+            conn.sendall(struct.pack('!Q', offset))
+
+            received = offset
+            with self._pipeline(writer, hashlib.sha256(), local_offset, chunk=chunk) as f:
+                tuner = ChunkTuner(conn, chunk, self.max_chunk, adaptive=False, send=False)
+                throttle = self._throttles[id(conn)]
+                start_time = time.time()
+                while received < filesize:
+                    to_read = min(max(io_size(conn, self.BUFFER_SIZE), chunk), filesize - received)
+                    data = conn.recv(throttle.max_send(to_read))
+                    if not data:
+                        # Connection closed unexpectedly; leave partial file
+                        break
+                    tuner.record(len(data))
+                    throttle.pace(len(data))
+                    end = received + len(data)
+                    # Cut-through: forward first so the next hop is never waiting on our disk
+                    if downstream is not None and end > down_offset:
+                        try:
+                            downstream.sendall(data[max(0, down_offset - received):])
+                        except OSError as e:
+                            print(f"Relay: next hop failed: {e}")
+                            downstream.close()
+                            downstream = None
+                            downstream_ok = False
+                    if end > local_offset:
+                        f.write(data[max(0, local_offset - received):])
+                    received = end
+
+                    try:
+                        elapsed = time.time() - start_time
+                        speed = (received - offset) / elapsed if elapsed > 0 else 0
+                        eta = int((filesize - received) / speed) if speed > 0 else None
+                        if self.progress_callback:
+                            try:
+                                self.progress_callback(received, filesize, speed, eta, filename)
+                            except Exception:
+                                pass
+                    except Exception:
+                        pass
+
+            if received < filesize:
                 return None
-            file_count = struct.unpack('!I', file_count_data)[0]
+
+            local_ok = f.digest() == expected_digest
+            if local_ok:
+                try:
+                    if output_path.exists():
+                        output_path.unlink()
+                    partial_path.replace(output_path)
+                    ticket = self.durability.commit(output_path)
+                    print(f"File saved to: {output_path.absolute()}")
+                except Exception as e:
+                    print(f"Error renaming partial file: {e}")
+                    local_ok = False
+            else:
+                print("SHA256 mismatch: transfer corrupted")
+
+            if downstream is not None:
+                downstream.settimeout(ack_timeout(self.stall_timeout, filesize))
+                ack = self._recv_exact(downstream, 2)
+                downstream_ok = ack == b'OK'
+                if not downstream_ok:
+                    print("Relay: downstream chain reported an error")
+
+            if local_ok:
+                try:
+                    self.durability.wait(ticket)
+                except OSError as e:
+                    print(f"Error syncing {filename}: {e}")
+                    local_ok = False
+
+            if local_ok and downstream_ok:
+                conn.sendall(b'OK')
+                return filename, filesize
+            conn.sendall(b'ER')
+            return None
+
+        except Exception as e:
+            print(f"\nError receiving relayed file: {e}")
+            return None
+        finally:
+            if downstream is not None:
+                try:
+                    downstream.close()
+                except Exception:
+                    pass
+
+    def _connect_next_hop(self, hops, header):
+        """Open a relay session with the first reachable hop in ``hops``.
+
+        Unreachable hops are skipped so one dead machine does not break the
+        chain. Returns (socket, downstream_offset) or (None, None).
+        """
+        filename, filesize, chunk_size, digest = header
+        for i, hop in enumerate(hops):
+            host, _, port = hop.rpartition(':')
+            sock = None
+            try:
+                sock = socket.create_connection((host, int(port)), timeout=self.RELAY_CONNECT_TIMEOUT)
+                tune_socket(sock)
+                rest = hops[i + 1:]
+                parts = [struct.pack('!I', 0xFFFF0004), struct.pack('!I', len(rest))]
+                for h in rest:
+                    h_encoded = h.encode('utf-8')
+                    parts.append(struct.pack('!I', len(h_encoded)))
+                    parts.append(h_encoded)
+                filename_encoded = filename.encode('utf-8')
+                parts.append(struct.pack('!I', len(filename_encoded)))
+                parts.append(filename_encoded)
+                parts.append(struct.pack('!QI', filesize, chunk_size))
+                parts.append(digest)
+                sock.sendall(b''.join(parts))
+                offset_data = self._recv_exact(sock, 8)
+                if not offset_data:
+                    raise ConnectionError("no offset reply")
+                if struct.unpack('!Q', offset_data)[0] == self.REJECTED:
+                    code = self._recv_exact(sock, 4)
+                    raise ConnectionError(f"transfer rejected (code {struct.unpack('!I', code)[0] if code else '?'})")
+                sock.settimeout(self.stall_timeout or None)
+                print(f"Relay: forwarding {filename} to {hop}")
+                return sock, struct.unpack('!Q', offset_data)[0]
+            except (OSError, ValueError, ConnectionError) as e:
+                print(f"Relay: skipping unreachable hop {hop}: {e}")
+                if sock is not None:
+                    sock.close()
+        return None, None
+
+    def _read_resumable_header(self, conn, digest_size=32):
+        """Read the resumable header that follows the magic.
+
+        Returns (filename, filesize, chunk_size, sha256) or None; the digest
+        is ``digest_size`` bytes long.
+        """
+        # Receive filename length
+        filename_len_data = self._recv_exact(conn, 4)
+        if not filename_len_data:
+            return None
+        filename_len = struct.unpack('!I', filename_len_data)[0]
+
+        # Receive filename
+        filename_data = self._recv_exact(conn, filename_len)
+        if not filename_data:
+            return None
+        filename = filename_data.decode('utf-8')
+
+        # Receive filesize
+        filesize_data = self._recv_exact(conn, 8)
+        if not filesize_data:
+            return None
+        filesize = struct.unpack('!Q', filesize_data)[0]
+
+        # Receive chunk_size
+        chunk_size_data = self._recv_exact(conn, 4)
+        if not chunk_size_data:
+            return None
+        chunk_size = struct.unpack('!I', chunk_size_data)[0]
+
+        # Receive expected sha256 (32 bytes, or digest_size)
+        sha256_data = self._recv_exact(conn, digest_size)
+        if sha256_data is None:
+            return None
+        return filename, filesize, chunk_size, sha256_data
+
+    def _pipeline(self, writer, hasher=None, hash_existing=0, conn=None, chunk=None):
+        """Run disk writes (and hashing) for ``writer`` on a separate thread.
+
+        If ``conn`` is given and can be spliced and nothing is hashed, payload
+        goes from the socket to the file inside the kernel instead; a hashed
+        transfer keeps the pipeline, which hashes the bytes as it writes them.
+        Pipeline buffers are ``chunk`` bytes (at least the default size);
+        larger buffers mean fewer of them, within pipeline_depth MiB.
+        """
+        if conn is not None and hasher is None and self.zero_copy and SpliceWriter.supported(conn):
+            return SpliceWriter(writer)
+        size = max(chunk or 0, PipelinedWriter.BUFFER_SIZE)
+        depth = max(2, self.pipeline_depth * PipelinedWriter.BUFFER_SIZE // size)
+        return PipelinedWriter(writer, depth=depth, buffer_size=size, hasher=hasher,
+                               hash_existing=hash_existing)
+
+    def _chunk_for(self, requested):
+        """The chunk size to use for a sender that asked for ``requested`` bytes"""
+        return clamp_chunk(requested or DEFAULT_CHUNK, self.max_chunk)
+
+    def _make_durable(self, path):
+        """Block until ``path`` is on stable storage as the durability policy requires"""
+        self.durability.wait(self.durability.commit(path))
+
+    def _resume_offset(self, partial_path, filesize):
+        """Return how many bytes of ``partial_path`` can be reused for resume."""
+        # If partial file exists but is larger than expected, remove it
+        offset = 0
+        if partial_path.exists():
+            try:
+                existing_size = partial_path.stat().st_size
+                if existing_size > filesize:
+                    partial_path.unlink()
+                else:
+                    offset = existing_size
+            except Exception:
+                offset = 0
+        return offset
+
+    def _receive_files_batch(self, conn):
+        """Multi-file protocol with the batch size announced up front.
+
+        Protocol (client -> server):
+        - file_count (4 bytes !I), total_size (8 bytes !Q)
+        Server replies a status (4 bytes !I): 0 to accept, then the files
+        follow as in the multi-file protocol, or a REJECT_* code.
+        """
+        header = self._recv_exact(conn, 12)
+        if not header:
+            return None
+        file_count, total_size = struct.unpack('!IQ', header)
+        code = self._admit(conn, total_size)
+        if code:
+            self._reject(conn, code, f"batch of {file_count} file(s)", batch=True)
+            return None
+        conn.sendall(struct.pack('!I', 0))
+        return self._receive_files_multi(conn, file_count)
+
+    def _receive_files_multi(self, conn, file_count=None):
+        """Receive multiple files using multi-file protocol"""
+        try:
+            # Read number of files (already known for an announced batch)
+            if file_count is None:
+                file_count_data = self._recv_exact(conn, 4)
+                if not file_count_data:
+                    return None
+                file_count = struct.unpack('!I', file_count_data)[0]
             print(f"Receiving {file_count} file(s)...")
             
+            # Files land in a staging directory and only appear in output_dir
+            # once the whole batch has arrived
             received_files = []
-            for i in range(file_count):
-                result = self._receive_single_file(conn, file_index=i+1, total_files=file_count)
-                if result:
+            with StagingArea(self.output_dir) as staging:
+                for i in range(file_count):
+                    result = self._receive_single_file(conn, file_index=i+1, total_files=file_count,
+                                                       staging=staging)
+                    if not result:
+                        break  # the stream is out of step; nothing more can be read
                     received_files.append(result)
-            
-            # Send acknowledgment
+                if len(received_files) < file_count:
+                    print("Incomplete batch: discarding received files")
+                    return None
+                paths = staging.commit()
+
+            # Acknowledge once the files are as durable as the policy requires
+            try:
+                self.durability.wait(*[self.durability.commit(p) for p in paths])
+            except OSError as e:
+                print(f"Error syncing received files: {e}")
+                conn.sendall(b'ER')
+                return None
             conn.sendall(b'OK')
             
             return received_files[0] if received_files else None
@@ -222,6 +1051,260 @@ class TransferServer:
             print(f"\nError receiving multiple files: {e}")
             return None
 
+    def _receive_files_mux(self, conn):
+        """Files interleaved on stream frames (magic 0xFFFF0011, see mux.py).
+
+        Protocol (client -> server):
+        - file_count (4 bytes !I), total_size (8 bytes !Q)
+        Server replies a status (4 bytes !I) as for a batch; frames follow.
+        Unlike a batch, each file goes to output_dir as soon as its END
+        frame checks out and is acknowledged on its own (ACK once durable),
+        so small files are usable while a large one is still arriving.
+        Failed or cancelled streams are dropped with their .partial file.
+        A paused session is parked without a thread (see _park).
+        """
+        header = self._recv_exact(conn, 12)
+        if not header:
+            return None
+        file_count, total_size = struct.unpack('!IQ', header)
+        code = self._admit(conn, total_size)
+        if code:
+            self._reject(conn, code, f"batch of {file_count} file(s)", batch=True)
+            return None
+        conn.sendall(struct.pack('!I', 0))
+        print(f"Receiving {file_count} file(s) on multiplexed streams...")
+        return self._mux_serve(conn, mux.ReceiveSession(file_count))
+
+    def _mux_serve(self, conn, session):
+        """Handle the frames of ``session``; its result, or mux.PARKED once it is parked"""
+        streams = session.streams
+        throttle = self._throttles[id(conn)]
+        parked = False
+        try:
+            while True:
+                received = mux.read_frame(lambda size: mux.recv_exact(conn, size), self.max_chunk)
+                if received is None:
+                    return None
+                kind, _, sid, payload = received
+                if kind == mux.OPEN:
+                    self._mux_open(conn, streams, sid, payload)
+                elif kind == mux.DATA:
+                    throttle.pace(len(payload))
+                    stream = streams.get(sid)
+                    credit = b''
+                    if stream is not None:
+                        try:
+                            if stream['writer'] is None:  # closed while the sender was paused
+                                stream['writer'] = BlockWriter(stream['partial'], stream['size'], stream['received'],
+                                                               bulk=self.bulk)
+                            stream['writer'].write(payload)
+                        except OSError as e:
+                            code = self.REJECT_NO_SPACE if e.errno == errno.ENOSPC else 0
+                            print(f"\nError writing {stream['name']}: {e}")
+                            self._mux_drop(conn, streams, sid, code)
+                        else:
+                            stream['sha'].update(payload)
+                            stream['received'] += len(payload)
+                            self._mux_progress(stream)
+                            increment = stream['credit'].consume(len(payload))
+                            if increment:
+                                credit += mux.frame(mux.WINDOW, sid, 4) + struct.pack('!I', increment)
+                    # Data of dropped streams still used the connection window
+                    increment = session.credit.consume(len(payload))
+                    if increment:
+                        credit += mux.frame(mux.WINDOW, 0, 4) + struct.pack('!I', increment)
+                    if credit:
+                        conn.sendall(credit)
+                elif kind == mux.END:
+                    result = self._mux_finish(conn, streams, sid, payload)
+                    if result:
+                        session.received_files.append(result[0])
+                        session.unacked.append((sid, result[1]))
+                elif kind == mux.CANCEL:
+                    if sid == 0:
+                        print(f"\nTransfer cancelled by the sender; discarding {len(streams)} unfinished file(s)")
+                        return None
+                    self._mux_drop(conn, streams, sid)
+                elif kind == mux.GOAWAY:
+                    self._mux_ack(conn, session.unacked, block=True)
+                    print(f"\n{len(session.received_files)} of {session.file_count} file(s) received")
+                    return session.received_files[0] if session.received_files else None
+                elif kind == mux.PAUSE:
+                    # Give back the open files now; DATA after RESUME reopens them
+                    session.paused = True
+                    self._mux_ack(conn, session.unacked, block=True)
+                    for stream in streams.values():
+                        if stream['writer'] is not None:
+                            stream['writer'].close()
+                            stream['writer'] = None
+                    print("\nSender paused")
+                    if self._park(conn, session):
+                        parked = True
+                        return mux.PARKED
+                    self._set_timeout(conn, mux.PARK_TIMEOUT)
+                elif kind == mux.RESUME:
+                    session.paused = False
+                    self._set_timeout(conn, self.stall_timeout or None)
+                    print("\nSender resumed")
+                elif kind == mux.PING and session.paused and self._park(conn, session):
+                    parked = True
+                    return mux.PARKED
+                # Acknowledge files whose sync is done; once no stream is open the
+                # sender is only waiting for ACKs, so wait for the syncs
+                self._mux_ack(conn, session.unacked, block=not streams)
+        except Exception as e:
+            print(f"\nError receiving multiplexed files: {e}")
+            return None
+        finally:
+            if not parked:
+                for sid in list(streams):
+                    self._mux_drop(conn, streams, sid, notify=False)
+
+    def _park(self, conn, session):
+        """Take a paused session off its thread until its sender speaks again.
+
+        The socket waits in the ParkingLot and the thread (a worker slot on
+        a concurrent server) returns; the next frame hands the session to
+        a thread again through _dispatch. Sessions on transports that
+        cannot be watched stay on their thread; returns False for those.
+        """
+        if not mux.ParkingLot.supports(conn):
+            return False
+        with self._quota_lock:
+            if self._parking is None:
+                self._parking = mux.ParkingLot()
+        # A paused session takes no share of the rate limits
+        self._throttles.pop(id(conn)).close()
+        self._parking.park(conn, lambda: self._dispatch(self._unpark, conn, session),
+                           lambda: self._dispatch(self._unpark, conn, session, True))
+        return True
+
+    def _unpark(self, conn, session, expired=False):
+        """Continue a parked session on this thread, or drop it if it went silent"""
+        result = None
+        self._throttles[id(conn)] = self.rate_limiter.transfer(self._peer_host(conn))
+        try:
+            if expired:
+                print(f"\nDropping a paused transfer silent for {self._parking.timeout} seconds")
+                for sid in list(session.streams):
+                    self._mux_drop(conn, session.streams, sid, notify=False)
+                return None
+            result = self._mux_serve(conn, session)
+            return result
+        finally:
+            if result is not mux.PARKED:
+                self._end_connection(conn, result)
+
+    def _dispatch(self, function, *args):
+        """Run ``function(*args)`` on a thread of its own.
+
+        Used for accepted connections and woken sessions; WorkerPool points
+        it at its thread pool instead.
+        """
+        threading.Thread(target=function, args=args, daemon=True).start()
+
+    def _set_timeout(self, conn, timeout):
+        if hasattr(conn, 'settimeout'):
+            conn.settimeout(timeout)
+
+    def _mux_open(self, conn, streams, sid, payload):
+        filesize = struct.unpack('!Q', payload[:8])[0]
+        filename = bytes(payload[8:]).decode('utf-8')
+        output_path = self.output_dir / filename
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path = output_path.with_suffix(output_path.suffix + '.partial')
+        if sid in streams or not self._partial_locks.acquire(partial_path, (id(conn), sid)):
+            print(f"Rejected {filename} from {self._peer_host(conn)}: already being received")
+            conn.sendall(mux.frame(mux.CANCEL, sid, 4) + struct.pack('!I', self.REJECT_BUSY))
+            return
+        stream = {'name': filename, 'size': filesize, 'output': output_path, 'partial': partial_path,
+                  'writer': None, 'sha': hashlib.sha256(), 'received': 0, 'start': time.time(),
+                  'credit': mux.Credit(mux.STREAM_WINDOW)}
+        streams[sid] = stream
+        try:
+            stream['writer'] = BlockWriter(partial_path, filesize, bulk=self.bulk)
+        except OSError as e:
+            print(f"Error receiving {filename}: {e}")
+            self._mux_drop(conn, streams, sid, self.REJECT_NO_SPACE if e.errno == errno.ENOSPC else 0)
+            return
+        print(f"\n[stream {sid}] Receiving: {filename} ({self._format_size(filesize)})")
+
+    def _mux_progress(self, stream):
+        if not self.progress_callback:
+            return
+        try:
+            elapsed = time.time() - stream['start']
+            speed = stream['received'] / elapsed if elapsed > 0 else 0
+            eta = int((stream['size'] - stream['received']) / speed) if speed > 0 else None
+            self.progress_callback(stream['received'], stream['size'], speed, eta, stream['name'])
+        except Exception:
+            pass
+
+    def _mux_finish(self, conn, streams, sid, digest):
+        """Verify a stream and move its file into place; (result, ticket) or None"""
+        stream = streams.pop(sid, None)
+        if stream is None:
+            return None
+        ok = False
+        try:
+            if stream['writer'] is not None:  # None: already closed by a PAUSE
+                stream['writer'].close()
+            if stream['received'] != stream['size']:
+                print(f"\n{stream['name']}: {stream['received']} of {stream['size']} bytes received")
+            elif stream['sha'].digest() != bytes(digest):
+                print(f"\n{stream['name']}: SHA256 mismatch: transfer corrupted")
+            else:
+                stream['partial'].replace(stream['output'])
+                ok = True
+        except Exception as e:
+            print(f"\nError saving {stream['name']}: {e}")
+        finally:
+            self._partial_locks.release((id(conn), sid))
+        if not ok:
+            self._discard(stream['partial'])
+            conn.sendall(mux.frame(mux.ACK, sid, 2) + b'ER')
+            return None
+        print(f"\nFile saved to: {stream['output'].absolute()}")
+        return (stream['name'], stream['size']), self.durability.commit(stream['output'])
+
+    def _mux_ack(self, conn, unacked, block=False):
+        """ACK the files in ``unacked`` whose sync is done (all of them with ``block``)"""
+        for sid, ticket in list(unacked):
+            if not block and not self.durability.done(ticket):
+                continue
+            try:
+                self.durability.wait(ticket)
+                status = b'OK'
+            except OSError as e:
+                print(f"Error syncing received file: {e}")
+                status = b'ER'
+            unacked.remove((sid, ticket))
+            conn.sendall(mux.frame(mux.ACK, sid, 2) + status)
+
+    def _mux_drop(self, conn, streams, sid, code=None, notify=True):
+        """Abandon a stream and its .partial file; tell the sender ``code`` unless it cancelled"""
+        stream = streams.pop(sid, None)
+        if stream is None:
+            return
+        if stream['writer'] is not None:
+            try:
+                stream['writer'].close()
+            except OSError:
+                pass
+        self._discard(stream['partial'])
+        self._partial_locks.release((id(conn), sid))
+        if code is not None and notify:
+            try:
+                conn.sendall(mux.frame(mux.CANCEL, sid, 4) + struct.pack('!I', code))
+            except OSError:
+                pass
+
+    def _discard(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
     def _receive_files_single(self, conn):
         """Receive single file using single-file protocol"""
         try:
@@ -256,16 +1339,16 @@ class TransferServer:
             output_path.parent.mkdir(parents=True, exist_ok=True)
             
             received = 0
-            with open(output_path, 'wb') as f:
+            throttle = self._throttles[id(conn)]
+            with self._pipeline(BlockWriter(output_path, filesize, bulk=self.bulk), conn=conn) as f:
                 start_time = time.time()
                 while received < filesize:
-                    chunk_size = min(self.BUFFER_SIZE, filesize - received)
-                    data = conn.recv(chunk_size)
-                    if not data:
+                    n = f.recv_from(conn, throttle.max_send(filesize - received))
+                    if not n:
                         print("[DEBUG] _receive_files_single: recv returned no data (connection closed?)")
                         break
-                    f.write(data)
-                    received += len(data)
+                    received += n
+                    throttle.pace(n)
 
                     # Report progress via callback if available
                     try:
@@ -281,6 +1364,7 @@ class TransferServer:
                     except Exception:
                         pass
             
+            self._make_durable(output_path)
             print(f"\nFile saved to: {output_path.absolute()}")
             
             # Send acknowledgment
@@ -301,8 +1385,12 @@ class TransferServer:
         """
         return self._receive_files(conn)
     
-    def _receive_single_file(self, conn, file_index=1, total_files=1):
-        """Receive a single file from the connection"""
+    def _receive_single_file(self, conn, file_index=1, total_files=1, staging=None):
+        """Receive a single file from the connection.
+
+        With ``staging`` (a StagingArea) the file is written there and the
+        caller commits the batch; otherwise it goes straight to output_dir.
+        """
         try:
             # Receive filename length (4 bytes)
             filename_len_data = self._recv_exact(conn, 4)
@@ -329,19 +1417,22 @@ class TransferServer:
                 print(f"Receiving: {filename} ({self._format_size(filesize)})")
             
             # Receive file content
-            output_path = self.output_dir / filename
-            output_path.parent.mkdir(parents=True, exist_ok=True)
+            if staging is not None:
+                output_path = staging.file_path(filename)
+            else:
+                output_path = self.output_dir / filename
+                output_path.parent.mkdir(parents=True, exist_ok=True)
             
             received = 0
-            with open(output_path, 'wb') as f:
+            throttle = self._throttles[id(conn)]
+            with self._pipeline(BlockWriter(output_path, filesize, bulk=self.bulk), conn=conn) as f:
                 start_time = time.time()
                 while received < filesize:
-                    chunk_size = min(self.BUFFER_SIZE, filesize - received)
-                    data = conn.recv(chunk_size)
-                    if not data:
+                    n = f.recv_from(conn, throttle.max_send(filesize - received))
+                    if not n:
                         break
-                    f.write(data)
-                    received += len(data)
+                    received += n
+                    throttle.pace(n)
 
                     # Report progress via callback if available
                     try:
@@ -357,7 +1448,13 @@ class TransferServer:
                     except Exception:
                         pass
             
-            print(f"\nFile saved to: {output_path.absolute()}")
+            if received < filesize:
+                return None
+            if staging is not None:
+                print(f"\nFile received: {filename}")
+            else:
+                self._make_durable(output_path)
+                print(f"\nFile saved to: {output_path.absolute()}")
             
             return filename, filesize
             
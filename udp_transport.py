@@ -0,0 +1,699 @@
+#!/usr/bin/env python3
+"""
+UDP Transport Module
+Reliable, paced and congestion-controlled byte stream over UDP (UDT-like) for
+long-RTT or lossy links where a single TCP stream collapses.
+
+UDPConnection implements the subset of the socket API used by TransferClient
+and TransferServer (sendall, recv, close, settimeout, getpeername), so the
+existing transfer protocols run over it unchanged.
+"""
+import socket
+import struct
+import threading
+import select
+import random
+import time
+import heapq
+
+
+# Packet layout: type (B) | conn_id (I) | seq (Q) | type-specific fields.
+# Sequence numbers are 64-bit so they never wrap (2^32 packets is only ~5.6 TiB).
+PKT = struct.Struct('!BIQ')
+DATA_INFO = struct.Struct('!I')        # send timestamp (us, wraps)
+ACK_INFO = struct.Struct('!IIIH')      # window (packets), ts echo, ack delay (us), range count
+ACK_RANGE = struct.Struct('!QQ')       # missing seqs, inclusive
+SYN_INFO = struct.Struct('!I')         # receive window (packets)
+
+T_SYN = 1
+T_SYNACK = 2
+T_DATA = 3
+T_ACK = 4
+T_FIN = 5
+T_FINACK = 6
+
+MAX_ACK_RANGES = 64
+
+
+def _now_us():
+    return int(time.monotonic() * 1000000) & 0xFFFFFFFF
+
+
+class UDPConnection:
+    """One reliable UDP stream driven by a background engine thread.
+
+    Sender: packets are paced by a token bucket whose rate follows a
+    UDT-style controller (slow start, then periodic increase and a 1/8
+    decrease on loss above LOSS_TOLERANCE, at most once per two RTTs).
+    Receiver: delivers in order, advertises a flow window and reports
+    missing ranges (NAK) in every ACK so losses are repaired within one RTT.
+    """
+    MSS = 1400  # payload bytes per packet
+    SYN_INTERVAL = 0.01  # ACK / rate control tick
+    RCV_WINDOW = 8192  # packets
+    SND_BUFFER = 8 * 1024 * 1024  # bytes queued by sendall() before it blocks
+    INITIAL_RATE = 512 * 1024  # bytes/sec, doubled every RTT during slow start
+    MIN_RATE = 64 * 1024
+    MAX_RATE = 1024 * 1024 * 1024
+    LOSS_TOLERANCE = 0.01  # random loss below this ratio does not reduce the rate
+    MIN_RTO = 0.2
+    KEEPALIVE_INTERVAL = 1.0
+    PEER_TIMEOUT = 30.0
+    HANDSHAKE_RETRY = 0.2
+    CLOSE_TIMEOUT = 30.0
+    FIN_RETRIES = 5
+
+    def __init__(self, sock, peer, conn_id, peer_window=None, server_side=False):
+        self._sock = sock
+        self._sock.setblocking(False)
+        for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                self._sock.setsockopt(socket.SOL_SOCKET, opt, 4 * 1024 * 1024)
+            except Exception:
+                pass
+        self._peer = peer
+        self._conn_id = conn_id
+        self._timeout = None
+        self._cond = threading.Condition()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+
+        # Sender state
+        self._pending = bytearray()
+        self._snd_next = 0
+        self._snd_una = 0
+        self._unacked = {}
+        self._sent_at = {}
+        self._loss = []
+        self._loss_set = set()
+        self._peer_window = peer_window or self.RCV_WINDOW
+        self._rate = float(self.INITIAL_RATE)
+        self._tokens = float(self.MSS * 4)
+        self._last_refill = time.monotonic()
+        self._slow_start = True
+        self._srtt = None
+        self._rttvar = 0.0
+        self._last_decrease = 0.0
+        self._last_increase = time.monotonic()  # last congestion-avoidance probe
+        self._last_progress = time.monotonic()
+        self._period_sent = 0
+        self._period_lost = 0
+
+        # Receiver state
+        self._recv_buf = bytearray()
+        self._rcv_next = 0
+        self._ooo = {}
+        self._missing = set()
+        self._highest = -1
+        self._ack_needed = True
+        self._last_ack = 0.0
+        self._last_ts = 0
+        self._last_ts_at = time.monotonic()
+        self._last_heard = time.monotonic()
+
+        # Connection state
+        self._handshake_pending = server_side
+        self._last_synack = 0.0
+        self._closing = False
+        self._fin_sent = 0
+        self._fin_last = 0.0
+        self._peer_fin = None
+        self._peer_closed = False
+        self._done = False
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # ------------------------------------------------------------------
+    # Socket-like API
+    # ------------------------------------------------------------------
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        pos = 0
+        deadline = time.monotonic() + self._timeout if self._timeout is not None else None
+        with self._cond:
+            while pos < len(view):
+                self._check_error()
+                if self._closing:
+                    raise ConnectionError("UDP connection is closing")
+                room = self.SND_BUFFER - len(self._pending)
+                if room <= 0:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise socket.timeout("timed out")
+                    self._cond.wait(remaining if remaining is not None else 0.5)
+                    continue
+                chunk = view[pos:pos + room]
+                self._pending += chunk
+                pos += len(chunk)
+                self._wake()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, bufsize):
+        deadline = time.monotonic() + self._timeout if self._timeout is not None else None
+        with self._cond:
+            while not self._recv_buf:
+                if self._peer_closed:
+                    return b''
+                self._check_error()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout("timed out")
+                self._cond.wait(remaining if remaining is not None else 0.5)
+            data = bytes(self._recv_buf[:bufsize])
+            del self._recv_buf[:len(data)]
+            # Re-open the flow window promptly once the application drains it
+            if len(self._recv_buf) < self.RCV_WINDOW * self.MSS // 4:
+                self._ack_needed = True
+        self._wake()
+        return data
+
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        with memoryview(buffer) as view:
+            view[:len(data)] = data
+        return len(data)
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def setsockopt(self, *args):
+        # TCP/socket options do not apply; accepted for compatibility
+        pass
+
+    def getpeername(self):
+        return self._peer
+
+    def getsockname(self):
+        return self._sock.getsockname()
+
+    def close(self):
+        """Flush queued data, exchange FIN/FINACK and stop the engine."""
+        if self._done and self._sock is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._wake()
+            deadline = time.monotonic() + self.CLOSE_TIMEOUT
+            while not self._done and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._done = True
+        self._wake()
+        self._thread.join(timeout=1.0)
+        for s in (self._sock, self._wake_r, self._wake_w):
+            try:
+                s.close()
+            except Exception:
+                pass
+        self._sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ------------------------------------------------------------------
+    # Engine
+    # ------------------------------------------------------------------
+    def _check_error(self):
+        if self._error is not None:
+            raise ConnectionError(f"UDP connection failed: {self._error}")
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _fail(self, reason):
+        with self._cond:
+            if self._error is None and not self._done:
+                self._error = reason
+            self._done = True
+            self._cond.notify_all()
+
+    def _run(self):
+        try:
+            while not self._done:
+                timeout = self._next_timeout()
+                readable, _, _ = select.select([self._sock, self._wake_r], [], [], timeout)
+                if self._wake_r in readable:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                if self._sock in readable:
+                    self._read_packets()
+                with self._cond:
+                    self._on_timers()
+                    self._send_packets()
+                    self._cond.notify_all()
+        except Exception as e:
+            self._fail(str(e))
+
+    def _next_timeout(self):
+        with self._cond:
+            if self._loss or (self._pending and len(self._unacked) < self._window()):
+                if self._tokens >= self.MSS:
+                    return 0
+                return max(0.0005, (self.MSS - self._tokens) / self._rate)
+            if self._ack_needed or self._unacked or self._closing or self._handshake_pending:
+                return self.SYN_INTERVAL
+            return self.KEEPALIVE_INTERVAL
+
+    def _window(self):
+        srtt = self._srtt or 0.1
+        cwnd = int(2 * self._rate * srtt / self.MSS) + 16
+        return max(1, min(self._peer_window, cwnd))
+
+    def _rto(self):
+        if self._srtt is None:
+            return 1.0
+        return max(self.MIN_RTO, self._srtt + 4 * self._rttvar)
+
+    def _read_packets(self):
+        for _ in range(512):
+            try:
+                packet = self._sock.recv(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                raise ConnectionError("peer unreachable")
+            if len(packet) < PKT.size:
+                continue
+            ptype, conn_id, seq = PKT.unpack_from(packet)
+            if conn_id != self._conn_id:
+                continue
+            self._last_heard = time.monotonic()
+            self._handshake_pending = False
+            with self._cond:
+                if ptype == T_DATA:
+                    self._on_data(seq, packet)
+                elif ptype == T_ACK:
+                    self._on_ack(seq, packet)
+                elif ptype == T_FIN:
+                    self._peer_fin = seq
+                    self._check_peer_fin()
+                elif ptype == T_FINACK:
+                    if self._closing and self._fin_sent:
+                        self._done = True
+                self._cond.notify_all()
+
+    def _on_data(self, seq, packet):
+        if seq >= self._rcv_next + self.RCV_WINDOW:
+            return  # beyond the window we advertised: would grow _missing and _ooo without bound
+        ts = DATA_INFO.unpack_from(packet, PKT.size)[0]
+        self._last_ts = ts
+        self._last_ts_at = time.monotonic()
+        payload = packet[PKT.size + DATA_INFO.size:]
+        if seq < self._rcv_next or seq in self._ooo:
+            self._ack_needed = True  # duplicate: our ACK was probably lost
+            return
+        if seq > self._highest + 1:
+            # New gap: report it immediately (fast NAK)
+            self._missing.update(range(self._highest + 1, seq))
+            self._send_ack()
+        self._missing.discard(seq)
+        if seq > self._highest:
+            self._highest = seq
+        if seq == self._rcv_next:
+            self._recv_buf += payload
+            self._rcv_next += 1
+            while self._rcv_next in self._ooo:
+                self._recv_buf += self._ooo.pop(self._rcv_next)
+                self._rcv_next += 1
+            self._check_peer_fin()
+        else:
+            self._ooo[seq] = payload
+        self._ack_needed = True
+
+    def _check_peer_fin(self):
+        if self._peer_fin is not None and self._rcv_next >= self._peer_fin:
+            self._peer_closed = True
+            self._sock.send(PKT.pack(T_FINACK, self._conn_id, self._peer_fin))
+
+    def _on_ack(self, cum, packet):
+        window, ts_echo, delay, nranges = ACK_INFO.unpack_from(packet, PKT.size)
+        now = time.monotonic()
+        self._peer_window = max(1, window)
+        if ts_echo:
+            sample = ((_now_us() - ts_echo) & 0xFFFFFFFF) - delay
+            if 0 < sample < 10000000:
+                rtt = sample / 1000000.0
+                if self._srtt is None:
+                    self._srtt = rtt
+                    self._rttvar = rtt / 2
+                else:
+                    self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+                    self._srtt = 0.875 * self._srtt + 0.125 * rtt
+
+        acked = 0
+        if cum > self._snd_una:
+            for s in range(self._snd_una, min(cum, self._snd_next)):
+                if self._unacked.pop(s, None) is not None:
+                    acked += 1
+                self._sent_at.pop(s, None)
+                self._loss_set.discard(s)
+            self._snd_una = cum
+            self._last_progress = now
+        if acked and self._slow_start:
+            # Slow start: +1 MSS/RTT per acked packet doubles the rate every RTT
+            self._rate = min(self.MAX_RATE, self._rate + acked * self.MSS / (self._srtt or 0.1))
+
+        new_losses = 0
+        pos = PKT.size + ACK_INFO.size
+        srtt = self._srtt or 0.1
+        for _ in range(nranges):
+            first, last = ACK_RANGE.unpack_from(packet, pos)
+            pos += ACK_RANGE.size
+            for s in range(max(first, self._snd_una), min(last + 1, self._snd_next)):
+                if s in self._loss_set or s not in self._unacked:
+                    continue
+                # Do not retransmit again before the previous copy could have arrived
+                if now - self._sent_at.get(s, 0) < srtt:
+                    continue
+                self._loss_set.add(s)
+                heapq.heappush(self._loss, s)
+                new_losses += 1
+        if new_losses:
+            self._period_lost += new_losses
+            self._on_loss(now)
+
+    def _on_loss(self, now):
+        srtt = self._srtt or 0.1
+        if self._slow_start:
+            self._slow_start = False
+            self._rate = max(self.MIN_RATE, self._rate * 0.5)
+            self._last_decrease = now
+            self._period_sent = self._period_lost = 0
+            return
+        if now - self._last_decrease < 2 * srtt:
+            return
+        if self._period_lost > self.LOSS_TOLERANCE * max(1, self._period_sent):
+            self._rate = max(self.MIN_RATE, self._rate * 0.875)
+            self._last_decrease = now
+        self._period_sent = self._period_lost = 0
+
+    def _on_timers(self):
+        now = time.monotonic()
+        if now - self._last_heard > self.PEER_TIMEOUT:
+            raise ConnectionError("peer timed out")
+
+        if self._handshake_pending and now - self._last_synack >= self.HANDSHAKE_RETRY:
+            self._sock.send(PKT.pack(T_SYNACK, self._conn_id, 0) + SYN_INFO.pack(self.RCV_WINDOW))
+            self._last_synack = now
+
+        # Periodic ACK / keepalive
+        if (self._ack_needed and now - self._last_ack >= self.SYN_INTERVAL) or \
+                now - self._last_ack >= self.KEEPALIVE_INTERVAL:
+            self._send_ack()
+
+        # Congestion avoidance: probe for bandwidth every tick since the last decrease
+        if not self._slow_start and self._unacked and now - self._last_decrease > (self._srtt or 0.1):
+            ticks = (now - self._last_increase) / self.SYN_INTERVAL
+            if ticks >= 1:
+                self._rate = min(self.MAX_RATE, self._rate + max(self._rate * 0.01, self.MSS * 100) * int(ticks))
+                self._last_increase = now
+        else:
+            self._last_increase = now
+
+        # Retransmission timeout: everything outstanding is presumed lost
+        if self._unacked and now - self._last_progress > self._rto():
+            for s in sorted(self._unacked):
+                if s not in self._loss_set:
+                    self._loss_set.add(s)
+                    heapq.heappush(self._loss, s)
+            self._rate = max(self.MIN_RATE, self._rate * 0.5)
+            self._slow_start = False
+            self._last_progress = now
+
+        # Closing: FIN once everything we sent is acknowledged
+        if self._closing and not self._pending and not self._unacked:
+            if self._peer_closed and not self._fin_sent:
+                self._done = True
+            elif self._fin_sent >= self.FIN_RETRIES and now - self._fin_last >= self._rto():
+                self._done = True
+            elif now - self._fin_last >= self._rto():
+                self._sock.send(PKT.pack(T_FIN, self._conn_id, self._snd_next))
+                self._fin_sent += 1
+                self._fin_last = now
+
+    def _send_ack(self):
+        now = time.monotonic()
+        ranges = []
+        if self._missing:
+            first = last = None
+            for s in sorted(self._missing):
+                if first is None:
+                    first = last = s
+                elif s == last + 1:
+                    last = s
+                else:
+                    ranges.append((first, last))
+                    if len(ranges) >= MAX_ACK_RANGES:
+                        first = None
+                        break
+                    first = last = s
+            if first is not None:
+                ranges.append((first, last))
+        buffered = len(self._ooo) + len(self._recv_buf) // self.MSS
+        window = max(0, self.RCV_WINDOW - buffered)
+        delay = int((now - self._last_ts_at) * 1000000) if self._last_ts else 0
+        packet = (PKT.pack(T_ACK, self._conn_id, self._rcv_next)
+                  + ACK_INFO.pack(window, self._last_ts, delay, len(ranges))
+                  + b''.join(ACK_RANGE.pack(a, b) for a, b in ranges))
+        try:
+            self._sock.send(packet)
+        except (BlockingIOError, InterruptedError):
+            pass
+        self._last_ack = now
+        self._ack_needed = False
+        self._last_ts = 0
+
+    def _send_packets(self):
+        now = time.monotonic()
+        burst = max(self.MSS * 4, self._rate * 0.002)
+        self._tokens = min(burst, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+        while self._tokens >= self.MSS:
+            if self._loss:
+                seq = heapq.heappop(self._loss)
+                self._loss_set.discard(seq)
+                payload = self._unacked.get(seq)
+                if payload is None:
+                    continue
+            elif self._pending and len(self._unacked) < self._window():
+                seq = self._snd_next
+                payload = bytes(self._pending[:self.MSS])
+                del self._pending[:len(payload)]
+                self._unacked[seq] = payload
+                if not self._sent_at:
+                    self._last_progress = now
+                self._snd_next += 1
+            else:
+                return
+            try:
+                self._sock.send(PKT.pack(T_DATA, self._conn_id, seq) + DATA_INFO.pack(_now_us()) + payload)
+            except (BlockingIOError, InterruptedError):
+                # Kernel buffer full: treat as lost and retry on the next pass
+                if seq not in self._loss_set:
+                    self._loss_set.add(seq)
+                    heapq.heappush(self._loss, seq)
+                return
+            self._sent_at[seq] = now
+            self._tokens -= len(payload)
+            self._period_sent += 1
+
+
+def udp_connect(host, port, timeout=10):
+    """Open a UDPConnection to a UDPListener at (host, port)."""
+    addr = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', 0))
+    conn_id = random.getrandbits(32)
+    syn = PKT.pack(T_SYN, conn_id, 0) + SYN_INFO.pack(UDPConnection.RCV_WINDOW)
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            sock.sendto(syn, addr)
+            readable, _, _ = select.select([sock], [], [], 0.25)
+            if not readable:
+                continue
+            try:
+                packet, peer = sock.recvfrom(65535)
+            except ConnectionRefusedError:
+                time.sleep(0.25)
+                continue
+            if len(packet) < PKT.size + SYN_INFO.size:
+                continue
+            ptype, cid, _ = PKT.unpack_from(packet)
+            if ptype == T_SYNACK and cid == conn_id:
+                window = SYN_INFO.unpack_from(packet, PKT.size)[0]
+                # The server answers from a dedicated per-connection port
+                sock.connect(peer)
+                return UDPConnection(sock, peer, conn_id, peer_window=window)
+    except Exception:
+        sock.close()
+        raise
+    sock.close()
+    raise ConnectionError(f"UDP connect to {host}:{port} timed out")
+
+
+class UDPListener:
+    """Accept UDPConnections on a UDP port (one ephemeral socket per connection)."""
+
+    def __init__(self, host='0.0.0.0', port=0):
+        self.host = host
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self.port = self._sock.getsockname()[1]
+        self._conns = {}
+
+    def accept(self, timeout=None):
+        """Wait for a SYN and return (UDPConnection, addr)."""
+        self._sock.settimeout(timeout)
+        while True:
+            packet, addr = self._sock.recvfrom(65535)
+            if len(packet) < PKT.size:
+                continue
+            ptype, conn_id, _ = PKT.unpack_from(packet)
+            if ptype != T_SYN:
+                continue
+            key = (addr, conn_id)
+            # Drop finished connections; a repeated SYN for a live one is
+            # answered by that connection's own SYNACK retries
+            self._conns = {k: c for k, c in self._conns.items() if not c._done}
+            if key in self._conns:
+                continue
+            window = SYN_INFO.unpack_from(packet, PKT.size)[0] if len(packet) >= PKT.size + SYN_INFO.size else None
+            conn_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            conn_sock.bind((self.host, 0))
+            conn_sock.connect(addr)
+            conn = UDPConnection(conn_sock, addr, conn_id, peer_window=window, server_side=True)
+            self._conns[key] = conn
+            return conn, addr
+
+    def close(self):
+        try:
+            self._sock.close()
+        except Exception:
+            pass
+
+
+class LossyProxy:
+    """UDP relay that injects one-way delay and random loss (test harness).
+
+    Clients talk to the proxy's port; packets are forwarded to the listener
+    and, after the handshake, to whichever server port answered.
+    """
+
+    def __init__(self, target_host, target_port, delay=0.04, loss=0.01, listen_port=0):
+        self.target = (target_host, target_port)
+        self.delay = delay
+        self.loss = loss
+        self._front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._front.bind(('127.0.0.1', listen_port))
+        self.port = self._front.getsockname()[1]
+        self._back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._back.bind(('127.0.0.1', 0))
+        self._client = None
+        self._server = None
+        self._queue = []
+        self._cond = threading.Condition()
+        self.running = True
+        threading.Thread(target=self._pump, daemon=True).start()
+        threading.Thread(target=self._release, daemon=True).start()
+
+    def _pump(self):
+        while self.running:
+            readable, _, _ = select.select([self._front, self._back], [], [], 0.2)
+            for s in readable:
+                try:
+                    packet, addr = s.recvfrom(65535)
+                except OSError:
+                    continue
+                if s is self._front:
+                    self._client = addr
+                    ptype = packet[0] if packet else 0
+                    dest = self.target if (ptype == T_SYN or self._server is None) else self._server
+                    out = self._back
+                else:
+                    if addr != self.target:
+                        self._server = addr
+                    dest = self._client
+                    out = self._front
+                if dest is None or random.random() < self.loss:
+                    continue
+                with self._cond:
+                    heapq.heappush(self._queue, (time.monotonic() + self.delay, id(packet), out, packet, dest))
+                    self._cond.notify()
+
+    def _release(self):
+        while self.running:
+            with self._cond:
+                while not self._queue and self.running:
+                    self._cond.wait(0.2)
+                if not self._queue:
+                    continue
+                due = self._queue[0][0] - time.monotonic()
+                if due > 0:
+                    self._cond.wait(due)
+                    continue
+                _, _, out, packet, dest = heapq.heappop(self._queue)
+            try:
+                out.sendto(packet, dest)
+            except OSError:
+                pass
+
+    def close(self):
+        self.running = False
+        self._front.close()
+        self._back.close()
+
+
+# Command-line test harness: loopback transfer through a delay/loss proxy
+if __name__ == '__main__':
+    import argparse
+    import os
+    import tempfile
+    from pathlib import Path
+    from transfer_server import TransferServer
+    from transfer_client import TransferClient
+
+    parser = argparse.ArgumentParser(description="UDP transport loopback test with injected delay and loss")
+    parser.add_argument('--size', type=int, default=16 * 1024 * 1024, help='Test file size in bytes')
+    parser.add_argument('--delay', type=float, default=40, help='One-way delay in ms (default: 40, i.e. 80 ms RTT)')
+    parser.add_argument('--loss', type=float, default=0.01, help='Packet loss probability (default: 0.01)')
+    parser.add_argument('--port', type=int, default=5099, help='UDP port for the test receiver')
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='netlink_udp_'))
+    source = workdir / 'source.bin'
+    with open(source, 'wb') as f:
+        f.write(os.urandom(args.size))
+    server = TransferServer(port=args.port, output_dir=workdir / 'received', udp=True)
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.3)
+    proxy = LossyProxy('127.0.0.1', args.port, delay=args.delay / 1000.0, loss=args.loss)
+
+    client = TransferClient('127.0.0.1', proxy.port, transport='udp', copy_offload=False)
+    start = time.time()
+    client.send_single_file(source)
+    elapsed = time.time() - start
+    proxy.close()
+    received = workdir / 'received' / 'source.bin'
+    ok = received.exists() and received.read_bytes() == source.read_bytes()
+    print(f"UDP self-test: {'OK' if ok else 'FAILED'} - {args.size / elapsed / 1048576:.2f} MB/s "
+          f"over {2 * args.delay:.0f} ms RTT with {args.loss * 100:.1f}% loss")
+    print(f"Files kept in {workdir}")
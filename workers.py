@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Receive Workers Module
+Scales TransferServer across CPU cores: the parent forks worker processes
+that all accept on the same port (SO_REUSEPORT, the kernel spreads the
+connections), each serving connections from a small thread pool. Workers
+report progress to the parent over a pipe; the parent aggregates it.
+POSIX only.
+"""
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from transport import get_transport
+
+
+def workers_supported():
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class _Reporter:
+    """Worker side of the stats pipe: one JSON line per record."""
+    REPORT_INTERVAL = 0.5  # seconds between progress records of one transfer
+
+    def __init__(self, fd, worker):
+        self.fd = fd
+        self.worker = worker
+        self._last = {}
+
+    def send(self, **record):
+        record['w'] = self.worker
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        try:
+            os.write(self.fd, line)  # below PIPE_BUF, so lines never interleave
+        except OSError:
+            pass  # parent gone
+
+    def progress(self, received, total, speed=None, eta=None, filename=None):
+        now = time.time()
+        key = (threading.get_ident(), filename)
+        if received < total and now - self._last.get(key, 0) < self.REPORT_INTERVAL:
+            return
+        self._last[key] = now
+        if received >= total:
+            self._last.pop(key, None)
+        self.send(t='progress', i=key[0], f=(filename or '')[:512], r=received, n=total, s=speed, e=eta)
+
+
+class WorkerPool:
+    """Runs ``server`` in ``workers`` processes with ``threads`` threads each.
+
+    Every worker binds the server's TCP port with SO_REUSEPORT. Worker 0
+    also serves the Unix socket and UDP transports, which cannot be shared.
+    Partial files are claimed through a lock file in output_dir, so a
+    resumed transfer that lands on another worker cannot write the same
+    file twice. The parent prints aggregated stats every STATS_INTERVAL
+    seconds and forwards progress to the server's progress_callback.
+    """
+    STATS_INTERVAL = 5
+
+    def __init__(self, server, workers, threads=4):
+        self.server = server
+        self.workers = workers
+        self.threads = threads
+        self.pids = []
+        self.files = 0
+        self.bytes = 0
+        self._active = {}  # (worker, thread) -> transfer in progress there
+
+    def run(self):
+        """Fork the workers and aggregate their reports until they exit"""
+        read_fd, write_fd = os.pipe()
+        for index in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                code = 0
+                try:
+                    self._worker_main(index, write_fd)
+                except KeyboardInterrupt:
+                    pass
+                except Exception as e:
+                    _Reporter(write_fd, index).send(t='error', m=str(e))
+                    code = 1
+                finally:
+                    os._exit(code)
+            self.pids.append(pid)
+        os.close(write_fd)
+        print(f"Started {self.workers} receive workers on port {self.server.port} "
+              f"({self.threads} threads each)")
+        try:
+            # Stop the workers too when the parent is terminated
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        except ValueError:
+            pass  # not the main thread
+        try:
+            self._aggregate(read_fd)
+        finally:
+            os.close(read_fd)
+            self.stop()
+
+    def stop(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = []
+
+    def _worker_main(self, index, write_fd):
+        server = self.server
+        reporter = _Reporter(write_fd, index)
+        server.progress_callback = reporter.progress
+        listener = get_transport('tcp').listen('0.0.0.0', server.port, reuse_port=True)
+        if index == 0:
+            # In-process memory connections cannot reach a forked worker
+            server.transports = [t for t in server.transports if t != 'memory']
+            server._start_extra_listeners()
+        pool = ThreadPoolExecutor(max_workers=self.threads)
+        # Paused sessions give their thread back; they continue on the pool
+        server._dispatch = pool.submit
+        parent = os.getppid()
+
+        listener.settimeout(1)
+        with listener:
+            while os.getppid() == parent:  # exit if the parent died without stopping us
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    continue
+                conn.settimeout(None)
+                pool.submit(server._receive_files, conn)
+
+    def _aggregate(self, read_fd):
+        buf = b''
+        started = last_stats = time.time()
+        changed = False
+        while True:
+            if select.select([read_fd], [], [], self.STATS_INTERVAL)[0]:
+                data = os.read(read_fd, 65536)
+                if not data:
+                    return  # every worker exited
+                buf += data
+                *lines, buf = buf.split(b'\n')
+                for line in lines:
+                    try:
+                        self._record(json.loads(line))
+                        changed = True
+                    except ValueError:
+                        continue
+            now = time.time()
+            if changed and now - last_stats >= self.STATS_INTERVAL:
+                last_stats = now
+                changed = False
+                rate = self.bytes / max(0.001, now - started)
+                print(f"Workers: {len(self._active)} active transfer(s), {self.files} file(s) "
+                      f"received ({self.server._format_size(self.bytes)}, "
+                      f"{self.server._format_size(rate)}/s average)")
+
+    def _record(self, record):
+        kind = record.get('t')
+        if kind == 'progress':
+            # A worker thread handles one transfer at a time
+            key = (record.get('w'), record.get('i'))
+            if record['r'] >= record['n']:
+                self._active.pop(key, None)
+                self.files += 1
+                self.bytes += record['n']
+            else:
+                self._active[key] = record
+            callback = self.server.progress_callback
+            if callback:
+                try:
+                    callback(record['r'], record['n'], record.get('s'), record.get('e'), record.get('f') or None)
+                except Exception:
+                    pass
+        elif kind == 'error':
+            print(f"Worker {record.get('w')} failed: {record.get('m')}")